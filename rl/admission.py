@@ -0,0 +1,115 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+class AdaptiveLimiter:
+  """
+  Caps how many callers hold a slot at once and adapts the cap to how the backend copes (AIMD).
+
+  Every completion reported through `record` adds 1/limit to the cap while latency stays
+  within `tolerance` times its long-run baseline (or under `target_latency`, if given);
+  an error or a latency above that multiplies it by `decrease`, at most once per `cooldown`
+  seconds. Waiters are admitted in priority order, first come first served among equals.
+  """
+  def __init__(self, name, initial, min_limit=1, max_limit=None, target_latency=None, tolerance=2.0, decrease=0.7, cooldown=5.0):
+    self.name = name
+    self.min_limit = min_limit
+    self.max_limit = max_limit if max_limit is not None else initial
+    self.limit = float(max(min_limit, min(initial, self.max_limit)))
+    self.target_latency = target_latency
+    self.tolerance = tolerance
+    self.decrease = decrease
+    self.cooldown = cooldown
+    self.in_flight = 0
+    self.baseline = None # slow EWMA of the latency, what an unloaded backend looks like
+    self.recent = None # fast EWMA of the latency
+    self._last_decrease = 0.0
+    self._waiters = [] # heap of (priority, seq, future)
+    self._seq = itertools.count()
+
+  async def acquire(self, priority=0.0):
+      """
+      Waits for a free slot. Lower priorities are admitted first.
+      """
+      if self.in_flight < int(self.limit) and not self._waiters:
+        self.in_flight += 1
+        return
+      future = asyncio.get_running_loop().create_future()
+      heapq.heappush(self._waiters, (priority, next(self._seq), future))
+      try:
+        await future
+      except asyncio.CancelledError:
+        if future.done() and not future.cancelled():
+          # The slot was handed over just as we were cancelled, pass it on
+          self.release()
+        raise
+
+  def release(self):
+      self.in_flight -= 1
+      self._admit()
+
+  def _admit(self):
+      while self._waiters and self.in_flight < int(self.limit):
+        _, _, future = heapq.heappop(self._waiters)
+        if future.done():
+          continue
+        self.in_flight += 1
+        future.set_result(None)
+
+  def record(self, latency=None, ok=True):
+      """
+      Reports how one request went, growing or shrinking the cap.
+      """
+      overloaded = not ok
+      if latency is not None:
+        self.recent = latency if self.recent is None else 0.8 * self.recent + 0.2 * latency
+        self.baseline = latency if self.baseline is None else min(0.99 * self.baseline + 0.01 * latency, self.recent)
+        if self.target_latency is not None:
+          overloaded = overloaded or self.recent > self.target_latency
+        else:
+          overloaded = overloaded or self.recent > self.tolerance * self.baseline
+      now = time.monotonic()
+      if overloaded:
+        if now - self._last_decrease >= self.cooldown:
+          self._last_decrease = now
+          self.limit = max(self.min_limit, self.limit * self.decrease)
+          print(f"[{self.name}] backend overloaded, concurrency limit down to {int(self.limit)}")
+      else:
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._admit()
+
+  @asynccontextmanager
+  async def slot(self, priority=0.0):
+      """
+      Holds a slot for the duration of the block, recording its latency and whether it raised.
+      """
+      await self.acquire(priority)
+      start_time = time.perf_counter()
+      try:
+        yield
+      except Exception:
+        self.record(time.perf_counter() - start_time, ok=False)
+        raise
+      else:
+        self.record(time.perf_counter() - start_time)
+      finally:
+        self.release()
+
+  def stats(self):
+      return {"name": self.name, "limit": int(self.limit), "in_flight": self.in_flight, "waiting": len(self._waiters), "latency": self.recent}
+
+# Live sandboxes: a slot is held from creation to teardown, only creation latency steers the cap
+SANDBOXES = AdaptiveLimiter(
+  "sandboxes",
+  initial=int(os.getenv("SANDBOX_CONCURRENCY", "16")),
+  max_limit=int(os.getenv("MAX_SANDBOX_CONCURRENCY", os.getenv("SANDBOX_CONCURRENCY", "16"))),
+)
+# Chat completion requests in flight to the inference server
+INFERENCE = AdaptiveLimiter(
+  "inference",
+  initial=int(os.getenv("INFERENCE_CONCURRENCY", "32")),
+  max_limit=int(os.getenv("MAX_INFERENCE_CONCURRENCY", os.getenv("INFERENCE_CONCURRENCY", "32"))),
+)
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+from functools import lru_cache
+
+# Tokens the chat template adds around every message (role header, end-of-turn marker)
+MESSAGE_OVERHEAD = 4
+
+_tokenizer_lock = threading.Lock()
+
+def load_tokenizer(name):
+  """
+  Returns the Hugging Face tokenizer of a model, or None if it can't be loaded,
+  in which case budgets fall back to four characters per token. It is loaded
+  once per process, also when many rollouts ask for it at the same time.
+  """
+  with _tokenizer_lock:
+    return _load_tokenizer(name)
+
+@lru_cache(maxsize=None)
+def _load_tokenizer(name):
+  try:
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name)
+  except Exception as e:
+    print(f"Warning: could not load the tokenizer of {name} ({e}), estimating four characters per token")
+    return None
+
+def _content(message):
+  # Trajectories mix plain message dicts with the model's Choice objects
+  if isinstance(message, dict):
+    return message.get("content") or ""
+  return message.message.content or ""
+
+def _role(message):
+  return message.get("role") if isinstance(message, dict) else "assistant"
+
+class ContextBudget:
+  """
+  Keeps the token count of a conversation as it grows and compacts it before it outgrows the model.
+
+  Every message is tokenized once; counts are cached by content, so a prompt that
+  is re-sent every turn costs nothing to re-measure. Once the conversation passes
+  `compact_at` of `max_tokens`, `compact` rewrites old shell outputs in place:
+  an output identical to a later one is replaced by a note, then the oldest outputs
+  are cut down to their head and tail until the conversation is back under the
+  threshold. The last `keep_recent` outputs are only cut if the conversation
+  would not fit the model otherwise, and the latest one never is.
+  """
+  def __init__(self, tokenizer, max_tokens, compact_at=0.8, keep_recent=4, head_chars=1500, tail_chars=1500):
+    self.tokenizer = tokenizer
+    self.max_tokens = max_tokens
+    self.compact_at = compact_at
+    self.keep_recent = keep_recent
+    self.head_chars = head_chars
+    self.tail_chars = tail_chars
+    self.counts = [] # tokens of each message, in conversation order
+    self.tokens = 0
+    self.compactions = 0
+    self._cache = {}
+    self._lock = threading.Lock()
+
+  def count(self, content):
+      """
+      Returns the tokens of a message's content, including the chat template's overhead.
+      """
+      key = hashlib.sha1(content.encode("utf-8")).digest()
+      with self._lock:
+        tokens = self._cache.get(key)
+      if tokens is None:
+        if self.tokenizer is None:
+          tokens = len(content) // 4
+        else:
+          tokens = len(self.tokenizer.encode(content, add_special_tokens=False))
+        tokens += MESSAGE_OVERHEAD
+        with self._lock:
+          self._cache[key] = tokens
+      return tokens
+
+  def add(self, message):
+      """
+      Accounts for a message appended to the conversation.
+      """
+      tokens = self.count(_content(message))
+      self.counts.append(tokens)
+      self.tokens += tokens
+
+  def fits(self):
+      return self.tokens <= self.max_tokens
+
+  def needs_compaction(self):
+      return self.tokens > self.compact_at * self.max_tokens
+
+  def _replace(self, messages, i, content):
+      messages[i] = {**messages[i], "content": content}
+      tokens = self.count(content)
+      self.tokens += tokens - self.counts[i]
+      self.counts[i] = tokens
+
+  def _truncate(self, messages, i):
+      content = _content(messages[i])
+      if len(content) > self.head_chars + self.tail_chars + 100:
+        omitted = content[self.head_chars:len(content) - self.tail_chars]
+        self._replace(messages, i, f"{content[:self.head_chars]}\n[... {omitted.count(chr(10)) + 1} lines omitted ...]\n{content[len(content) - self.tail_chars:]}")
+
+  def compact(self, messages):
+      """
+      Shrinks old shell outputs in `messages` (the conversation `add` has seen) and returns the tokens saved.
+      """
+      before = self.tokens
+      target = self.compact_at * self.max_tokens
+      outputs = [i for i, m in enumerate(messages) if i > 0 and _role(m) == "user"]
+      old = outputs[:-self.keep_recent] if self.keep_recent else outputs
+      # An output repeated later on (e.g. the same `ls` twice) only needs to be read once
+      seen = {}
+      for i in reversed(outputs):
+        content = _content(messages[i])
+        if len(content) < 200:
+          continue
+        if content in seen and i in old:
+          self._replace(messages, i, f"[output identical to turn {seen[content]}'s, omitted]")
+        else:
+          seen.setdefault(content, outputs.index(i) + 1)
+      for i in old:
+        if self.tokens <= target:
+          break
+        self._truncate(messages, i)
+      # Still too big for the model: recent outputs go too, all but the one the model is about to answer
+      for i in outputs[len(old):-1]:
+        if self.fits():
+          break
+        self._truncate(messages, i)
+      saved = before - self.tokens
+      if saved:
+        self.compactions += 1
+      return saved
+
+  def stats(self):
+      return {"tokens": self.tokens, "max_tokens": self.max_tokens, "messages": len(self.counts), "compactions": self.compactions}
@@ -1,6 +1,9 @@
 import os
 import art
+import asyncio
+from art.trajectories import History as ArtHistory
 import json
+import time
 import traceback
 from pydantic import BaseModel
 from openai import AsyncOpenAI
@@ -14,16 +17,37 @@ load_dotenv()
 
 
 from project_types import Scenario, Message
-from sandbox import SoSClient
+from sandbox import SoSClient, NamespaceClient, exec_streaming
+import metrics # shellm/metrics.py, on the path through sandbox
+from admission import SANDBOXES, INFERENCE
+from history import History # shellm/history.py
+from context_budget import ContextBudget, load_tokenizer
 
 LOCAL = os.getenv("LOCAL", "1") == "1"
 EPHEMERAL = os.getenv("EPHEMERAL", "1") == "1"
 MAX_TURNS = int(os.getenv("MAX_TURNS", "30")) # reasoning counts as 1 turn 
 MAX_MODEL_TOKENS = int(os.getenv("MAX_MODEL_TOKENS", "32000"))
+RESPONSE_TOKENS = int(os.getenv("RESPONSE_TOKENS", "1024")) # room left in the context for the model's reply
+COMPACT_AT = float(os.getenv("COMPACT_AT", "0.8")) # fraction of the budget at which old outputs get compacted
+TOKENIZER = os.getenv("TOKENIZER") # defaults to the model's (base model's) own
 BASE_URL = os.getenv("BASE_URL", "http://rearden:8000/v1")
 API_KEY = os.getenv("API_KEY", "MEOW")
+SANDBOX_BACKEND = os.getenv("SANDBOX_BACKEND", "sos") # "sos" or "namespace"
+SOS_HTTP2 = os.getenv("SOS_HTTP2", "0") == "1"
+SOS_MAX_IN_FLIGHT = int(os.getenv("SOS_MAX_IN_FLIGHT", "128")) # concurrent requests to the sandbox server
+STREAM_EXEC = os.getenv("STREAM_EXEC", "0") == "1" # stream command output and abort runaway commands client-side
+MAX_OUTPUT_CHARS = int(os.getenv("MAX_OUTPUT_CHARS", "16384")) # per command, with STREAM_EXEC
+COMMAND_TIMEOUT = float(os.getenv("COMMAND_TIMEOUT", "60")) # seconds per command, with STREAM_EXEC
 oai = AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY)
-sos = SoSClient(server_url="http://localhost:3000")
+sos = NamespaceClient() if SANDBOX_BACKEND == "namespace" else SoSClient(server_url="http://localhost:3000", http2=SOS_HTTP2, max_in_flight=SOS_MAX_IN_FLIGHT)
+# METRICS_PORT serves sandbox latency histograms for Prometheus, METRICS_FILE dumps them as JSON
+metrics.export_from_env()
+
+def as_messages(messages_and_choices):
+  """
+  Plain chat messages of a history, with the model's Choices turned into assistant messages.
+  """
+  return [m if isinstance(m, dict) else {"role": "assistant", "content": m.message.content} for m in messages_and_choices]
 
 class ProjectTrajectory(art.Trajectory):
   task_id: str
@@ -32,32 +56,32 @@ class ProjectTrajectory(art.Trajectory):
   success_condition_passed: bool
   corrupted: bool
 
+  def conversation(self):
+    """
+    The whole conversation; once compacted, its last history holds all of it in compacted form.
+    """
+    return (self.additional_histories[-1] if self.additional_histories else self).messages()
+
   def format_trajectory(self):
-    messages = self.messages()
+    messages = self.conversation()
     if not messages or len(messages) < 2:
         return "No actions were taken."
-
-    formatted = ""
-    outputs = 0
-    for msg in messages:
-        role = msg['role']
-        content = msg['content'] if 'content' in msg else "None"
-        if role == 'assistant':
-          # as command
-          formatted += f"$ {content}\n"
-        elif role == 'user':
-          # as output
-          formatted += f"{content}\n[EXIT_CODE = {self.exit_codes[outputs]}]\n"
-          outputs += 1
-        elif role == 'system':
-          # as task (should be the first message)
-          formatted += f"TASK: {content}\n\n"
-    return formatted
+    task = messages[0]['content'] if messages[0]['role'] == 'system' else None
+    return History.from_messages(messages, self.exit_codes).shell_transcript(task)
 
 
 async def run_agent(model: art.Model, scenario: Scenario) -> ProjectTrajectory:
   client = model.openai_client() if LOCAL else oai
-  sandbox_id = await sos.create_sandbox(image="shellm-sandbox:latest", setup_commands=scenario.setup_commands)
+  # Rollouts admitted earlier get their inference requests served first, so groups finish together
+  admitted_at = time.monotonic()
+  try:
+    # One round trip for create + start
+    sandbox_id = await sos.create_and_start_sandbox(image="shellm-sandbox:latest", setup_commands=scenario.setup_commands)
+  except Exception as e:
+    SANDBOXES.record(time.monotonic() - admitted_at, ok=False)
+    print(scenario.setup_commands)
+    raise e
+  SANDBOXES.record(time.monotonic() - admitted_at)
   traj = ProjectTrajectory(
     reward=0.0,
     messages_and_choices=[],
@@ -74,64 +98,85 @@ async def run_agent(model: art.Model, scenario: Scenario) -> ProjectTrajectory:
     {"role": "system", "content": system_prompt }
   ]
   traj.exit_codes = []
-
-  try:
-    await sos.start_sandbox(sandbox_id)
-  except Exception as e: 
-    print(scenario.setup_commands)
-    raise e
+  # Exact running size of the conversation, in the model's own tokens
+  # Loaded once per process (load_tokenizer is cached), off the event loop
+  tokenizer = await asyncio.to_thread(load_tokenizer, TOKENIZER or getattr(model, "base_model", None) or model.name)
+  budget = ContextBudget(
+    tokenizer,
+    MAX_MODEL_TOKENS - RESPONSE_TOKENS,
+    compact_at=COMPACT_AT,
+  )
+  budget.add(traj.messages_and_choices[0])
+  # Where turns are recorded. ART trains every history exactly as it was sampled, so after a
+  # compaction the turns continue in a new history that starts from the compacted conversation.
+  context = traj.messages_and_choices
 
   async def finish_traj(sandbox_id: str, success_command: str) -> bool:
     try:
-      _, code = await sos.exec_command(sandbox_id, success_command, standalone=True)
-      await sos.stop_sandbox(sandbox_id, remove=EPHEMERAL)
+      _, code = await sos.exec_and_stop(sandbox_id, success_command, standalone=True, remove=EPHEMERAL)
       return code == 0
     except Exception as e:
-      await sos.stop_sandbox(sandbox_id, remove=EPHEMERAL)
       print(f"[ {scenario.id} ] Error running success command in sandbox: {e}")
+      try:
+        # Usually stopped already, unless the request itself never got through
+        await sos.stop_sandbox(sandbox_id, remove=EPHEMERAL)
+      except Exception:
+        pass
       return False
 
   for turn in range(MAX_TURNS):
 
     @retry(stop=stop_after_attempt(3))
     async def get_response():
-      response = await client.chat.completions.create(
-        messages=traj.messages(),
-        model=model.name,
-        temperature=0.7,
-        top_p=0.95,
-        # extra_body={
-        #   "top_k":50,
-        # }
-      )
+      async with INFERENCE.slot(priority=admitted_at):
+        response = await client.chat.completions.create(
+          messages=as_messages(context),
+          model=model.name,
+          temperature=0.7,
+          top_p=0.95,
+          # extra_body={
+          #   "top_k":50,
+          # }
+        )
 
       if not response.choices[0].message.content or response.choices[0].message.content is None:
         raise Exception("No response from model")
 
       return response.choices[0]
     
-    approx_token_count = 0
-    for msg in traj.messages():
-      approx_token_count += (len(msg['content']) / 4)
-    if approx_token_count > MAX_MODEL_TOKENS:
+    if budget.needs_compaction():
+      # Long trajectories keep going on a shortened view of their old outputs.
+      # Earlier replies become plain messages there, they were already trained where they were sampled.
+      compacted = as_messages(context)
+      saved = budget.compact(compacted)
+      if saved:
+        traj.additional_histories.append(ArtHistory(messages_and_choices=compacted))
+        context = traj.additional_histories[-1].messages_and_choices
+        print(f"[ {scenario.id} ] Compacted old outputs by {saved} tokens, context at {budget.tokens}/{budget.max_tokens}")
+    if not budget.fits():
       await finish_traj(sandbox_id, scenario.success_condition)
       traj.success_condition_passed = False
       return traj
 
     response_message = await get_response()
 
-    traj.messages_and_choices.append(
+    context.append(
       response_message
     )
+    budget.add(response_message)
     
     cmd = response_message.message.content
   
     try:
-      output, exit_code = await sos.exec_command(sandbox_id, cmd) 
+      if STREAM_EXEC:
+        output, exit_code = await exec_streaming(sos, sandbox_id, cmd, max_output_chars=MAX_OUTPUT_CHARS, timeout=COMMAND_TIMEOUT)
+      else:
+        output, exit_code = await sos.exec_command(sandbox_id, cmd) 
 
-      traj.messages_and_choices.append(
+      context.append(
         {"role":"user", "content": output}
       )
+      budget.add(context[-1])
 
 
       if "exit" in cmd and not cmd.startswith("#"):
@@ -149,7 +194,7 @@ async def run_agent(model: art.Model, scenario: Scenario) -> ProjectTrajectory:
       print(f"Error running command in sandbox: {e}")
       traceback.print_exc()
       output = f"Error running command: {e}"
-      traj.messages_and_choices.append({"role": "user", "content": output})
+      context.append({"role": "user", "content": output})
       traj.exit_codes.append(-1)
       await finish_traj(sandbox_id, scenario.success_condition)
       traj.success_condition_passed = False
@@ -163,7 +208,12 @@ async def run_agent(model: art.Model, scenario: Scenario) -> ProjectTrajectory:
 async def run_agent_and_score(
   model: art.Model, scenario: Scenario
 ) -> ProjectTrajectory:
-  traj = await run_agent(model, scenario)
+  # Every rollout holds a sandbox from creation to teardown; the rest wait their turn here
+  await SANDBOXES.acquire()
+  try:
+    traj = await run_agent(model, scenario)
+  finally:
+    SANDBOXES.release()
   
   def check_exit_codes(exit_codes: List[int]) -> float:
     r = sum([-0.1 for x in exit_codes if x != 0]) 
@@ -190,8 +240,8 @@ async def run_agent_and_score(
       reward += check_success_command(traj.success_condition_passed)
       if reward > 0.0:
         extra_reward = check_exit_codes(traj.exit_codes)
-        extra_reward += check_format(traj.messages()) # type: ignore
-        extra_reward += check_turns(traj.messages()) # type: ignore
+        extra_reward += check_format(traj.conversation()) # type: ignore
+        extra_reward += check_turns(traj.conversation()) # type: ignore
         reward += extra_reward if extra_reward > -0.5 else -0.5
     except Exception as e:
       traj.corrupted = True
@@ -200,7 +250,6 @@ async def run_agent_and_score(
 
 
 if __name__ == "__main__":
-  import asyncio
   from load_scenarios import load_scenarios
 
   scenario = load_scenarios(limit=1)[0]
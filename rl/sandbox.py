@@ -1,11 +1,111 @@
 import asyncio
+import json
+import os
+import shlex
+import sys
+import time
+import uuid
 import httpx
 
 TIMEOUT = 300
+# Exit codes exec_streaming reports for a command it gave up on, as timeout(1) and a closed pipe would
+STREAM_TIMEOUT_EXIT_CODE = 124
+STREAM_CAPPED_EXIT_CODE = 141
+# Extra seconds the server gets to report its own timeout before the client gives up on the stream
+STREAM_GRACE = 5
+SHELLM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shellm")
+# shellm/ modules import each other flat; appended so rl's own modules (e.g. this one) win on name clashes
+if SHELLM_DIR not in sys.path:
+  sys.path.append(SHELLM_DIR)
+import metrics
 
 class SoSClient:
-  def __init__(self, server_url="http://localhost:3000"):
+  """
+  Client of a SoS sandbox server. All requests share one keep-alive connection pool,
+  and at most max_in_flight of them are outstanding at a time.
+  """
+  def __init__(self, server_url="http://localhost:3000", max_connections=128, max_keepalive_connections=64, keepalive_expiry=60, http2=False, max_in_flight=128):
     self.server_url = server_url
+    self.limits = httpx.Limits(
+      max_connections=max_connections,
+      max_keepalive_connections=max_keepalive_connections,
+      keepalive_expiry=keepalive_expiry,
+    )
+    self.http2 = http2
+    self.max_in_flight = max_in_flight
+    self._client = None
+    self._client_loop = None
+    self._client_guard = None
+    self._slots = None
+    # Whether the server has the compound endpoints, unknown until the first create_and_start
+    self._compound = None
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.aclose()
+
+  async def _get_client(self):
+      """
+      Returns the shared HTTP client, creating it on first use in the running event loop.
+      """
+      loop = asyncio.get_running_loop()
+      if self._client is None or self._client_loop is not loop:
+        # Connections are bound to the loop that opened them, so a new asyncio.run() needs its own
+        if self._client is not None and not self._client_loop.is_closed():
+          # The old loop still runs (in another thread), so its client is closed there
+          asyncio.run_coroutine_threadsafe(self._client.aclose(), self._client_loop)
+        http2 = self.http2
+        if http2:
+          try:
+            import h2 # noqa: F401
+          except ImportError:
+            print("Warning: HTTP/2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+            http2 = False
+        self._client = httpx.AsyncClient(timeout=TIMEOUT, limits=self.limits, http2=http2, base_url=self.server_url)
+        self._client_loop = loop
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._client_guard = self._close_with_loop(self._client)
+        await self._client_guard.__anext__()
+      return self._client
+
+  async def _close_with_loop(self, client):
+      """
+      Closes a client when its event loop shuts down: loops finalize the async generators
+      they run (asyncio.run() does before closing), and this one closes the client then.
+      """
+      try:
+        yield
+      finally:
+        if self._client is client:
+          self._client = None
+          self._client_loop = None
+        await client.aclose()
+
+  async def aclose(self):
+      """
+      Closes the shared HTTP client and its connections.
+      """
+      if self._client_guard is not None:
+        guard, self._client_guard = self._client_guard, None
+        await guard.aclose()
+
+  async def _request(self, stage, method, path, **kwargs):
+      """
+      Sends one request to the server, recording its latency under a sandbox lifecycle stage.
+      """
+      client = await self._get_client()
+      async with self._slots:
+        with metrics.timed(stage, backend="sos"):
+          try:
+            response = await client.request(method, path, **kwargs)
+          except httpx.TimeoutException:
+            metrics.inc("sandbox_timeouts_total", backend="sos")
+            raise
+      if response.status_code >= 500:
+        metrics.inc("sandbox_failures_total", stage=stage, backend="sos")
+      return response
 
   async def create_sandbox(self, image="ubuntu:latest", setup_commands=None):
       """
@@ -22,13 +122,12 @@ class SoSClient:
       if setup_commands is None:
           setup_commands = []
       payload = {"image": image, "setup_commands": setup_commands}
-      async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-          response = await client.post(f"{self.server_url}/sandboxes", json=payload)
-          response.raise_for_status()
-          parsed = response.json()
-          if "id" not in parsed:
-            raise Exception(f"Failed to create sandbox: {parsed}")
-          return parsed["id"]
+      response = await self._request("create", "POST", "/sandboxes", json=payload)
+      response.raise_for_status()
+      parsed = response.json()
+      if "id" not in parsed:
+        raise Exception(f"Failed to create sandbox: {parsed}")
+      return parsed["id"]
 
   async def list_sandboxes(self):
       """
@@ -40,10 +139,9 @@ class SoSClient:
       Returns:
           list: A list of dictionaries, each containing information about a sandbox.
       """
-      async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-          response = await client.get(f"{self.server_url}/sandboxes")
-          response.raise_for_status()
-          return response.json()
+      response = await self._request("list", "GET", "/sandboxes")
+      response.raise_for_status()
+      return response.json()
 
   async def start_sandbox(self, sandbox_id):
       """
@@ -53,9 +151,54 @@ class SoSClient:
           sandbox_id (str): The ID of the sandbox to start.
           server_url (str): The base URL of the sandbox server.
       """
-      async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-          response = await client.post(f"{self.server_url}/sandboxes/{sandbox_id}/start")
+      # The server starts the container and runs the setup commands here
+      response = await self._request("setup", "POST", f"/sandboxes/{sandbox_id}/start")
+      response.raise_for_status()
+
+  async def create_and_start_sandbox(self, image="ubuntu:latest", setup_commands=None):
+      """
+      Creates and starts a new sandbox in one request, or two on servers without the compound endpoint.
+
+      Returns:
+          str: The new sandbox ID.
+      """
+      if self._compound is not False:
+        payload = {"image": image, "setup_commands": setup_commands or []}
+        response = await self._request("setup", "POST", "/sandboxes/create_and_start", json=payload)
+        if response.status_code in (404, 405):
+          self._compound = False
+        else:
+          self._compound = True
           response.raise_for_status()
+          parsed = response.json()
+          if "id" not in parsed:
+            raise Exception(f"Failed to create sandbox: {parsed}")
+          return parsed["id"]
+      sandbox_id = await self.create_sandbox(image, setup_commands)
+      await self.start_sandbox(sandbox_id)
+      return sandbox_id
+
+  async def exec_and_stop(self, sandbox_id, command, standalone=False, remove=True):
+      """
+      Executes a last command in a sandbox and stops it in one request, or two on servers without the compound endpoint.
+      The sandbox is stopped even if the command fails.
+
+      Returns:
+          tuple: The output and exit code of the command.
+      """
+      if self._compound:
+        payload = {"command": command, "standalone": standalone, "remove": remove}
+        response = await self._request("teardown", "POST", f"/sandboxes/{sandbox_id}/exec_and_stop", json=payload)
+        if response.status_code > 400:
+          raise Exception(f"Failed to execute command `{command}`: {response.text}")
+        parsed = response.json()
+        if "output" not in parsed or "exit_code" not in parsed:
+          raise Exception(f"Failed to execute command: {parsed}")
+        return parsed["output"], parsed["exit_code"]
+      try:
+        return await self.exec_command(sandbox_id, command, standalone)
+      finally:
+        await self.stop_sandbox(sandbox_id, remove)
 
   async def exec_command(self, sandbox_id, command, standalone=False):
       """
@@ -70,14 +213,79 @@ class SoSClient:
           dict: The JSON response from the server, containing stdout, stderr, and exit code.
       """
       payload = {"command": command, "standalone": standalone}
-      async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-          response = await client.post(f"{self.server_url}/sandboxes/{sandbox_id}/exec", json=payload)
-          if response.status_code > 400:
+      response = await self._request("exec", "POST", f"/sandboxes/{sandbox_id}/exec", json=payload)
+      if response.status_code > 400:
+        raise Exception(f"Failed to execute command `{command}`: {response.text}")
+      parsed = response.json()
+      if "output" not in parsed or "exit_code" not in parsed:
+        raise Exception(f"Failed to execute command: {parsed}")
+      return parsed["output"], parsed["exit_code"]
+
+  async def stream_command(self, sandbox_id, command, timeout=None):
+      """
+      Executes a command in a specific sandbox, yielding its output while it runs.
+
+      Yields {"output": str} events, then one {"exit_code": int, ...} event. Closing the
+      generator early drops the connection, and the server interrupts the command.
+      Servers without the streaming endpoint get a plain exec, yielded as one chunk.
+      """
+      client = await self._get_client()
+      payload = {"command": command, "timeout": timeout}
+      async with self._slots:
+        # Timed by hand: a consumer closing the stream early is not a failure
+        start_time = time.perf_counter()
+        async with client.stream("POST", f"/sandboxes/{sandbox_id}/exec_stream", json=payload) as response:
+          if response.status_code in (404, 405):
+            response = None
+          elif response.status_code > 400:
+            await response.aread()
+            metrics.inc("sandbox_failures_total", stage="exec", backend="sos")
             raise Exception(f"Failed to execute command `{command}`: {response.text}")
-          parsed = response.json()
-          if "output" not in parsed or "exit_code" not in parsed:
-            raise Exception(f"Failed to execute command: {parsed}")
-          return parsed["output"], parsed["exit_code"]
+          else:
+            async for line in response.aiter_lines():
+              if line:
+                event = json.loads(line)
+                if "exit_code" in event:
+                  metrics.observe("sandbox_exec_seconds", time.perf_counter() - start_time, backend="sos")
+                yield event
+      if response is None:
+        output, exit_code = await self.exec_command(sandbox_id, command)
+        yield {"output": output}
+        yield {"exit_code": exit_code}
+
+  async def exec_batch(self, sandbox_id, commands, stop_on_error=False):
+      """
+      Executes several commands back to back in a specific sandbox, in one request.
+
+      Args:
+          sandbox_id (str): The ID of the sandbox to execute the commands in.
+          commands (list): The commands to execute, in order.
+          stop_on_error (bool): Skip the remaining commands after the first non-zero exit code.
+
+      Returns:
+          list: One dict per command that ran, with its command, output, exit_code and duration in seconds.
+      """
+      payload = {"commands": commands, "stop_on_error": stop_on_error}
+      response = await self._request("exec_batch", "POST", f"/sandboxes/{sandbox_id}/exec_batch", json=payload)
+      if response.status_code in (404, 405):
+        # Server without batch support, fall back to one request per command
+        return await self._exec_sequentially(sandbox_id, commands, stop_on_error)
+      if response.status_code > 400:
+        raise Exception(f"Failed to execute batch: {response.text}")
+      parsed = response.json()
+      if "results" not in parsed:
+        raise Exception(f"Failed to execute batch: {parsed}")
+      return parsed["results"]
+
+  async def _exec_sequentially(self, sandbox_id, commands, stop_on_error):
+      results = []
+      for command in commands:
+        start_time = time.time()
+        output, exit_code = await self.exec_command(sandbox_id, command)
+        results.append({"command": command, "output": output, "exit_code": exit_code, "duration": time.time() - start_time})
+        if stop_on_error and exit_code != 0:
+          break
+      return results
 
   async def stop_sandbox(self, sandbox_id, remove=True):
       """
@@ -87,9 +295,114 @@ class SoSClient:
           sandbox_id (str): The ID of the sandbox to stop.
           server_url (str): The base URL of the sandbox server.
       """
-      async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-          response = await client.post(f"{self.server_url}/sandboxes/{sandbox_id}/stop", json={'remove': remove})
-          response.raise_for_status()
+      response = await self._request("teardown", "POST", f"/sandboxes/{sandbox_id}/stop", json={'remove': remove})
+      response.raise_for_status()
+
+class NamespaceClient:
+  """
+  Drop-in for SoSClient that runs sandboxes in-process on Linux namespaces
+  (shellm/ns_sandbox.py) instead of talking to a SoS server.
+  """
+  def __init__(self, rootfs=None):
+    from ns_sandbox import NamespaceSandbox, DEFAULT_ROOTFS
+    self.sandbox_cls = NamespaceSandbox
+    self.rootfs = rootfs or DEFAULT_ROOTFS
+    self.sandboxes = {}
+
+  async def create_sandbox(self, image="ubuntu:latest", setup_commands=None):
+      """
+      Creates a new sandbox. The image is ignored, namespace sandboxes use the unpacked rootfs.
+
+      Returns:
+          str: The new sandbox ID.
+      """
+      sandbox_id = uuid.uuid4().hex
+      self.sandboxes[sandbox_id] = self.sandbox_cls(rootfs=self.rootfs, setup_commands=setup_commands or [])
+      return sandbox_id
+
+  async def list_sandboxes(self):
+      return [{"id": sandbox_id} for sandbox_id in self.sandboxes]
+
+  async def start_sandbox(self, sandbox_id):
+      await asyncio.to_thread(self.sandboxes[sandbox_id].start)
+
+  async def create_and_start_sandbox(self, image="ubuntu:latest", setup_commands=None):
+      sandbox_id = await self.create_sandbox(image, setup_commands)
+      await self.start_sandbox(sandbox_id)
+      return sandbox_id
+
+  async def exec_command(self, sandbox_id, command, standalone=False):
+      """
+      Executes a command in a specific sandbox.
+
+      Returns:
+          tuple: The combined stdout and stderr, and the exit code.
+      """
+      if standalone:
+        # Run in a subshell so the session's cwd and variables don't leak in or out
+        command = f"(cd ~ && /bin/bash -c {shlex.quote(command)})"
+      stdout, stderr, exit_code = await asyncio.to_thread(self.sandboxes[sandbox_id].execute_command, command)
+      return stdout + stderr, exit_code
+
+  def stream_command(self, sandbox_id, command, timeout=None):
+      # Handed out as is, so closing it closes the sandbox's stream right away
+      return self.sandboxes[sandbox_id].astream_command(command, timeout)
+
+  async def exec_batch(self, sandbox_id, commands, stop_on_error=False):
+      results = await asyncio.to_thread(self.sandboxes[sandbox_id].execute_batch, commands, stop_on_error)
+      return [{"command": r["command"], "output": r["stdout"] + r["stderr"], "exit_code": r["exit_code"], "duration": r["duration"]} for r in results]
+
+  async def exec_and_stop(self, sandbox_id, command, standalone=False, remove=True):
+      try:
+        return await self.exec_command(sandbox_id, command, standalone)
+      finally:
+        await self.stop_sandbox(sandbox_id, remove)
+
+  async def stop_sandbox(self, sandbox_id, remove=True):
+      # Namespace sandboxes vanish with their processes, so there's nothing to keep around
+      sandbox = self.sandboxes.pop(sandbox_id, None)
+      if sandbox is not None:
+        await asyncio.to_thread(sandbox.stop)
+
+  async def aclose(self):
+      for sandbox_id in list(self.sandboxes):
+        await self.stop_sandbox(sandbox_id)
+
+async def exec_streaming(client, sandbox_id, command, max_output_chars=16 * 1024, timeout=60):
+    """
+    Executes a command through client.stream_command, giving up on it client-side once it
+    prints more than max_output_chars or runs longer than timeout seconds.
+
+    Returns:
+        tuple: The output (cut at the cap) and the exit code, 141 if capped and 124 if timed out.
+    """
+    chunks = []
+    size = 0
+    exit_code = None
+    stream = client.stream_command(sandbox_id, command, timeout=timeout)
+    try:
+      async with asyncio.timeout(timeout + STREAM_GRACE):
+        async for event in stream:
+          if "exit_code" in event:
+            exit_code = event["exit_code"]
+            break
+          text = event.get("output", "")
+          if size + len(text) > max_output_chars:
+            chunks.append(text[:max_output_chars - size])
+            chunks.append(f"\n[output exceeded {max_output_chars} characters, command aborted]\n")
+            exit_code = STREAM_CAPPED_EXIT_CODE
+            break
+          chunks.append(text)
+          size += len(text)
+    except TimeoutError:
+      chunks.append(f"\n[command timed out after {timeout}s, aborted]\n")
+      exit_code = STREAM_TIMEOUT_EXIT_CODE
+    finally:
+      # Stops the command if it is still running
+      await stream.aclose()
+    if exit_code is None:
+      raise Exception(f"Stream of command `{command}` ended without an exit code")
+    return "".join(chunks), exit_code
 
 async def main():
     # Example workflow
@@ -112,6 +425,7 @@ async def main():
         # Stop the sandbox
         if sandbox_id is not None:
             await client.stop_sandbox(sandbox_id)
+        await client.aclose()
 
 if __name__ == '__main__':
     asyncio.run(main())
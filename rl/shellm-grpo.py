@@ -6,153 +6,61 @@ from typing import List, Dict, Any, Tuple, Union
 from openai import AsyncOpenAI, OpenAI
 import verifiers as vf
 from verifiers import ChatMessage, Messages, MultiTurnEnv
-import docker
-import time
-import socket
 from typing import Tuple, List, Dict, Any
 from datasets import Dataset, load_dataset
 from verifiers import MultiTurnEnv, Parser, Rubric
 import os
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from dotenv import load_dotenv
 load_dotenv()
 
+def find_shellm_dir():
+    """Returns the repo's shellm/ directory, whose modules this script imports.
 
-class Sandbox:
-    """Manages an isolated Docker container with a persistent shell session."""
-    
-    def __init__(self, image="shellm-sandbox:latest", setup_commands=[]):
-        self.image = image
-        self.client = docker.from_env()
-        self.container = None
-        self.socket = None
-        self.command_id = 0
-        self.setup_commands = " && ".join(setup_commands).replace("'", "'\\''")
-
-    def start(self):
-        """Starts a new Docker container and sets up a persistent shell session."""
-        print("Starting secure sandbox...")
-        try:
-            # Start container with bash as the main process
-            self.container = self.client.containers.run(
-                self.image,
-                command="/bin/bash",
-                tty=True,
-                stdin_open=True,
-                detach=True
-            )
-            # Install tools using exec_run
-            print("Installing tools in sandbox...")
-            exit_code, (stdout, stderr) = self.container.exec_run(
-                f"/bin/bash -c '{self.setup_commands}'", demux=True
-            )
-            if exit_code != 0:
-                raise Exception(f"Sandbox setup failed: {stderr.decode() if stderr else 'Unknown error'}")
-            print("Sandbox ready.")
-            # Attach to the bash process
-            self.socket = self.container.attach_socket(
-                params={'stdin': 1, 'stdout': 1, 'stderr': 1, 'stream': 1}
-            )
-            self.socket._sock.settimeout(1)  # Set timeout for socket reads
-            self.socket._sock.send(b'stty -echo\n')
-            time.sleep(0.1)
-
-        except Exception as e:
-            print(f"Error starting sandbox: {e}")
-            self.stop()
-            raise
-
-    def execute_command(self, command: str):
-        """Executes a command in the persistent shell session."""
-        if not self.container or not self.socket:
-            raise Exception("Sandbox is not running or session is not started.")
-
-        self.command_id += 1
-        id = self.command_id
-        stdout_file = f"/tmp/stdout_{id}.txt"
-        stderr_file = f"/tmp/stderr_{id}.txt"
-        exitcode_file = f"/tmp/exitcode_{id}.txt"
-        marker = f"COMMAND_DONE_{id}"
-
-        # By wrapping the command in `{ ...; }`, we create a command group.
-        # This allows shell redirections inside the `command` (e.g., `> file.txt`)
-        # to function correctly, while we capture the output of the group itself.
-        # Unlike a subshell `(...)`, this executes in the current shell context,
-        # so commands like `cd` work as expected.
-        # The spaces and trailing semicolon are required syntax for the shell group.
-        grouped_command = f"{{ {command}; }}"
-
-        # Send command with output redirection and marker
-        cmd_to_send = (
-            f"{grouped_command} > {stdout_file} 2> {stderr_file}; "
-            f"echo $? > {exitcode_file}; echo '{marker}'\n"
-        )
-        self.socket._sock.send(cmd_to_send.encode('utf-8'))
-
-        # Wait for command completion
-        self.read_until_marker(marker)
-
-        # Read output files
-        stdout_exit, (stdout_data, stdout_errdata) = self.container.exec_run(f"cat {stdout_file}", demux=True)
-        stderr_exit, (stderr_data, stderr_errdata) = self.container.exec_run(f"cat {stderr_file}", demux=True)
-        exitcode_exit, (exitcode_data, exitcode_errdata) = self.container.exec_run(f"cat {exitcode_file}", demux=True)
-        
-        if stdout_exit != 0:
-            raise Exception(f"Command failed: {stdout_errdata.decode('utf-8')}")
-        if stderr_exit != 0:
-            raise Exception(f"Command failed: {stderr_errdata.decode('utf-8')}")
-        if exitcode_exit != 0:
-            raise Exception(f"Command failed: {exitcode_errdata.decode('utf-8')}")
-
-        # Decode outputs
-        stdout = stdout_data.decode('utf-8') if stdout_data else ""
-        stderr = stderr_data.decode('utf-8') if stderr_data else ""
-        exit_code_str = exitcode_data.decode('utf-8').strip() if exitcode_data else "0"
-
-        # Parse exit code
-        try:
-            exit_code = int(exit_code_str)
-        except ValueError:
-            exit_code = -1  # Indicate parsing error
-
-        # Clean up temporary files
-        self.container.exec_run(f"rm {stdout_file} {stderr_file} {exitcode_file}")
-
-        return stdout, stderr, exit_code
-
-    def read_until_marker(self, marker, timeout=10):
-        """Reads from the socket until the specified marker is found."""
-        if self.socket is None:
-            raise Exception("Socket not initialized")
-        accumulated = ""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            try:
-                data = self.socket._sock.recv(1024).decode('utf-8')
-                accumulated += data
-                if marker in accumulated:
-                    return accumulated
-            except socket.timeout:
-                continue
-        raise TimeoutError(f"Timeout waiting for marker: {marker}")
-
-    def stop(self):
-        """Stops the shell session and removes the container."""
-        if self.socket:
-            try:
-                self.socket._sock.send(b"exit\n")
-                time.sleep(1)  # Allow bash to exit
-            except Exception as e:
-                print(f"Error sending exit command: {e}")
-            self.socket.close()
-            self.socket = None
-        if self.container:
-            try:
-                self.container.remove(force=True)
-            except docker.errors.APIError as e: # type: ignore
-                print(f"Warning: Could not stop container properly: {e}")
-            self.container = None
-
+    The script is usually copied into verifiers/examples/, so SHELLM_REPO can point
+    at the repo checkout; otherwise it is looked up next to the script's own location.
+    """
+    candidates = []
+    if os.getenv("SHELLM_REPO"):
+        candidates.append(Path(os.environ["SHELLM_REPO"]).expanduser().resolve() / "shellm")
+    candidates.append(Path(__file__).resolve().parent.parent / "shellm")
+    for candidate in candidates:
+        if (candidate / "metrics.py").is_file():
+            return candidate
+    raise Exception(f"shellm modules not found in {', '.join(map(str, candidates))}, set SHELLM_REPO to the repo checkout.")
+
+# Sandboxes, latency histograms, teardown and caching shared with the data generation pipeline.
+# First on the path, so `sandbox` is shellm's and not rl/sandbox.py next to this script.
+SHELLM_DIR = str(find_shellm_dir())
+if SHELLM_DIR not in sys.path:
+    sys.path.insert(0, SHELLM_DIR)
+import metrics
+from reactor import Reactor
+from sandbox import Sandbox
+from teardown import OrphanReaper, TeardownQueue
+from history import History
+from clients import REGISTRY
+from completion_cache import CompletionCache, complete
+
+# Containers are removed in the background once main() starts the queue, so a finished rollout doesn't wait on Docker
+TEARDOWN = TeardownQueue()
+# Reads every sandbox shell from one thread once main() starts it; rollouts await their
+# command output on the event loop (Sandbox.aexecute_command) instead of holding a thread
+REACTOR = Reactor()
+# Starting a sandbox is a handful of blocking Docker API calls (create, setup, attach).
+# They run on this executor, sized explicitly instead of sharing the loop's default one;
+# an aiodocker start would still have to hand a docker-py socket to the reactor.
+SANDBOX_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("SANDBOX_START_THREADS", "32")), thread_name_prefix="sandbox-start")
+
+# verifiers scores the whole generation batch at once, every reward function on its own
+# worker thread; these cap how many judge calls and success checks are in flight
+JUDGE_SLOTS = threading.BoundedSemaphore(int(os.getenv("JUDGE_CONCURRENCY", "16")))
+SUCCESS_CHECK_SLOTS = threading.BoundedSemaphore(int(os.getenv("SUCCESS_CHECK_CONCURRENCY", "16")))
 
 
 class ShellEnv(MultiTurnEnv):
@@ -171,7 +79,9 @@ class ShellEnv(MultiTurnEnv):
         parser = Parser()
         base_url = "https://api.deepseek.com"
         api_key = os.environ.get("DEEPSEEK_API_KEY")
-        rubric = ShellJudgeRubric(parser=parser, judge_model="deepseek-chat", judge_client=OpenAI(base_url=base_url, api_key=api_key))
+        # COMPLETION_CACHE names an SQLite file that keeps judge verdicts across runs
+        cache = CompletionCache(os.environ["COMPLETION_CACHE"]) if os.getenv("COMPLETION_CACHE") else None
+        rubric = ShellJudgeRubric(parser=parser, judge_model="deepseek-chat", judge_client=REGISTRY.openai(base_url, api_key), cache=cache)
 
         def check_exit_codes(completion, answer, state, info, **kwargs) -> float:
             exit_codes = state['exit_codes']
@@ -181,8 +91,12 @@ class ShellEnv(MultiTurnEnv):
         def check_success_command(completion, answer, state, info, **kwargs) -> float:
             success_command = info['success_condition']
             sandbox = state['sandbox']
-            _, _, exit_code = sandbox.execute_command(success_command)
-            sandbox.stop()
+            # Runs on a verifiers worker thread, alongside the judge call of the same rollout
+            with SUCCESS_CHECK_SLOTS:
+                try:
+                    _, _, exit_code = sandbox.execute_command(success_command)
+                finally:
+                    sandbox.stop()
             # Success command has low reward as it's LLM generated and could be wrong,
             # so I reward it a bit for being correct but let the Judge LLM provide
             # stronger rewards.
@@ -212,17 +126,17 @@ class ShellEnv(MultiTurnEnv):
             return True
         return False
 
-    def env_response(self,
-                     messages: Messages,
-                     state: Dict[str, Any],
-                     **kwargs: Any) -> Tuple[ChatMessage, Dict[str, Any]]:
+    async def env_response(self,
+                           messages: Messages,
+                           state: Dict[str, Any],
+                           **kwargs: Any) -> Tuple[ChatMessage, Dict[str, Any]]:
         if isinstance(messages, str):
             raise ValueError("Messages must be a list of ChatMessages")
         # load active sandbox container
         sandbox: Sandbox = state['sandbox']
         # read command
         command = messages[-1]["content"]
-        stdout, stderr, exit_code = sandbox.execute_command(command)
+        stdout, stderr, exit_code = await sandbox.aexecute_command(command)
         state['exit_codes'].append(exit_code)
         feedback = ""
         if stdout:
@@ -277,8 +191,8 @@ class ShellEnv(MultiTurnEnv):
         messages = deepcopy(prompt) 
         is_completed = False
         setup_commands = info.get('setup_commands', [])
-        sandbox = Sandbox(setup_commands=setup_commands)
-        sandbox.start()
+        sandbox = Sandbox(setup_commands=setup_commands, client=REGISTRY.docker(), reactor=REACTOR, teardown_queue=TEARDOWN, resource_accounting=False)
+        await asyncio.get_running_loop().run_in_executor(SANDBOX_EXECUTOR, sandbox.start)
         state = {'answer': answer, 'responses': [], 'sandbox': sandbox, 'exit_codes': []}
         completion = []
         turn = 0
@@ -303,7 +217,7 @@ class ShellEnv(MultiTurnEnv):
             if self.is_completed(messages, state, **kwargs) or turn >= self.max_turns:
                 is_completed = True
             else:
-                env_msg, state = self.env_response(messages, state, **kwargs)
+                env_msg, state = await self.env_response(messages, state, **kwargs)
                 messages.append(env_msg)
                 completion.append(env_msg)
         return completion, state
@@ -327,56 +241,43 @@ Respond with a single JSON object containing 'reasoning' and 'rating'  keys.
 """
 
 class ShellJudgeRubric(Rubric):
+    """
+    Rewards a rollout with an LLM judge's rating. verifiers calls reward functions
+    synchronously on worker threads, so the judge uses a pooled sync client whose
+    connections every call reuses; at most JUDGE_CONCURRENCY calls are in flight.
+    """
     def __init__(self,
                  judge_client: OpenAI | None = None,
                  judge_model: str = "gpt-4.1-nano",
                  judge_prompt: str = DEFAULT_JUDGE_PROMPT,
                  parser: Parser = Parser(),
+                 cache: CompletionCache | None = None,
                  **kwargs):
         super().__init__(**kwargs)
-        self.judge_client = judge_client if judge_client is not None else OpenAI()
+        self.judge_client = judge_client if judge_client is not None else REGISTRY.openai()
         self.judge_model = judge_model
         self.judge_prompt = judge_prompt
         self.parser = parser
+        self.cache = cache
         self.add_reward_func(self.judge_reward_func)
 
 
-    def _format_history(self, completion: List[Dict[str, Any]], exit_codes: List[int]):
-        """Formats the trajectory into a string for the prompt."""
-        if not completion:
-            return "No actions were taken."
-
-        formatted = []
-        for (turn, msg) in enumerate(completion):
-            if msg['role'] == 'user':
-                continue
-            formatted.append(f"Turn {turn}:")
-            formatted.append(f"Action:`{msg['content']}`")
-            formatted.append(f"Exit Code: {exit_codes[turn]}")
-            if turn < len(exit_codes) - 1:
-                # assume next message is the observation
-                formatted.append(f"Shell Output:\n---\n{completion[turn + 1]['content'].strip()}\n---")
-        return "\n".join(formatted)
-
     def judge_reward_func(self, prompt, completion, answer, state, **kwargs) -> float:
         task = prompt[0]['content']
         setup_commands = state['setup_commands']
         exit_codes = state['exit_codes']
 
-        history = self._format_history(completion, exit_codes)
+        history = History.from_messages(completion, exit_codes).action_transcript()
         setup_str = "\n".join(f"$ {cmd}" for cmd in setup_commands) if setup_commands else "None"
 
         prompt = f"TASK: {task}\n\nSETUP COMMANDS:\n{setup_str}\n\nTRAJECTORY:\n{history}\n\nBased on the trajectory, was the task successfully completed? Provide your rating and reasoning."
         system_prompt = self.judge_prompt
-        judge_response = self.judge_client.chat.completions.create(
-            model=self.judge_model,
-            messages=[
+        with JUDGE_SLOTS:
+            judge_response = complete(self.judge_client, self.judge_model, [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
-            ],
-            max_tokens=1024,
-        )
-        judge_response = json.loads(str(judge_response.choices[0].message.content))
+            ], cache=self.cache, max_tokens=1024)
+        judge_response = json.loads(str(judge_response))
         reasoning = judge_response['reasoning']
         rating = judge_response['rating']
         reward = 0
@@ -401,34 +302,56 @@ class ShellJudgeRubric(Rubric):
 inference:
 CUDA_VISIBLE_DEVICES=0,1,2,3,4,5 vf-vllm --model deathbyknowledge/Qwen3-8B-Shell-SFT --tensor-parallel-size 2 --data-parallel-size 3
 
-training:
-CUDA_VISIBLE_DEVICES=6,7 accelerate launch --config-file configs/zero3.yaml --num-processes 2 verifiers/examples/shellm.py
+training (SHELLM_REPO is the checkout of this repo, for the shellm/ modules):
+SHELLM_REPO=/path/to/shellm CUDA_VISIBLE_DEVICES=6,7 accelerate launch --config-file configs/zero3.yaml --num-processes 2 verifiers/examples/shellm.py
 """
 
-model_name = f'deathbyknowledge/Qwen3-8B-Shell-SFT'
-model, tokenizer = vf.get_model_and_tokenizer(model_name, use_liger=False)
-
-vf_env = ShellEnv(
-    num_samples=2000, 
-    num_eval_samples=20
-)
-
-run_name = f"shell-grpo-8B"
-training_args=vf.grpo_defaults(run_name=run_name)
-training_args.num_iterations=1
-training_args.per_device_train_batch_size=2
-training_args.num_generations=8
-training_args.gradient_accumulation_steps=6
-training_args.max_prompt_length=1024
-training_args.max_completion_length=3072
-training_args.max_steps=100
-training_args.mask_env_responses=True
-
-trainer = vf.GRPOTrainer(
-    model=model,
-    processing_class=tokenizer,
-    env=vf_env,
-    args=training_args,
-)
-trainer.train()
+# Sandboxes of crashed runs are removed once older than ORPHAN_TTL_HOURS (0 disables it)
+ORPHAN_TTL_HOURS = float(os.getenv("ORPHAN_TTL_HOURS", "6"))
+
+
+def main():
+    # METRICS_PORT / METRICS_FILE expose the sandbox latency histograms during the run
+    metrics.export_from_env()
+    TEARDOWN.start()
+    REACTOR.start()
+    reaper = OrphanReaper(client=REGISTRY.docker(), ttl=ORPHAN_TTL_HOURS * 3600).start() if ORPHAN_TTL_HOURS > 0 else None
+
+    model_name = f'deathbyknowledge/Qwen3-8B-Shell-SFT'
+    model, tokenizer = vf.get_model_and_tokenizer(model_name, use_liger=False)
+
+    vf_env = ShellEnv(
+        num_samples=2000, 
+        num_eval_samples=20
+    )
+
+    run_name = f"shell-grpo-8B"
+    training_args=vf.grpo_defaults(run_name=run_name)
+    training_args.num_iterations=1
+    training_args.per_device_train_batch_size=2
+    training_args.num_generations=8
+    training_args.gradient_accumulation_steps=6
+    training_args.max_prompt_length=1024
+    training_args.max_completion_length=3072
+    training_args.max_steps=100
+    training_args.mask_env_responses=True
+
+    trainer = vf.GRPOTrainer(
+        model=model,
+        processing_class=tokenizer,
+        env=vf_env,
+        args=training_args,
+    )
+    try:
+        trainer.train()
+    finally:
+        if reaper is not None:
+            reaper.close()
+        REACTOR.close()
+        TEARDOWN.close()
+        SANDBOX_EXECUTOR.shutdown()
+
+
+if __name__ == "__main__":
+    main()
 
@@ -1,10 +1,11 @@
 import art
-from run_agent import ProjectTrajectory, run_agent_and_score
+from run_agent import ProjectTrajectory, run_agent_and_score, sos
 from load_scenarios import load_scenarios
 from art.local import LocalBackend
 from art.utils import iterate_dataset
 from project_types import RunConfig
 from benchmark import benchmark
+from admission import SANDBOXES, INFERENCE
 
 
 async def train(model: art.TrainableModel[RunConfig]):
@@ -40,6 +41,7 @@ async def train(model: art.TrainableModel[RunConfig]):
                     )
                 )
             finished_groups = await art.gather_trajectory_groups(groups)
+            print(f"Admission: {SANDBOXES.stats()} {INFERENCE.stats()}")
 
             # Filter out corrupted trajectories from groups
             filtered_groups = []
@@ -69,4 +71,11 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
     model = models[args.model]
-    asyncio.run(train(model))
\ No newline at end of file
+
+    async def main():
+        try:
+            await train(model)
+        finally:
+            await sos.aclose()
+
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,382 @@
+import asyncio
+import codecs
+import threading
+import time
+
+import metrics
+from protocol import (
+    FrameReader, StreamReader, frame_command, init_command, new_nonce, stream_end_command,
+    wrap_batch, wrap_command, wrap_stream_command,
+)
+
+# Same exit code `timeout(1)` uses for a command that ran out of time
+TIMEOUT_EXIT_CODE = 124
+# Appended to the output of a command that ran out of time, however it was stopped
+TIMEOUT_NOTICE = "[command timed out after {timeout}s, interrupted]\n"
+# How long an interrupted command gets to let go of the shell before escalating
+INTERRUPT_GRACE = 3
+# How often a streamed command yields, output or not, so its consumer can give up on it
+STREAM_POLL_INTERVAL = 1
+
+
+class ShellClosedError(Exception):
+    """The shell session ended while we were waiting for a frame."""
+
+
+class BaseSandbox:
+    """Runs framed commands in a persistent interactive shell.
+
+    Subclasses own the shell and its transport: they implement `_send`, `_recv`,
+    `_session_open`, `_kill_foreground_job` and `_respawn_shell`, and call
+    `_init_session` once a new shell is attached. With a shared `reactor`, they
+    hand it the connection through `_attach` and reads go through the reactor.
+    With `resource_accounting`, every command also reports the CPU time, disk IO
+    and peak memory of the shell's cgroup in `last_command["resources"]`.
+    """
+
+    # Label of this implementation's lifecycle metrics
+    METRICS_BACKEND = "base"
+
+    def __init__(self, max_output_bytes=32 * 1024, command_timeout=20, reactor=None, resource_accounting=False):
+        self.reactor = reactor
+        self.resource_accounting = resource_accounting
+        self.channel = None
+        self.command_timeout = command_timeout
+        # Per stream cap; larger outputs keep their first and last max_output_bytes / 2 bytes
+        self.max_output_bytes = max_output_bytes
+        self.nonce = None
+        self.shell_pid = None
+        self.command_id = 0
+        self.last_command = {}
+
+    def _attach(self, fileobj):
+        """Lets the reactor, if any, read the new shell connection."""
+        if self.reactor is not None:
+            self.channel = self.reactor.register(fileobj)
+
+    def _detach(self):
+        """Takes the connection away from its reactor; call before closing it."""
+        if self.channel is not None:
+            self.channel.reactor.unregister(self.channel)
+            self.channel = None
+
+    def _init_session(self):
+        """Silences echo and prompts, then waits for the shell to acknowledge with frame 0."""
+        self.nonce = new_nonce()
+        self._send(init_command(self.nonce).encode('utf-8'))
+        reader = FrameReader(self.nonce, 0)
+        self.read_frame(reader)
+        self.shell_pid = reader.exit_code
+
+    def execute_command(self, command: str, timeout=None):
+        """Executes a command in the persistent shell session.
+
+        A command still running after `timeout` seconds (default `command_timeout`)
+        is interrupted and returns exit code 124 with the output it produced so far.
+        """
+        if not self._session_open():
+            raise Exception("Sandbox is not running or session is not started.")
+
+        self.command_id += 1
+        reader = FrameReader(self.nonce, self.command_id, self.max_output_bytes)
+        # The shell runs the command and writes stdout, stderr and the exit code
+        # back as one length-prefixed frame, so a turn costs a single round trip.
+        request = wrap_command(command, self.nonce, self.command_id, self.max_output_bytes, accounting=self.resource_accounting)
+        return self._collect(reader, timeout, request)
+
+    def execute_batch(self, commands, stop_on_error=False, timeout=None):
+        """Executes several commands in the persistent session, sent to the shell in one write.
+
+        Meant for non-interactive sequences: commands get /dev/null as stdin and
+        `timeout` applies to each of them. Returns one dict per command that ran,
+        with its stdout, stderr, exit_code, duration in seconds and the
+        `last_command` fields. The batch ends early after a timeout or a lost
+        shell, and with stop_on_error after the first non-zero exit code.
+        """
+        if not self._session_open():
+            raise Exception("Sandbox is not running or session is not started.")
+
+        first_id = self.command_id + 1
+        self.command_id += len(commands)
+        request = wrap_batch(commands, self.nonce, first_id, self.max_output_bytes, stop_on_error, accounting=self.resource_accounting)
+        results = []
+        remainder = b""
+        start_time = time.time()
+        for i, command in enumerate(commands):
+            reader = FrameReader(self.nonce, first_id + i, self.max_output_bytes)
+            # Frames arrive back to back, so one read can hold the start of the next
+            reader.feed(remainder)
+            stdout, stderr, exit_code = self._collect(reader, timeout, request)
+            request = None
+            end_time = time.time()
+            results.append({
+                "command": command,
+                "stdout": stdout,
+                "stderr": stderr,
+                "exit_code": exit_code,
+                "duration": end_time - start_time,
+                **self.last_command,
+            })
+            start_time = end_time
+            if self.last_command["timed_out"] or self.last_command["shell_restarted"]:
+                break
+            if stop_on_error and exit_code != 0:
+                break
+            remainder = reader.remainder()
+        return results
+
+    def stream_command(self, command: str, timeout=None):
+        """Executes a command in the persistent session, yielding its output as it arrives.
+
+        Yields bytes chunks of the combined stdout and stderr (b"" about every
+        STREAM_POLL_INTERVAL seconds while the command is quiet), then one dict with
+        the exit_code and the `last_command` fields. Closing the generator early
+        interrupts the command, so the consumer can enforce its own limits.
+        """
+        if not self._session_open():
+            raise Exception("Sandbox is not running or session is not started.")
+
+        self.command_id += 1
+        reader = StreamReader(self.nonce, self.command_id)
+        # Output goes to the terminal as it is written instead of to files; only the
+        # exit code comes back framed, so there is no truncation and no accounting.
+        resend = stream_end_command(self.nonce, self.command_id, TIMEOUT_EXIT_CODE)
+        timeout = self.command_timeout if timeout is None else timeout
+        timed_out = False
+        shell_alive = True
+        finished = False
+        start_time = time.perf_counter()
+        try:
+            self._send(wrap_stream_command(command, self.nonce, self.command_id).encode('utf-8'))
+            while not reader.complete:
+                remaining = timeout - (time.perf_counter() - start_time)
+                if remaining <= 0:
+                    timed_out = True
+                    shell_alive = self._interrupt(reader, resend, reason=f"timed out after {timeout}s")
+                    break
+                try:
+                    self.read_frame(reader, timeout=min(STREAM_POLL_INTERVAL, remaining))
+                except TimeoutError:
+                    pass
+                yield reader.take_output()
+            finished = True
+        except (ShellClosedError, OSError) as e:
+            print(f"Shell session ended: {e}")
+            self._respawn_shell()
+            shell_alive = False
+            finished = True
+        finally:
+            if not finished:
+                # The consumer stopped listening, so the command must not keep the shell busy
+                self._interrupt(reader, resend, reason="abandoned by its consumer")
+
+        metrics.observe("sandbox_exec_seconds", time.perf_counter() - start_time, backend=self.METRICS_BACKEND)
+        if timed_out:
+            metrics.inc("sandbox_timeouts_total", backend=self.METRICS_BACKEND)
+        if not shell_alive:
+            metrics.inc("sandbox_failures_total", stage="exec", backend=self.METRICS_BACKEND)
+
+        tail = reader.take_output() if shell_alive else b"[shell session ended, continuing in a new one]\n"
+        if timed_out:
+            tail += TIMEOUT_NOTICE.format(timeout=timeout).encode('utf-8')
+        if tail:
+            yield tail
+        self.last_command = {
+            "stdout_bytes": None,
+            "stderr_bytes": None,
+            "truncated": reader.dropped > 0,
+            "timed_out": timed_out,
+            "shell_restarted": not shell_alive,
+            "resources": None,
+        }
+        if timed_out:
+            # The frame may be the one of a command killed after ignoring SIGINT (137)
+            exit_code = TIMEOUT_EXIT_CODE
+        elif shell_alive:
+            exit_code = reader.exit_code
+        else:
+            exit_code = -1
+        yield {"exit_code": exit_code, **self.last_command}
+
+    async def astream_command(self, command: str, timeout=None):
+        """Async version of `stream_command` that yields JSON-ready events.
+
+        Yields {"output": str} for each chunk, then {"exit_code": ...} with the
+        `last_command` fields. The blocking reads run in a worker thread.
+        """
+        stream = self.stream_command(command, timeout)
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # A generator can't be resumed while it runs, and a cancelled read keeps running in its thread
+        lock = threading.Lock()
+
+        def step():
+            with lock:
+                return next(stream, None)
+
+        def close():
+            with lock:
+                stream.close()
+
+        try:
+            while True:
+                item = await asyncio.to_thread(step)
+                if item is None:
+                    return
+                if isinstance(item, dict):
+                    text = decoder.decode(b"", final=True)
+                    if text:
+                        yield {"output": text}
+                    yield item
+                    return
+                text = decoder.decode(item)
+                if text:
+                    yield {"output": text}
+        finally:
+            await asyncio.to_thread(close)
+
+    def _collect(self, reader, timeout=None, request=None):
+        """Sends the request, if any, and waits for the reader's frame, recovering from timeouts.
+
+        Returns the decoded (stdout, stderr, exit_code) and records `last_command`.
+        """
+        timed_out = False
+        shell_alive = True
+        timeout = self.command_timeout if timeout is None else timeout
+        start_time = time.perf_counter()
+        try:
+            if request is not None:
+                self._send(request.encode('utf-8'))
+            if not reader.complete:
+                self.read_frame(reader, timeout=timeout)
+        except TimeoutError:
+            timed_out = True
+            shell_alive = self._interrupt(reader, reason=f"timed out after {timeout}s")
+        except (ShellClosedError, OSError) as e:
+            # e.g. the agent ran `exit` or `exec`
+            print(f"Shell session ended: {e}")
+            self._respawn_shell()
+            shell_alive = False
+        return self._finish(reader, timeout, start_time, timed_out, shell_alive)
+
+    async def aexecute_command(self, command: str, timeout=None):
+        """Async version of `execute_command`.
+
+        With a reactor, the event loop waits for the frame itself, so sessions
+        cost no thread while their commands run; only the rare recovery from a
+        timeout or a lost shell runs in a worker thread. Without one, the whole
+        command runs in a worker thread.
+        """
+        if self.channel is None:
+            return await asyncio.to_thread(self.execute_command, command, timeout)
+        if not self._session_open():
+            raise Exception("Sandbox is not running or session is not started.")
+
+        self.command_id += 1
+        reader = FrameReader(self.nonce, self.command_id, self.max_output_bytes)
+        request = wrap_command(command, self.nonce, self.command_id, self.max_output_bytes, accounting=self.resource_accounting)
+        timed_out = False
+        shell_alive = True
+        timeout = self.command_timeout if timeout is None else timeout
+        start_time = time.perf_counter()
+        try:
+            # A command line is far smaller than the socket buffer, so this doesn't block
+            self._send(request.encode('utf-8'))
+            await self.channel.reactor.await_frame(self.channel, reader, timeout)
+        except TimeoutError:
+            timed_out = True
+            shell_alive = await asyncio.to_thread(self._interrupt, reader, reason=f"timed out after {timeout}s")
+        except (ShellClosedError, OSError) as e:
+            print(f"Shell session ended: {e}")
+            await asyncio.to_thread(self._respawn_shell)
+            shell_alive = False
+        return self._finish(reader, timeout, start_time, timed_out, shell_alive)
+
+    def _finish(self, reader, timeout, start_time, timed_out, shell_alive):
+        """Records the metrics and `last_command` of a collected frame and returns its decoded result."""
+        metrics.observe("sandbox_exec_seconds", time.perf_counter() - start_time, backend=self.METRICS_BACKEND)
+        if timed_out:
+            metrics.inc("sandbox_timeouts_total", backend=self.METRICS_BACKEND)
+        if not shell_alive:
+            metrics.inc("sandbox_failures_total", stage="exec", backend=self.METRICS_BACKEND)
+
+        if shell_alive:
+            stdout_data, stderr_data, exit_code = reader.result()
+        else:
+            stdout_data = b""
+            stderr_data = b"[shell session ended, continuing in a new one]\n"
+            exit_code = -1
+        if timed_out:
+            # Whichever frame ended the wait, e.g. 137 of a command killed after ignoring SIGINT
+            exit_code = TIMEOUT_EXIT_CODE
+            stderr_data += TIMEOUT_NOTICE.format(timeout=timeout).encode('utf-8')
+        self.last_command = {
+            "stdout_bytes": reader.stdout_total,
+            "stderr_bytes": reader.stderr_total,
+            "truncated": reader.stdout_truncated or reader.stderr_truncated,
+            "timed_out": timed_out,
+            "shell_restarted": not shell_alive,
+            "resources": reader.resources if shell_alive else None,
+        }
+
+        # Decode outputs, binary output must not fail the turn
+        stdout = stdout_data.decode('utf-8', errors='replace')
+        stderr = stderr_data.decode('utf-8', errors='replace')
+
+        return stdout, stderr, exit_code
+
+    def read_frame(self, reader, timeout=20):
+        """Reads from the shell until the reader has received its whole frame."""
+        if not self._session_open():
+            raise Exception("Session not initialized")
+        if self.channel is not None:
+            return self.channel.reactor.wait_frame(self.channel, reader, timeout)
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            data = self._recv()
+            if data is None:
+                continue
+            if not data:
+                raise ShellClosedError("Shell session closed while waiting for command output.")
+            if reader.feed(data):
+                return
+        raise TimeoutError(f"Timeout waiting for frame: {reader.header!r}")
+
+    def _wait_complete(self, reader, timeout):
+        """Like `read_frame`, but also for readers that return early with partial output."""
+        deadline = time.perf_counter() + timeout
+        while not reader.complete:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f"Timeout waiting for frame: {reader.header!r}")
+            self.read_frame(reader, timeout=remaining)
+
+    def _interrupt(self, reader, resend=None, reason="timed out"):
+        """Stops a running command and collects its partial frame.
+
+        `resend` is the shell input that produces the frame of an interrupted
+        command, by default a `frame_command` with exit code 124. `reason` says
+        why in the logs, e.g. a timeout or a stream its consumer abandoned.
+        Returns False if the shell had to be replaced, in which case the output is lost.
+        """
+        print(f"Command {reader.command_id} {reason}, interrupting it...")
+        if resend is None:
+            resend = frame_command(reader.command_id, TIMEOUT_EXIT_CODE, self.max_output_bytes, self.resource_accounting)
+        try:
+            # Ctrl-C reaches the foreground process group through the terminal
+            self._send(b"\x03")
+            time.sleep(0.2)
+            # An interrupted command line never gets to its own frame, so ask for it
+            self._send(resend.encode('utf-8'))
+            try:
+                self._wait_complete(reader, INTERRUPT_GRACE)
+                return True
+            except TimeoutError:
+                pass
+            print(f"Command {reader.command_id} ignored SIGINT, killing it...")
+            self._kill_foreground_job()
+            self._wait_complete(reader, INTERRUPT_GRACE)
+            return True
+        except (TimeoutError, ShellClosedError, OSError) as e:
+            print(f"Shell did not recover from the interrupt: {e}")
+            self._respawn_shell()
+            return False
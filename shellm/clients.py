@@ -0,0 +1,80 @@
+import threading
+
+
+class ClientRegistry:
+    """Process-wide LLM and Docker clients, one per endpoint, with connection pools sized for the run.
+
+    Every task of a run asks the registry instead of constructing its own clients,
+    so HTTP keep-alive connections are reused across tasks.
+    """
+
+    def __init__(self, max_connections=16, keepalive_expiry=60, timeout=600):
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        # Reentrant: the instructor client is created around the OpenAI one
+        self._lock = threading.RLock()
+        self._clients = {}
+        # Optional CompletionCache the teacher and judge calls go through
+        self.completion_cache = None
+
+    def configure(self, max_connections, completion_cache=None):
+        """Sizes the pools of clients created from now on, e.g. to the number of workers."""
+        self.max_connections = max_connections
+        self.completion_cache = completion_cache
+
+    def _get(self, key, create):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = create()
+            return client
+
+    def openai(self, base_url=None, api_key=None):
+        """Returns the OpenAI client of an endpoint."""
+        def create():
+            import httpx
+            from openai import DefaultHttpxClient, OpenAI
+
+            http_client = DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=self.timeout,
+            )
+            return OpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+
+        return self._get(("openai", base_url, api_key), create)
+
+    def instructor(self, base_url=None, api_key=None):
+        """Returns the instructor-patched client of an endpoint, sharing the OpenAI client's pool."""
+        def create():
+            import instructor
+
+            return instructor.from_openai(self.openai(base_url, api_key))
+
+        return self._get(("instructor", base_url, api_key), create)
+
+    def docker(self):
+        """Returns the Docker client."""
+        def create():
+            import docker
+
+            # Each busy sandbox can hold an API connection on top of its attached shell socket
+            return docker.from_env(max_pool_size=max(10, 2 * self.max_connections))
+
+        return self._get(("docker",), create)
+
+    def close(self):
+        """Closes every client and forgets them."""
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for (kind, *_), client in clients.items():
+            if kind != "instructor":
+                client.close()
+
+
+# Shared by everything in the process that doesn't get a registry of its own
+REGISTRY = ClientRegistry()
@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_FILE = os.path.expanduser("~/.cache/shellm/completions.sqlite")
+
+
+class CompletionCache:
+    """Caches chat completions in SQLite, keyed by a hash of the model, messages and sampling params.
+
+    Re-running a crashed generation or re-judging a dataset then only pays for
+    requests it has not made before. Least recently used entries are evicted
+    once the stored responses exceed max_bytes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_bytes=1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # One connection shared by the worker threads, serialized by the lock
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def key(self, model, messages, **params):
+        """Returns the cache key of a request."""
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached response for key, or None on a miss."""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, value):
+        """Stores a response and evicts old ones if the cache is over its budget."""
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM completions ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+
+    def complete(self, client, model, messages, **params):
+        """Returns the content of a chat completion, reusing the cached one for an identical request."""
+        key = self.key(model, messages, **params)
+        content = self.get(key)
+        if content is None:
+            res = client.chat.completions.create(model=model, messages=messages, **params)
+            content = res.choices[0].message.content
+            if content:
+                self.put(key, content)
+        return content
+
+    async def acomplete(self, client, model, messages, **params):
+        """Like `complete`, for async clients. The cache lookups run in a thread, off the event loop."""
+        key = self.key(model, messages, **params)
+        content = await asyncio.to_thread(self.get, key)
+        if content is None:
+            res = await client.chat.completions.create(model=model, messages=messages, **params)
+            content = res.choices[0].message.content
+            if content:
+                await asyncio.to_thread(self.put, key, content)
+        return content
+
+    def complete_structured(self, client, response_model, model, messages, **params):
+        """Like `complete`, for instructor clients that return a response_model instance."""
+        key = self.key(model, messages, response_model=response_model.model_json_schema(), **params)
+        cached = self.get(key)
+        if cached is not None:
+            return response_model.model_validate_json(cached)
+        response = client.chat.completions.create(model=model, messages=messages, response_model=response_model, **params)
+        if response:
+            self.put(key, response.model_dump_json())
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM completions")
+            self._db.commit()
+            self._db.execute("VACUUM")
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+            return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def complete(client, model, messages, cache=None, **params):
+    """Returns the content of a chat completion, through the cache if there is one."""
+    if cache is not None:
+        return cache.complete(client, model, messages, **params)
+    res = client.chat.completions.create(model=model, messages=messages, **params)
+    return res.choices[0].message.content
+
+
+async def acomplete(client, model, messages, cache=None, **params):
+    """Like `complete`, for async clients."""
+    if cache is not None:
+        return await cache.acomplete(client, model, messages, **params)
+    res = await client.chat.completions.create(model=model, messages=messages, **params)
+    return res.choices[0].message.content
+
+
+def complete_structured(client, response_model, model, messages, cache=None, **params):
+    """Returns an instructor completion as a response_model instance, through the cache if there is one."""
+    if cache is not None:
+        return cache.complete_structured(client, response_model, model, messages, **params)
+    return client.chat.completions.create(model=model, messages=messages, response_model=response_model, **params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the teacher and judge completion cache")
+    parser.add_argument("action", choices=["stats", "clear"])
+    parser.add_argument("--path", type=str, default=DEFAULT_CACHE_FILE, help=f"Cache database (default: {DEFAULT_CACHE_FILE})")
+    args = parser.parse_args()
+
+    cache = CompletionCache(args.path)
+    if args.action == "clear":
+        cache.clear()
+    print(cache.stats())
+
+
+if __name__ == "__main__":
+    main()
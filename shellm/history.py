@@ -0,0 +1,119 @@
+class History:
+    """Append-only record of a trajectory's turns that renders each prompt format incrementally.
+
+    Every format renders a turn once, when it is first asked for, and keeps the
+    result, so prompting every turn costs time linear in the trajectory instead
+    of quadratic. A turn is a dict with `turn`, `thought`, `action`,
+    `observation` and `exit_code`, as main.py records them.
+    """
+
+    def __init__(self, turns=()):
+        self.turns = []
+        self._blocks = {}
+        self._messages = {}
+        for turn in turns:
+            self.append(turn)
+
+    @classmethod
+    def of(cls, trajectory):
+        """Returns the trajectory itself if it is a History, else a History of its turns."""
+        return trajectory if isinstance(trajectory, cls) else cls(trajectory or ())
+
+    @classmethod
+    def from_messages(cls, messages, exit_codes):
+        """Builds a History from chat messages alternating the agent's command and the shell's output."""
+        history = cls()
+        commands = [m['content'] for m in messages if m['role'] == 'assistant']
+        outputs = [m['content'] for m in messages if m['role'] == 'user']
+        for i, command in enumerate(commands):
+            history.append({
+                "turn": i + 1,
+                "thought": "",
+                "action": command,
+                "observation": outputs[i] if i < len(outputs) else None,
+                "exit_code": exit_codes[i] if i < len(exit_codes) else None,
+            })
+        return history
+
+    def append(self, turn):
+        self.turns.append(turn)
+
+    def __len__(self):
+        return len(self.turns)
+
+    def __iter__(self):
+        return iter(self.turns)
+
+    def _rendered(self, name, render):
+        """Returns the per-turn renderings of a format, rendering only the turns added since the last call."""
+        blocks = self._blocks.setdefault(name, [])
+        for turn in self.turns[len(blocks):]:
+            blocks.append(render(turn))
+        return blocks
+
+    def judge_transcript(self):
+        """The Thought / Action / Exit Code / Observation transcript the Teacher and Judge prompts use."""
+        blocks = self._rendered("judge", _judge_block)
+        return "\n".join(blocks) if blocks else "No actions were taken."
+
+    def action_transcript(self):
+        """Like `judge_transcript`, for agents whose reasoning is part of the command itself."""
+        blocks = self._rendered("action", _action_block)
+        return "\n".join(blocks) if blocks else "No actions were taken."
+
+    def shell_transcript(self, task=None):
+        """The `$ command` / output / `[EXIT_CODE = n]` transcript of a terminal session."""
+        blocks = self._rendered("shell", _shell_block)
+        if not blocks:
+            return "No actions were taken."
+        header = f"TASK: {task}\n\n" if task else ""
+        return header + "".join(blocks)
+
+    def chat_messages(self):
+        """The chat messages of ShellTeacher's prompt, without the system message.
+
+        Each turn is the thought, an empty user message, the action and the
+        observation, as the two-call teacher produced them. Turns marked
+        `single_call` came from one reply, and one assistant message holds their
+        thought, if any, and action.
+        """
+        rendered = self._messages.setdefault("chat", {"messages": [], "turns": 0})
+        messages = rendered["messages"]
+        for turn in self.turns[rendered["turns"]:]:
+            if turn.get('single_call'):
+                content = f"{turn['thought']}\n{turn['action']}" if turn['thought'] else turn['action']
+                messages.append({"role": "assistant", "content": content})
+            else:
+                messages.append({"role": "assistant", "content": turn['thought']})
+                messages.append({"role": "user", "content": ""})
+                messages.append({"role": "assistant", "content": turn['action']})
+            messages.append({"role": "user", "content": turn['observation']})
+        rendered["turns"] = len(self.turns)
+        # A copy, so callers can append the next step's messages to it
+        return list(messages)
+
+
+def _judge_block(turn):
+    return (
+        f"Turn {turn['turn']}:\n"
+        f"Thought:\n{turn['thought']}\n"
+        f"Action: `{turn['action']}`\n"
+        f"Exit Code: {turn['exit_code']}\n"
+        f"Observation:\n---\n{turn['observation'].strip()}\n---"
+    )
+
+
+def _action_block(turn):
+    lines = [f"Turn {turn['turn']}:", f"Action:`{turn['action']}`"]
+    if turn['exit_code'] is not None:
+        lines.append(f"Exit Code: {turn['exit_code']}")
+    if turn['observation'] is not None:
+        lines.append(f"Shell Output:\n---\n{turn['observation'].strip()}\n---")
+    return "\n".join(lines)
+
+
+def _shell_block(turn):
+    block = f"$ {turn['action']}\n"
+    if turn['observation'] is not None:
+        block += f"{turn['observation']}\n[EXIT_CODE = {turn['exit_code']}]\n"
+    return block
@@ -1,9 +1,10 @@
 import os
-from openai import OpenAI
 from pydantic import BaseModel, Field
-import instructor
 from dotenv import load_dotenv
 from typing import List, Dict, Any
+from clients import REGISTRY
+from completion_cache import complete_structured
+from history import History
 
 load_dotenv()
 
@@ -14,27 +15,14 @@ class JudgeResponse(BaseModel):
 class Judge:
     """Handles the evaluation of a completed trajectory by an LLM."""
 
-    def __init__(self, base_url: str | None = "https://api.deepseek.com", api_key: str | None = os.environ.get("DEEPSEEK_API_KEY"), model: str = "deepseek-chat"):
-        oai = OpenAI(base_url=base_url, api_key=api_key)
-        self.client = instructor.from_openai(oai)
+    def __init__(self, base_url: str | None = "https://api.deepseek.com", api_key: str | None = os.environ.get("DEEPSEEK_API_KEY"), model: str = "deepseek-chat", clients=None):
+        clients = clients or REGISTRY
+        self.client = clients.instructor(base_url, api_key)
+        # Judging runs at a low temperature, so cached verdicts are as good as new ones
+        self.cache = clients.completion_cache
         self.model = model
 
-    def _format_history(self, trajectory: List[Dict[str, Any]]):
-        """Formats the trajectory into a string for the prompt."""
-        if not trajectory:
-            return "No actions were taken."
-
-        formatted = []
-        for turn in trajectory:
-            formatted.append(f"Turn {turn['turn']}:")
-            formatted.append(f"Thought:\n{turn['thought']}")
-            formatted.append(f"Action: `{turn['action']}`")
-            formatted.append(f"Exit Code: {turn['exit_code']}")
-            formatted.append(f"Observation:\n---\n{turn['observation'].strip()}\n---")
-
-        return "\n".join(formatted)
-
-    def evaluate_trajectory(self, task: str, setup_commands: List[str], trajectory: List[Dict[str, Any]]):
+    def evaluate_trajectory(self, task: str, setup_commands: List[str], trajectory: History | List[Dict[str, Any]]):
         """Evaluates a trajectory to determine if the task was successfully completed."""
 
         system_prompt = """
@@ -52,19 +40,21 @@ class Judge:
         Respond with a single JSON object containing 'reasoning' and 'rating'  keys.
         """
 
-        history = self._format_history(trajectory)
+        history = History.of(trajectory).judge_transcript()
         setup_str = "\n".join(f"$ {cmd}" for cmd in setup_commands) if setup_commands else "None"
 
         prompt_content = f"TASK: {task}\n\nSETUP COMMANDS:\n{setup_str}\n\nTRAJECTORY:\n{history}\n\nBased on the trajectory, was the task successfully completed? Provide your rating and reasoning."
 
         try:
-            judge_response = self.client.chat.completions.create(
+            judge_response = complete_structured(
+                self.client,
+                JudgeResponse,
                 model=self.model,
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt_content}
                 ],
-                response_model=JudgeResponse,
+                cache=self.cache,
                 temperature=0.1
             )
             return judge_response
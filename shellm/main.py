@@ -3,7 +3,16 @@ from tqdm import tqdm
 from task_curator import TaskCurator
 from teacher import Teacher, ShellTeacher
 from sandbox import Sandbox
+from sandbox_pool import SandboxPool
+from ns_sandbox import NamespaceSandbox
+from reactor import Reactor
+from teardown import TeardownQueue, OrphanReaper
+import metrics
+from setup_cache import SetupCache
 from judge import Judge
+from history import History
+from clients import REGISTRY
+from completion_cache import CompletionCache
 
 import aiofiles
 from dotenv import load_dotenv
@@ -19,8 +28,11 @@ import argparse
 
 load_dotenv()
 
-def generate_trajectory(task_id, task_description, setup_commands, how_realistic, difficulty_level, required_tools, success_condition, run_evaluation=True, manual=False, teacher_base_url=None, teacher_api_key=None, teacher_model=None):
-    """Generates a single trajectory for a given task."""
+def generate_trajectory(task_id, task_description, setup_commands, how_realistic, difficulty_level, required_tools, success_condition, run_evaluation=True, manual=False, teacher_base_url=None, teacher_api_key=None, teacher_model=None, pool=None, setup_cache=None, backend="docker", reactor=None, cpu_limit=None, memory_limit=None, teardown_queue=None, teacher_single_call=False, clients=None):
+    """Generates a single trajectory for a given task.
+
+    With run_evaluation, the judge rates it once the sandbox has been released.
+    """
     print(f"--- Starting generation for Task ID: {task_id} ---")
     print(f"Task: {task_description}")
     print(f"Setup commands: {setup_commands}")
@@ -36,13 +48,17 @@ def generate_trajectory(task_id, task_description, setup_commands, how_realistic
     if teacher_model is None:
         teacher_model = "deepseek-chat"
 
-    teacher = ShellTeacher(base_url=teacher_base_url, api_key=teacher_api_key, model=teacher_model)
-    sandbox = Sandbox(setup_commands=setup_commands)
-    judge = Judge()
+    # Clients come from the run's registry, so their connections are reused across tasks
+    clients = clients or REGISTRY
+    teacher = ShellTeacher(base_url=teacher_base_url, api_key=teacher_api_key, model=teacher_model, single_call=teacher_single_call, clients=clients)
+    if backend == "namespace":
+        sandbox = NamespaceSandbox(setup_commands=setup_commands, reactor=reactor)
+    else:
+        sandbox = Sandbox(setup_commands=setup_commands, pool=pool, setup_cache=setup_cache, reactor=reactor, cpu_limit=cpu_limit, memory_limit=memory_limit, teardown_queue=teardown_queue, client=clients.docker())
     
-    trajectory = []
+    # Keeps each prompt format rendered as turns are added
+    trajectory = History()
     current_turn = 1
-    evaluation = None
     
     # Start the secure sandbox environment
     sandbox.start()
@@ -52,9 +68,11 @@ def generate_trajectory(task_id, task_description, setup_commands, how_realistic
             if manual:
                 action = input(f"Turn {current_turn}: Enter command (or 'exit 0' to finish): ")
                 thought = "Manual user input."
+                single_call = False
             else:
                 # Get the next thought and action from the teacher model
                 thought, action = teacher.get_next_step(task_description, trajectory)
+                single_call = teacher.last_single_call
 
             if "exit 0" in action.strip():
                 print("User or model indicated task is complete.")
@@ -63,6 +81,7 @@ def generate_trajectory(task_id, task_description, setup_commands, how_realistic
             # Execute the action in the sandbox
             stdout, stderr, exit_code = sandbox.execute_command(action)
             observation = stdout + stderr
+            output_info = sandbox.last_command
 
             if manual:
                 print(observation)
@@ -73,7 +92,14 @@ def generate_trajectory(task_id, task_description, setup_commands, how_realistic
                 "thought": thought,
                 "action": action,
                 "observation": observation,
-                "exit_code": exit_code
+                "exit_code": exit_code,
+                # Whether thought and action came from one teacher reply, which changes how the turn is replayed
+                "single_call": single_call,
+                "output_bytes": output_info["stdout_bytes"] + output_info["stderr_bytes"],
+                "output_truncated": output_info["truncated"],
+                "timed_out": output_info["timed_out"],
+                # CPU time, disk IO and peak memory of the container while the command ran
+                "resources": output_info["resources"]
             }
             trajectory.append(turn_data)
             
@@ -99,19 +125,12 @@ def generate_trajectory(task_id, task_description, setup_commands, how_realistic
                 success_condition_passed = False
                 print(f"Error running success condition: {e}")
 
-        if run_evaluation:
-            print(f"--- Evaluating trajectory for Task ID: {task_id} ---")
-            evaluation = judge.evaluate_trajectory(task_description, setup_commands, trajectory)
-            print(f"Evaluation complete. Rating: {evaluation.rating}/5")
-        else:
-            print(f"--- Skipping evaluation for Task ID: {task_id} ---")
-
     finally:
         # Always ensure the sandbox is stopped and cleaned up
         sandbox.stop()
         print("--- Sandbox stopped. ---")
 
-    return {
+    trajectory_data = {
         "dataset_id": f"she_syn_{task_id}",
         "source": "manual" if manual else "synthetic_teacher_model_v1",
         "setup_commands": setup_commands,
@@ -120,14 +139,28 @@ def generate_trajectory(task_id, task_description, setup_commands, how_realistic
         "difficulty_level": difficulty_level,
         "required_tools": required_tools,
         "success_condition": success_condition,
-        "trajectory": trajectory,
+        "trajectory": trajectory.turns,
         "evaluation": {
-          "rating": evaluation.rating if evaluation else None,
-          "reasoning": evaluation.reasoning if evaluation else "Evaluation did not run.",
+          "rating": None,
+          "reasoning": "Evaluation did not run.",
           "success_condition_passed": success_condition_passed,
           "success_condition_output": success_condition_output
         }
     }
+    if run_evaluation:
+        # The judge never touches the sandbox, so it runs after the container is released
+        judge_trajectory(trajectory_data, clients, trajectory)
+    return trajectory_data
+
+def judge_trajectory(trajectory_data, clients=None, history=None):
+    """Rates a generated trajectory with the LLM judge and merges the result into its record."""
+    print(f"--- Evaluating trajectory for Task ID: {trajectory_data['dataset_id']} ---")
+    judge = Judge(clients=clients or REGISTRY)
+    evaluation = judge.evaluate_trajectory(trajectory_data['task'], trajectory_data['setup_commands'], history or trajectory_data['trajectory'])
+    trajectory_data['evaluation']['rating'] = evaluation.rating
+    trajectory_data['evaluation']['reasoning'] = evaluation.reasoning
+    print(f"Evaluation complete. Rating: {evaluation.rating}/5")
+    return trajectory_data
 
 # Thread-safe file writing
 write_lock = threading.Lock()
@@ -140,8 +173,20 @@ def write_trajectory_safely(trajectory_data, filename="dataset.jsonl"):
             f.flush()  # Ensure immediate write
     print(f"--- Saved trajectory for Task ID: {trajectory_data['dataset_id']} ---\n")
 
-def generate_and_save_trajectory(task_item, output_file, run_evaluation, manual, teacher_base_url=None, teacher_api_key=None, teacher_model=None):
-    """Wrapper function that generates and saves a trajectory."""
+def judge_and_save_trajectory(trajectory_data, output_file, clients=None):
+    """Judge stage: rates a generated trajectory, then saves it."""
+    try:
+        judge_trajectory(trajectory_data, clients)
+    except Exception as e:
+        # Keep the trajectory, it can be judged again later
+        print(f"Error judging {trajectory_data['dataset_id']}: {e}")
+    write_trajectory_safely(trajectory_data, output_file)
+
+def generate_and_save_trajectory(task_item, output_file, run_evaluation, manual, teacher_base_url=None, teacher_api_key=None, teacher_model=None, pool=None, setup_cache=None, backend="docker", reactor=None, cpu_limit=None, memory_limit=None, teardown_queue=None, teacher_single_call=False, clients=None, judge_executor=None):
+    """Wrapper function that generates and saves a trajectory.
+
+    With a judge_executor, judging and saving are handed to that stage instead.
+    """
     task_id = task_item['id']
     task_description = task_item['task']
     setup_commands = task_item['setup_commands']
@@ -150,15 +195,25 @@ def generate_and_save_trajectory(task_item, output_file, run_evaluation, manual,
     required_tools = task_item['required_tools']
     success_condition = task_item['success_condition']
     try:
-        trajectory_data = generate_trajectory(task_id, task_description, setup_commands, how_realistic, difficulty_level, required_tools, success_condition, run_evaluation, manual, teacher_base_url, teacher_api_key, teacher_model)
+        judge_later = run_evaluation and judge_executor is not None
+        trajectory_data = generate_trajectory(task_id, task_description, setup_commands, how_realistic, difficulty_level, required_tools, success_condition, run_evaluation and not judge_later, manual, teacher_base_url, teacher_api_key, teacher_model, pool, setup_cache, backend, reactor, cpu_limit, memory_limit, teardown_queue, teacher_single_call, clients)
+        if judge_later:
+            judge_executor.submit(judge_and_save_trajectory, trajectory_data, output_file, clients)
+            return f"Completed {task_id}, queued for judging"
+        if not run_evaluation:
+            print(f"--- Skipping evaluation for Task ID: {task_id} ---")
         write_trajectory_safely(trajectory_data, output_file)
         return f"Completed {task_id}"
     except Exception as e:
         print(f"Error processing {task_id}: {e}")
         return f"Failed {task_id}: {e}"
 
-def run_concurrent_generation(task_file="tasks.jsonl", max_workers=3, output_file="dataset.jsonl", limit=20, run_evaluation=True, manual=False, teacher_base_url=None, teacher_api_key=None, teacher_model=None):
-    """Run trajectory generation with controlled concurrency."""
+def run_concurrent_generation(task_file="tasks.jsonl", max_workers=3, output_file="dataset.jsonl", limit=20, run_evaluation=True, manual=False, teacher_base_url=None, teacher_api_key=None, teacher_model=None, pool_size=0, setup_cache_gb=0, backend="docker", cpu_limit=None, memory_limit=None, orphan_ttl_hours=6, teacher_single_call=False, completion_cache_file=None, completion_cache_gb=1, judge_workers=None):
+    """Run trajectory generation with controlled concurrency.
+
+    Judging is its own stage with judge_workers threads (default: max_workers),
+    fed with trajectories whose sandboxes have already been released.
+    """
     curator = TaskCurator(task_file=task_file)
     tasks = curator.get_tasks(limit=limit)
     
@@ -170,26 +225,82 @@ def run_concurrent_generation(task_file="tasks.jsonl", max_workers=3, output_fil
     if manual:
         print("Manual mode is enabled. You will be prompted for commands.")
 
+    # One client per endpoint for the whole run, with a connection for every worker
+    clients = REGISTRY
+    completion_cache = None
+    if completion_cache_file:
+        # Identical teacher and judge requests, e.g. after a crash, are answered from disk
+        completion_cache = CompletionCache(completion_cache_file, max_bytes=int(completion_cache_gb * 1024**3))
+        print(f"Completion cache enabled at {completion_cache_file}.")
+    clients.configure(max_connections=max_workers, completion_cache=completion_cache)
+
+    # One thread reads every sandbox shell instead of each worker polling its own
+    reactor = Reactor().start()
+
+    teardown_queue = None
+    reaper = None
+    if backend == "docker":
+        # Containers are removed in the background instead of on each worker's critical path
+        teardown_queue = TeardownQueue().start()
+        if orphan_ttl_hours > 0:
+            reaper = OrphanReaper(client=clients.docker(), ttl=orphan_ttl_hours * 3600).start()
+
+    pool = None
+    if pool_size > 0 and backend == "docker":
+        # Never keep more warm containers around than workers that could use them
+        pool = SandboxPool(min_size=pool_size, max_size=max(pool_size, max_workers), reactor=reactor, cpu_limit=cpu_limit, memory_limit=memory_limit, teardown_queue=teardown_queue, client=clients.docker())
+        pool.start()
+        print(f"Warm sandbox pool enabled with {pool_size} containers.")
+
+    setup_cache = None
+    if setup_cache_gb > 0 and backend == "docker":
+        setup_cache = SetupCache(client=clients.docker(), max_bytes=int(setup_cache_gb * 1024**3))
+        print(f"Setup cache enabled with a {setup_cache_gb}GB budget.")
+
+    judge_executor = None
+    if run_evaluation:
+        judge_executor = ThreadPoolExecutor(max_workers=judge_workers or max_workers, thread_name_prefix="judge")
+
     start_time = time.time()
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_task = {
-            executor.submit(generate_and_save_trajectory, task_item, output_file, run_evaluation, manual, teacher_base_url, teacher_api_key, teacher_model): task_item['id'] 
-            for task_item in tasks
-        }
-        
-        # Process completed tasks as they finish with progress bar
-        from concurrent.futures import as_completed
-        with tqdm(total=len(tasks), desc="Processing tasks", unit="task") as pbar:
-            for future in as_completed(future_to_task):
-                task_id = future_to_task[future]
-                try:
-                    result = future.result()
-                    print(f"✅ {result}")
-                except Exception as e:
-                    print(f"❌ Task {task_id} failed: {e}")
-                pbar.update(1)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Submit all tasks
+            future_to_task = {
+                executor.submit(generate_and_save_trajectory, task_item, output_file, run_evaluation, manual, teacher_base_url, teacher_api_key, teacher_model, pool, setup_cache, backend, reactor, cpu_limit, memory_limit, teardown_queue, teacher_single_call, clients, judge_executor): task_item['id'] 
+                for task_item in tasks
+            }
+            
+            # Process completed tasks as they finish with progress bar
+            from concurrent.futures import as_completed
+            with tqdm(total=len(tasks), desc="Processing tasks", unit="task") as pbar:
+                for future in as_completed(future_to_task):
+                    task_id = future_to_task[future]
+                    try:
+                        result = future.result()
+                        print(f"✅ {result}")
+                    except Exception as e:
+                        print(f"❌ Task {task_id} failed: {e}")
+                    pbar.update(1)
+        if judge_executor is not None:
+            print("Waiting for the judge to finish...")
+    finally:
+        if judge_executor is not None:
+            # Sandboxes are all released by now; only the remaining judge calls are left
+            judge_executor.shutdown(wait=True)
+        if pool is not None:
+            pool.close()
+        reactor.close()
+        if reaper is not None:
+            reaper.close()
+        if teardown_queue is not None:
+            teardown_queue.close()
+        clients.close()
+        if completion_cache is not None:
+            print(f"Completion cache: {completion_cache.stats()}")
+            completion_cache.close()
+        if setup_cache is not None:
+            print(f"Setup cache: {setup_cache.stats()}")
     
     end_time = time.time()
     print(f"\n🎉 All tasks completed in {end_time - start_time:.1f} seconds")
@@ -227,15 +338,92 @@ def main():
         default=True,
         help="Enable or disable the LLM-judge evaluation. Enabled by default."
     )
+    parser.add_argument(
+        "--judge-workers",
+        type=int,
+        default=None,
+        help="Concurrent LLM-judge calls, a stage separate from generation (default: --max-workers)"
+    )
     parser.add_argument(
         "--manual",
         action="store_true",
         help="Enable manual mode to override LLM actions with user input."
     )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=0,
+        help="Number of pre-started sandbox containers to keep warm, 0 disables the pool (default: 0)"
+    )
+    parser.add_argument(
+        "--setup-cache-gb",
+        type=float,
+        default=0,
+        help="Disk budget in GB for images cached after setup, 0 disables the cache (default: 0)"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["docker", "namespace"],
+        default="docker",
+        help="Sandbox backend: Docker containers, or Linux namespaces over an unpacked rootfs (default: docker)"
+    )
+    parser.add_argument(
+        "--cpu-limit",
+        type=float,
+        default=None,
+        help="CPUs each sandbox container may use, e.g. 1.5 (default: no limit)"
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=str,
+        default=None,
+        help="Memory each sandbox container may use, e.g. 2g (default: no limit)"
+    )
+    parser.add_argument(
+        "--teacher-single-call",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Ask the teacher for the reasoning and the command in one call, falling back to two when it only reasons. Changes the teacher's prompt, so it is off by default."
+    )
+    parser.add_argument(
+        "--completion-cache",
+        type=str,
+        default=None,
+        help="SQLite file caching teacher and judge completions across runs (default: disabled)"
+    )
+    parser.add_argument(
+        "--completion-cache-gb",
+        type=float,
+        default=1,
+        help="Size budget in GB of the completion cache (default: 1)"
+    )
+    parser.add_argument(
+        "--orphan-ttl-hours",
+        type=float,
+        default=6,
+        help="Remove sandbox containers left behind by this or earlier runs once they are this old, 0 disables it (default: 6)"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve sandbox latency metrics for Prometheus on this port (default: disabled)"
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=None,
+        help="Dump sandbox latency metrics as JSON to this file every minute (default: disabled)"
+    )
     
     args = parser.parse_args()
     print(os.getenv("HTTP_PROXY"))
 
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file:
+        metrics.dump_periodically(args.metrics_file)
+
     teacher_base_url = "http://rearden:8000/v1"
     teacher_api_key = "MEOW"
     teacher_model = "deathbyknowledge/Qwen3-8B-Shell-SFT"
@@ -255,7 +443,17 @@ def main():
         manual=args.manual,
         teacher_base_url=teacher_base_url,
         teacher_api_key=teacher_api_key,
-        teacher_model=teacher_model
+        teacher_model=teacher_model,
+        pool_size=0 if args.manual else args.pool_size,
+        setup_cache_gb=args.setup_cache_gb,
+        backend=args.backend,
+        cpu_limit=args.cpu_limit,
+        memory_limit=args.memory_limit,
+        orphan_ttl_hours=args.orphan_ttl_hours,
+        teacher_single_call=args.teacher_single_call,
+        completion_cache_file=args.completion_cache,
+        completion_cache_gb=args.completion_cache_gb,
+        judge_workers=args.judge_workers
     )
 
 if __name__ == "__main__":
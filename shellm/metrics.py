@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds: a shell exec takes milliseconds, a container setup can take minutes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    """Cumulative bucket counts plus sum and count, as Prometheus expects them."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry:
+    """Thread-safe store of histograms and counters, keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timed(self, stage, **labels):
+        """Records how long the block took in `sandbox_<stage>_seconds`, or counts a failure if it raised."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("sandbox_failures_total", stage=stage, **labels)
+            raise
+        self.observe(f"sandbox_{stage}_seconds", time.perf_counter() - start_time, **labels)
+
+    def snapshot(self):
+        """Returns every metric as plain JSON-serializable data."""
+        with self._lock:
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": dict(zip(map(str, h.buckets), h.counts)),
+                    "sum": h.sum,
+                    "count": h.count,
+                }
+                for (name, labels), h in self._histograms.items()
+            ]
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._counters.items()
+            ]
+        return {"time": time.time(), "histograms": histograms, "counters": counters}
+
+    def render_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        typed = set()
+        snapshot = self.snapshot()
+        for histogram in sorted(snapshot["histograms"], key=lambda h: h["name"]):
+            name = histogram["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in histogram["buckets"].items():
+                lines.append(f"{name}_bucket{_labels(histogram['labels'], le=bound)} {count}")
+            lines.append(f"{name}_bucket{_labels(histogram['labels'], le='+Inf')} {histogram['count']}")
+            lines.append(f"{name}_sum{_labels(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{_labels(histogram['labels'])} {histogram['count']}")
+        for counter in sorted(snapshot["counters"], key=lambda c: c["name"]):
+            name = counter["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_labels(counter['labels'])} {counter['value']}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+# Process-wide registry every sandbox implementation records into
+REGISTRY = Registry()
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+timed = REGISTRY.timed
+
+
+def serve(port=9464, registry=REGISTRY):
+    """Serves the metrics at http://0.0.0.0:<port>/metrics from a background thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving sandbox metrics on port {port}")
+    return server
+
+
+def dump_periodically(path, interval=60, registry=REGISTRY):
+    """Rewrites a JSON snapshot of the metrics to path every interval seconds from a background thread."""
+    def loop():
+        while True:
+            time.sleep(interval)
+            tmp_file = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(registry.snapshot(), f)
+            os.replace(tmp_file, path)
+
+    thread = threading.Thread(target=loop, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
+
+
+_exporting = False
+
+
+def export_from_env():
+    """Starts the exporters configured by METRICS_PORT and METRICS_FILE (and METRICS_INTERVAL), once per process."""
+    global _exporting
+    if _exporting:
+        return
+    _exporting = True
+    if os.getenv("METRICS_PORT"):
+        serve(int(os.environ["METRICS_PORT"]))
+    if os.getenv("METRICS_FILE"):
+        dump_periodically(os.environ["METRICS_FILE"], interval=float(os.getenv("METRICS_INTERVAL", "60")))
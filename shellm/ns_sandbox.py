@@ -0,0 +1,234 @@
+import argparse
+import fcntl
+import os
+import select
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import termios
+import time
+
+import metrics
+from base_sandbox import BaseSandbox
+
+DEFAULT_ROOTFS = os.path.expanduser("~/.cache/shellm/rootfs/shellm-sandbox")
+
+# Runs as root of a fresh user namespace: the unpacked image is the read-only lower
+# layer of an overlay whose writes land in a tmpfs, so every sandbox starts from the
+# pristine rootfs and its changes vanish with the namespace. The overlay becomes the
+# root with pivot_root and the host's root is unmounted, so nothing of the host
+# filesystem stays reachable, and the shell runs without the capabilities that could
+# mount it again. The network namespace only has loopback.
+LAUNCH_SCRIPT = """
+set -e
+ip link set lo up 2>/dev/null || true
+mount -t tmpfs -o size="$SHELLM_TMPFS_SIZE" tmpfs "$SHELLM_SCRATCH"
+mkdir "$SHELLM_SCRATCH/upper" "$SHELLM_SCRATCH/work" "$SHELLM_SCRATCH/root"
+mount -t overlay overlay -o "lowerdir=$SHELLM_ROOTFS,upperdir=$SHELLM_SCRATCH/upper,workdir=$SHELLM_SCRATCH/work" "$SHELLM_SCRATCH/root"
+mount -t proc proc "$SHELLM_SCRATCH/root/proc"
+mkdir -p "$SHELLM_SCRATCH/root/dev" "$SHELLM_SCRATCH/root/tmp" "$SHELLM_SCRATCH/root/.oldroot"
+for dev in null zero full random urandom tty; do
+    touch "$SHELLM_SCRATCH/root/dev/$dev"
+    mount --bind "/dev/$dev" "$SHELLM_SCRATCH/root/dev/$dev"
+done
+cd "$SHELLM_SCRATCH/root"
+pivot_root . .oldroot
+export PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
+cd /
+umount -l /.oldroot
+rmdir /.oldroot
+exec setpriv --bounding-set=-all --inh-caps=-all --no-new-privs -- /usr/bin/env -i HOME=/home/shellm TERM=dumb \
+    PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin \
+    /bin/sh -c 'cd "$HOME" 2>/dev/null; exec /bin/bash --noprofile --norc -i'
+"""
+
+
+class NamespaceSandbox(BaseSandbox):
+    """Runs the persistent shell in unprivileged Linux namespaces instead of a Docker container.
+
+    Needs an unpacked copy of the sandbox image (see `prepare_rootfs`) with util-linux
+    (`umount`, `setpriv`) in it, and a kernel that allows overlay mounts in user
+    namespaces (5.11+). Commands have no network access beyond loopback.
+    """
+
+    METRICS_BACKEND = "namespace"
+
+    def __init__(self, rootfs=DEFAULT_ROOTFS, setup_commands=[], tmpfs_size="512m", max_output_bytes=32 * 1024, command_timeout=20, reactor=None):
+        super().__init__(max_output_bytes=max_output_bytes, command_timeout=command_timeout, reactor=reactor)
+        self.rootfs = rootfs
+        self.tmpfs_size = tmpfs_size
+        self.setup_command_list = list(setup_commands)
+        self.process = None
+        self.master_fd = None
+        self.scratch_dir = None
+        self._shell_host_pid = None
+
+    def launch(self):
+        """Creates the namespaces and attaches to their shell, without running any setup."""
+        if not os.path.isdir(self.rootfs):
+            raise Exception(f"Sandbox rootfs not found at {self.rootfs}, run `python ns_sandbox.py prepare` first.")
+        self.scratch_dir = tempfile.mkdtemp(prefix="shellm-ns-")
+        self.master_fd, slave_fd = os.openpty()
+        env = {
+            "PATH": os.environ.get("PATH", "/usr/sbin:/usr/bin:/sbin:/bin"),
+            "SHELLM_ROOTFS": os.path.abspath(self.rootfs),
+            "SHELLM_SCRATCH": self.scratch_dir,
+            "SHELLM_TMPFS_SIZE": self.tmpfs_size,
+        }
+        try:
+            # --kill-child takes the whole namespace down with the unshare process
+            with metrics.timed("create", backend=self.METRICS_BACKEND):
+                self.process = subprocess.Popen(
+                    ["unshare", "--user", "--map-root-user", "--mount", "--pid", "--net", "--fork", "--kill-child",
+                     "/bin/sh", "-c", LAUNCH_SCRIPT],
+                    stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, env=env,
+                    start_new_session=True,
+                    # Make the pty the controlling terminal so Ctrl-C and job control work
+                    preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0),
+                )
+        finally:
+            os.close(slave_fd)
+        with metrics.timed("attach", backend=self.METRICS_BACKEND):
+            self._attach(self.master_fd)
+            self._init_session()
+        self._shell_host_pid = self._find_shell_host_pid()
+
+    def _find_shell_host_pid(self):
+        """Returns the host PID of the shell, the only child of the unshare process."""
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children", 'r') as f:
+                children = f.read().split()
+            return int(children[0]) if children else None
+        except (OSError, ValueError):
+            return None
+
+    def start(self):
+        """Starts the namespaced shell and runs the setup commands in it."""
+        print("Starting namespace sandbox...")
+        try:
+            self.launch()
+            if self.setup_command_list:
+                print("Installing tools in sandbox...")
+                setup = " && ".join(self.setup_command_list)
+                with metrics.timed("setup", backend=self.METRICS_BACKEND):
+                    _, stderr, exit_code = self.execute_command(f"/bin/bash -c {shlex.quote(setup)}", timeout=300)
+                    if exit_code != 0:
+                        raise Exception(f"Sandbox setup failed: {stderr or 'Unknown error'}")
+            print("Sandbox ready.")
+        except Exception as e:
+            print(f"Error starting sandbox: {e}")
+            self.stop()
+            raise
+
+    def _session_open(self):
+        return self.process is not None and self.master_fd is not None
+
+    def _send(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.master_fd, view)
+            view = view[written:]
+
+    def _recv(self):
+        """Returns received bytes, b"" once the shell is gone, or None if nothing arrived."""
+        ready, _, _ = select.select([self.master_fd], [], [], 1)
+        if not ready:
+            return None
+        try:
+            return os.read(self.master_fd, 65536)
+        except OSError:
+            # EIO: every process holding the pty slave has exited
+            return b""
+
+    def _kill_foreground_job(self):
+        """Sends SIGKILL to the process group in the foreground of the shell's terminal."""
+        try:
+            foreground = os.tcgetpgrp(self.master_fd)
+            if self._shell_host_pid is None or foreground != os.getpgid(self._shell_host_pid):
+                os.killpg(foreground, signal.SIGKILL)
+        except OSError as e:
+            print(f"Warning: Could not kill foreground job: {e}")
+
+    def _respawn_shell(self):
+        """Starts over in new namespaces; the shell is their init, so its files died with it."""
+        print("Respawning sandbox shell, the sandbox filesystem is lost and setup runs again...")
+        self.stop()
+        self.command_id = 0
+        self.start()
+
+    def reset(self):
+        """Returns to the pristine rootfs, which for namespaces is just a relaunch."""
+        self.stop()
+        self.command_id = 0
+        self.launch()
+
+    def stop(self):
+        """Kills the namespaces and everything running in them."""
+        with metrics.timed("teardown", backend=self.METRICS_BACKEND):
+            self._stop()
+
+    def _stop(self):
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.wait()
+            self.process = None
+        self._detach()
+        if self.master_fd is not None:
+            os.close(self.master_fd)
+            self.master_fd = None
+        if self.scratch_dir is not None:
+            # The tmpfs was only mounted inside the namespace, so this is an empty directory
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
+
+
+def prepare_rootfs(image="shellm-sandbox:latest", dest=DEFAULT_ROOTFS):
+    """Unpacks a Docker image's filesystem to dest, as the lower layer for namespace sandboxes."""
+    import docker
+
+    client = docker.from_env()
+    container = client.containers.create(image, command="true")
+    tmp_dest = f"{dest}.tmp"
+    shutil.rmtree(tmp_dest, ignore_errors=True)
+    os.makedirs(tmp_dest)
+    try:
+        # Device nodes can't be created unprivileged; the launcher bind-mounts the host ones
+        tar = subprocess.Popen(
+            ["tar", "-x", "--no-same-owner", "--exclude=dev/*", "-C", tmp_dest],
+            stdin=subprocess.PIPE,
+        )
+        for chunk in container.export():
+            tar.stdin.write(chunk)
+        tar.stdin.close()
+        if tar.wait() != 0:
+            raise Exception(f"Failed to unpack {image}")
+    finally:
+        container.remove(force=True)
+    shutil.rmtree(dest, ignore_errors=True)
+    os.replace(tmp_dest, dest)
+    print(f"Unpacked {image} to {dest}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Docker-free sandboxes on Linux namespaces")
+    parser.add_argument("action", choices=["prepare", "demo"])
+    parser.add_argument("--image", type=str, default="shellm-sandbox:latest", help="Image to unpack")
+    parser.add_argument("--rootfs", type=str, default=DEFAULT_ROOTFS, help="Where the unpacked rootfs lives")
+    args = parser.parse_args()
+
+    if args.action == "prepare":
+        prepare_rootfs(args.image, args.rootfs)
+    else:
+        start_time = time.time()
+        sandbox = NamespaceSandbox(rootfs=args.rootfs, setup_commands=["mkdir -p /workspace"])
+        sandbox.start()
+        print(f"Sandbox ready in {time.time() - start_time:.3f}s")
+        for command in ["cd /workspace", "touch file.txt", "ls -l", "asdf"]:
+            stdout, stderr, exit_code = sandbox.execute_command(command)
+            print(f"{command}: Exit code: {exit_code}, Stdout: {stdout}, Stderr: {stderr}")
+        sandbox.stop()
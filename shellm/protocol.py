@@ -0,0 +1,279 @@
+import uuid
+
+# Every frame starts with an ASCII record separator followed by the session nonce.
+# The wrapped command only ever contains the escaped form `\036`, so neither the
+# echo of a command nor anything the agent prints can be mistaken for a header.
+FRAME_START = b"\x1e"
+
+# Makes the interactive shell quiet and binary-safe: no input echo, no \n -> \r\n
+# translation on output, no prompts and no `!` history expansion.
+SESSION_INIT = "stty -echo -opost; set +H; PS1=''; PS2=''; unset PROMPT_COMMAND"
+
+# cgroup v2 directory of the shell's own cgroup (the container's, given a cgroup namespace)
+CGROUP_DIR = "/sys/fs/cgroup"
+
+# Samples the cgroup's counters with builtins only, so accounting costs no forks.
+# `__shellm_usage` sets __shellm_cpu (usage_usec), __shellm_rd / __shellm_wr (io.stat
+# bytes summed over devices) and __shellm_peak (memory.peak), -1 where a file is
+# missing; `__shellm_mark` keeps the current values as the baseline of a command.
+USAGE_FUNCTIONS = (
+    "__shellm_usage() { local k v f; __shellm_cpu=-1; __shellm_rd=-1; __shellm_wr=-1; __shellm_peak=-1; "
+    f"if [ -r {CGROUP_DIR}/cpu.stat ]; then while read -r k v; do "
+    "[ \"$k\" = usage_usec ] && __shellm_cpu=$v; "
+    f"done < {CGROUP_DIR}/cpu.stat; fi; "
+    f"if [ -r {CGROUP_DIR}/io.stat ]; then __shellm_rd=0; __shellm_wr=0; "
+    "while read -r k v; do for f in $v; do case $f in "
+    "rbytes=*) __shellm_rd=$(( __shellm_rd + ${f#rbytes=} ));; "
+    "wbytes=*) __shellm_wr=$(( __shellm_wr + ${f#wbytes=} ));; "
+    f"esac; done; done < {CGROUP_DIR}/io.stat; fi; "
+    f"if [ -r {CGROUP_DIR}/memory.peak ]; then read -r __shellm_peak < {CGROUP_DIR}/memory.peak; fi; }}; "
+    "__shellm_mark() { __shellm_usage; "
+    "__shellm_cpu0=$__shellm_cpu; __shellm_rd0=$__shellm_rd; __shellm_wr0=$__shellm_wr; }"
+)
+
+
+def new_nonce():
+    """Returns a random token that identifies frames of one shell session."""
+    return uuid.uuid4().hex
+
+
+def output_files(nonce, tmp_dir="/tmp"):
+    return f"{tmp_dir}/.shellm_{nonce}.out", f"{tmp_dir}/.shellm_{nonce}.err"
+
+
+def init_command(nonce, tmp_dir="/tmp"):
+    """Configures a fresh shell session and answers with frame 0.
+
+    It also defines `__shellm_frame <id> <exit_code> <max_bytes> [1]`, which writes the
+    frame of a finished command: `\\x1e<nonce>:<id>:<exit_code>:<stdout_total>:<stderr_total>\\n`
+    followed by each output, cut down to its first and last max_bytes / 2 bytes
+    when it is larger than max_bytes (0 means no limit). With the trailing 1 the
+    header goes on with `:<cpu_usec>:<read_bytes>:<write_bytes>:<memory_peak>`,
+    counted since the last `__shellm_mark`.
+    Frame 0 has no output and carries the PID of the shell in its exit code field.
+    """
+    out_file, err_file = output_files(nonce, tmp_dir)
+    functions = (
+        "__shellm_cat() { if [ \"$3\" -gt 0 ] && [ \"$2\" -gt \"$3\" ]; then "
+        "head -c $(( $3 / 2 )) \"$1\"; tail -c $(( $3 - $3 / 2 )) \"$1\"; "
+        "else head -c \"$2\" \"$1\"; fi; }; "
+        "__shellm_frame() { "
+        f"local s=($(stat -c %s {out_file} {err_file} 2>/dev/null)); "
+        "local o=${s[0]:-0} e=${s[1]:-0}; "
+        f"printf '\\036{nonce}:%d:%d:%d:%d' \"$1\" \"$2\" $o $e; "
+        "if [ \"$4\" = 1 ]; then __shellm_usage; printf ':%d:%d:%d:%d' "
+        "$(( __shellm_cpu < 0 || __shellm_cpu0 < 0 ? -1 : __shellm_cpu - __shellm_cpu0 )) "
+        "$(( __shellm_rd < 0 || __shellm_rd0 < 0 ? -1 : __shellm_rd - __shellm_rd0 )) "
+        "$(( __shellm_wr < 0 || __shellm_wr0 < 0 ? -1 : __shellm_wr - __shellm_wr0 )) "
+        "$__shellm_peak; fi; printf '\\n'; "
+        f"__shellm_cat {out_file} $o $3; __shellm_cat {err_file} $e $3; }}"
+    )
+    return f"{SESSION_INIT}; {USAGE_FUNCTIONS}; {functions}; printf '\\036{nonce}:0:%d:0:0\\n' $$\n"
+
+
+def _accounting_parts(accounting):
+    """Returns the baseline call to put before a command and the flag for its frame."""
+    return ("__shellm_mark; ", " 1") if accounting else ("", "")
+
+
+def wrap_command(command, nonce, command_id, max_output_bytes=0, tmp_dir="/tmp", accounting=False):
+    """Wraps a command so the shell answers with a single length-prefixed frame.
+
+    With accounting, the frame also reports the cgroup resources used while it ran.
+    """
+    out_file, err_file = output_files(nonce, tmp_dir)
+    mark, flag = _accounting_parts(accounting)
+    # The command runs in a `{ ...\n}` group in the current shell so `cd` and
+    # variables persist, and the newline keeps trailing `#` comments harmless.
+    return f"{mark}{{ {command}\n}} > {out_file} 2> {err_file}; __shellm_frame {command_id} $? {max_output_bytes}{flag}\n"
+
+
+def wrap_batch(commands, nonce, first_id, max_output_bytes=0, stop_on_error=False, tmp_dir="/tmp", accounting=False):
+    """Wraps several commands so the shell answers with one frame each, ids counting up from first_id.
+
+    Everything is sent at once, so commands read stdin from /dev/null instead of
+    swallowing the commands queued behind them. With stop_on_error, commands after
+    the first non-zero exit code are skipped and send no frame.
+    """
+    out_file, err_file = output_files(nonce, tmp_dir)
+    mark, flag = _accounting_parts(accounting)
+    lines = ["__shellm_failed=\n"]
+    for i, command in enumerate(commands):
+        run = (
+            f"{mark}{{ {command}\n}} < /dev/null > {out_file} 2> {err_file}; "
+            f"__shellm_rc=$?; __shellm_frame {first_id + i} $__shellm_rc {max_output_bytes}{flag}"
+        )
+        if stop_on_error:
+            run = f"if [ -z \"$__shellm_failed\" ]; then {run}; [ $__shellm_rc -eq 0 ] || __shellm_failed=1; fi"
+        lines.append(run + "\n")
+    lines.append("unset __shellm_failed __shellm_rc\n")
+    return "".join(lines)
+
+
+def frame_command(command_id, exit_code, max_output_bytes=0, accounting=False):
+    """Asks the shell to (re)send the frame of a command with the given exit code."""
+    _, flag = _accounting_parts(accounting)
+    return f"__shellm_frame {command_id} {exit_code} {max_output_bytes}{flag}\n"
+
+
+def wrap_stream_command(command, nonce, command_id):
+    """Wraps a command whose combined output goes straight to the terminal, ended by an empty frame."""
+    return f"{{ {command}\n}} 2>&1; printf '\\036{nonce}:{command_id}:%d:0:0\\n' $?\n"
+
+
+def stream_end_command(nonce, command_id, exit_code):
+    """Asks the shell to send the empty frame that ends a streamed command."""
+    return f"printf '\\036{nonce}:{command_id}:{exit_code}:0:0\\n'\n"
+
+
+def _resources(cpu_usec, read_bytes, write_bytes, memory_peak):
+    """Turns the accounting fields of a frame header into a dict, None where the cgroup has no counter."""
+    return {
+        "cpu_seconds": cpu_usec / 1e6 if cpu_usec >= 0 else None,
+        "read_bytes": read_bytes if read_bytes >= 0 else None,
+        "write_bytes": write_bytes if write_bytes >= 0 else None,
+        # memory.peak is the high-water mark of the whole container so far, not of this command alone
+        "memory_peak_bytes": memory_peak if memory_peak >= 0 else None,
+    }
+
+
+def _sent_bytes(total, max_output_bytes):
+    if max_output_bytes > 0 and total > max_output_bytes:
+        return max_output_bytes
+    return total
+
+
+class FrameReader:
+    """Incrementally scans the shell output stream for the frame of one command.
+
+    Memory stays bounded: noise before the header is dropped as it arrives and
+    the body is at most 2 * max_output_bytes.
+    """
+
+    def __init__(self, nonce, command_id, max_output_bytes=0):
+        self.command_id = command_id
+        self.header = FRAME_START + f"{nonce}:{command_id}:".encode()
+        self.max_output_bytes = max_output_bytes
+        self.buffer = bytearray()
+        self.exit_code = None
+        self.stdout_total = 0
+        self.stderr_total = 0
+        self.resources = None
+        self._body_start = None
+        self.complete = False
+
+    @property
+    def stdout_truncated(self):
+        return _sent_bytes(self.stdout_total, self.max_output_bytes) < self.stdout_total
+
+    @property
+    def stderr_truncated(self):
+        return _sent_bytes(self.stderr_total, self.max_output_bytes) < self.stderr_total
+
+    def feed(self, data):
+        """Adds received bytes and returns True once the whole frame has arrived."""
+        self.buffer += data
+        if self._body_start is None:
+            index = self.buffer.find(self.header)
+            if index == -1:
+                # Anything before a possible partial header is shell noise (e.g. job notices)
+                keep = len(self.header) - 1
+                if len(self.buffer) > keep:
+                    del self.buffer[:len(self.buffer) - keep]
+                return False
+            del self.buffer[:index]
+            newline = self.buffer.find(b"\n", len(self.header))
+            if newline == -1:
+                return False
+            try:
+                fields = [int(f) for f in self.buffer[len(self.header):newline].split(b":")]
+                if len(fields) not in (3, 7):
+                    raise ValueError
+                self.exit_code, self.stdout_total, self.stderr_total = fields[:3]
+                if len(fields) == 7:
+                    self.resources = _resources(*fields[3:])
+            except ValueError:
+                raise Exception(f"Malformed frame header: {bytes(self.buffer[:newline])!r}")
+            self._body_start = newline + 1
+        self.complete = len(self.buffer) >= self._frame_end()
+        return self.complete
+
+    def _frame_end(self):
+        body_len = _sent_bytes(self.stdout_total, self.max_output_bytes) + _sent_bytes(self.stderr_total, self.max_output_bytes)
+        return self._body_start + body_len
+
+    def remainder(self):
+        """Returns what arrived after the end of a complete frame, e.g. the start of the next one."""
+        return bytes(self.buffer[self._frame_end():])
+
+    def _section(self, start, total):
+        sent = _sent_bytes(total, self.max_output_bytes)
+        data = bytes(self.buffer[start:start + sent])
+        if sent < total:
+            head = self.max_output_bytes // 2
+            data = data[:head] + f"\n[... {total - sent} bytes truncated ...]\n".encode() + data[head:]
+        return data, start + sent
+
+    def result(self):
+        """Returns (stdout, stderr, exit_code) of a complete frame, outputs as bytes."""
+        stdout, offset = self._section(self._body_start, self.stdout_total)
+        stderr, _ = self._section(offset, self.stderr_total)
+        return stdout, stderr, self.exit_code
+
+
+class StreamReader:
+    """Passes a streamed command's output through until the empty frame that ends it.
+
+    Header lines of other commands of the session, left over from an interrupted
+    one, are dropped. Output that nobody takes is capped at max_pending bytes;
+    the rest is counted in `dropped`.
+    """
+
+    def __init__(self, nonce, command_id, max_pending=1024 * 1024):
+        self.command_id = command_id
+        self.prefix = FRAME_START + f"{nonce}:".encode()
+        self.header = self.prefix + f"{command_id}:".encode()
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.output = bytearray()
+        self.dropped = 0
+        self.exit_code = None
+        self.complete = False
+
+    def feed(self, data):
+        """Adds received bytes and returns True once there is output to take or the frame has arrived."""
+        if self.complete:
+            return True
+        self.buffer += data
+        while not self.complete:
+            index = self.buffer.find(self.prefix)
+            if index == -1:
+                # Hold back what could be the start of a header split across reads
+                start = self.buffer.rfind(FRAME_START, max(0, len(self.buffer) - (len(self.prefix) - 1)))
+                self._pass(len(self.buffer) if start == -1 else start)
+                break
+            self._pass(index)
+            newline = self.buffer.find(b"\n")
+            if newline == -1:
+                break
+            line = bytes(self.buffer[:newline])
+            del self.buffer[:newline + 1]
+            if line.startswith(self.header):
+                try:
+                    self.exit_code = int(line[len(self.header):].split(b":")[0])
+                except ValueError:
+                    raise Exception(f"Malformed frame header: {line!r}")
+                self.complete = True
+        return self.complete or bool(self.output)
+
+    def _pass(self, end):
+        room = max(0, self.max_pending - len(self.output))
+        self.output += self.buffer[:min(end, room)]
+        self.dropped += max(0, end - room)
+        del self.buffer[:end]
+
+    def take_output(self):
+        """Returns and forgets the output received so far."""
+        data = bytes(self.output)
+        self.output.clear()
+        return data
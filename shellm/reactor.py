@@ -0,0 +1,238 @@
+import asyncio
+import os
+import selectors
+import threading
+
+from base_sandbox import ShellClosedError
+
+# Output that arrives while nobody waits for a frame is only shell noise or the
+# start of the next frame; keep at most this much of it.
+MAX_PENDING_BYTES = 1024 * 1024
+
+
+class Channel:
+    """A shell connection registered with a Reactor."""
+
+    def __init__(self, reactor, fileobj):
+        self.reactor = reactor
+        self.fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.pending = bytearray()
+        self.waiter = None
+        self.closed = False
+
+
+class _Waiter:
+    def __init__(self, reader, loop=None):
+        self.reader = reader
+        self.event = threading.Event()
+        self.done = False
+        # Raised in the waiting thread, e.g. a malformed frame the reader refused
+        self.error = None
+        # An event loop waiting through `await_frame` is woken with this future instead
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def wake(self):
+        self.event.set()
+        if self.future is not None:
+            try:
+                self.loop.call_soon_threadsafe(_resolve, self.future)
+            except RuntimeError:
+                # The loop closed before its waiter gave up; nobody is left to wake
+                pass
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Reactor:
+    """Reads every registered shell connection from one selector thread.
+
+    Callers block in `wait_frame` on an event instead of polling their own
+    connection, so hundreds of sessions cost one thread and one epoll set.
+    Coroutines use `await_frame`, which needs no thread at all.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._changes = []
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="sandbox-reactor", daemon=True)
+        self._thread.start()
+        return self
+
+    def register(self, fileobj):
+        """Starts reading a socket or file descriptor and returns its Channel."""
+        channel = Channel(self, fileobj)
+        self._change(("register", channel))
+        return channel
+
+    def unregister(self, channel):
+        """Stops reading a channel; call it before closing the channel's socket."""
+        with self._lock:
+            channel.closed = True
+            self._wake(channel)
+        done = self._change(("unregister", channel))
+        # Wait until the selector has let go of the descriptor, so it can't be reused under us
+        while not done.wait(timeout=1) and not self._closed:
+            pass
+
+    def wait_frame(self, channel, reader, timeout=20):
+        """Blocks until the reader has received its whole frame from the channel."""
+        waiter = _Waiter(reader)
+        if self._park(channel, waiter):
+            return
+        waiter.event.wait(timeout)
+        self._settle(channel, waiter)
+
+    async def await_frame(self, channel, reader, timeout=20):
+        """Like `wait_frame`, but waits on the running event loop instead of blocking a thread."""
+        waiter = _Waiter(reader, asyncio.get_running_loop())
+        if self._park(channel, waiter):
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self._release(channel, waiter)
+            raise
+        self._settle(channel, waiter)
+
+    def _park(self, channel, waiter):
+        """Feeds the channel's pending output to the waiter's reader, then makes it the channel's waiter.
+
+        Returns True if the pending output already completed the frame.
+        """
+        with self._lock:
+            if channel.closed:
+                raise ShellClosedError("Shell session closed while waiting for command output.")
+            if channel.pending:
+                data, channel.pending = channel.pending, bytearray()
+                if waiter.reader.feed(data):
+                    return True
+            channel.waiter = waiter
+        return False
+
+    def _release(self, channel, waiter):
+        with self._lock:
+            if channel.waiter is waiter:
+                # The reader keeps its partial frame, so waiting again picks up from here
+                channel.waiter = None
+
+    def _settle(self, channel, waiter):
+        """Takes a waiter off its channel and raises unless its frame is complete."""
+        self._release(channel, waiter)
+        if waiter.error is not None:
+            raise waiter.error
+        if waiter.done:
+            return
+        if channel.closed:
+            raise ShellClosedError("Shell session closed while waiting for command output.")
+        raise TimeoutError(f"Timeout waiting for frame: {waiter.reader.header!r}")
+
+    def close(self):
+        """Stops the reactor thread; registered channels read as closed from then on."""
+        self._closed = True
+        os.write(self._wakeup_w, b"\0")
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for key in list(self._selector.get_map().values()):
+                if key.data is not None:
+                    key.data.closed = True
+                    self._wake(key.data)
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _change(self, change):
+        # The selector is only touched by the reactor thread; it applies queued changes on wakeup
+        done = threading.Event()
+        with self._lock:
+            self._changes.append((*change, done))
+        os.write(self._wakeup_w, b"\0")
+        return done
+
+    def _wake(self, channel):
+        """Releases a channel's waiter; the caller holds the lock."""
+        if channel.waiter is not None:
+            channel.waiter.wake()
+            channel.waiter = None
+
+    def _apply_changes(self):
+        with self._lock:
+            changes, self._changes = self._changes, []
+        for action, channel, done in changes:
+            registered = self._selector.get_map().get(channel.fd)
+            if action == "register" and not channel.closed:
+                if registered is not None:
+                    # The descriptor was closed and reused without unregistering its old channel
+                    with self._lock:
+                        registered.data.closed = True
+                        self._wake(registered.data)
+                    self._selector.unregister(channel.fd)
+                self._selector.register(channel.fd, selectors.EVENT_READ, channel)
+            elif action == "unregister" and registered is not None and registered.data is channel:
+                self._selector.unregister(channel.fd)
+            done.set()
+
+    def _loop(self):
+        while not self._closed:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    try:
+                        os.read(self._wakeup_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    self._read(key.data)
+                except Exception as e:
+                    # One broken channel must not take the reactor, and every other session, down with it
+                    self._fail(key.data, e)
+            self._apply_changes()
+
+    def _fail(self, channel, error):
+        """Closes a channel whose data couldn't be handled and hands the error to its waiter."""
+        with self._lock:
+            channel.closed = True
+            if channel.waiter is not None:
+                channel.waiter.error = error
+            self._wake(channel)
+            registered = self._selector.get_map().get(channel.fd)
+            if registered is not None and registered.data is channel:
+                self._selector.unregister(channel.fd)
+
+    def _read(self, channel):
+        try:
+            data = os.read(channel.fd, 65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # e.g. EIO on a pty whose shell has exited
+            data = b""
+        with self._lock:
+            if not data:
+                channel.closed = True
+                self._wake(channel)
+                self._selector.unregister(channel.fd)
+                return
+            waiter = channel.waiter
+            if waiter is None:
+                channel.pending += data
+                if len(channel.pending) > MAX_PENDING_BYTES:
+                    del channel.pending[:len(channel.pending) - MAX_PENDING_BYTES]
+            elif waiter.reader.feed(data):
+                waiter.done = True
+                self._wake(channel)
@@ -1,144 +1,310 @@
 import docker
+import os
+import shlex
+import tarfile
+import threading
 import time
 import socket
 
-class Sandbox:
+import metrics
+import teardown
+from base_sandbox import BaseSandbox
+
+# Pristine (mode, uid, gid, mtime) of directories, by template container and path
+_template_dirs = {}
+_template_dirs_lock = threading.Lock()
+
+class Sandbox(BaseSandbox):
     """Manages an isolated Docker container with a persistent shell session."""
-    
-    def __init__(self, image="shellm-sandbox:latest", setup_commands=[]):
+
+    METRICS_BACKEND = "docker"
+
+    def __init__(self, image="shellm-sandbox:latest", setup_commands=[], pool=None, client=None, setup_cache=None, max_output_bytes=32 * 1024, command_timeout=20, reactor=None, resource_accounting=True, cpu_limit=None, memory_limit=None, teardown_queue=None):
+        super().__init__(max_output_bytes=max_output_bytes, command_timeout=command_timeout, reactor=reactor, resource_accounting=resource_accounting)
         self.image = image
-        self.client = docker.from_env()
+        self.pool = pool
+        self.setup_cache = setup_cache
+        # Optional per-container limits: CPUs (e.g. 1.5) and memory (bytes or a string like "2g").
+        # Pooled containers get the limits of their pool instead.
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        # Removes stopped containers in the background; without one, `stop` removes them itself
+        self.teardown_queue = teardown_queue
+        self.client = client if client is not None else docker.from_env()
         self.container = None
+        self.container_image = None
         self.socket = None
-        self.command_id = 0
+        self.setup_command_list = list(setup_commands)
         self.setup_commands = " && ".join(setup_commands).replace("'", "'\\''")
-        print(setup_commands)
+        if setup_commands:
+            print(setup_commands)
 
-    def start(self):
-        """Starts a new Docker container and sets up a persistent shell session."""
-        print("Starting secure sandbox...")
-        try:
-            # Start container with bash as the main process
+    def launch(self, image=None):
+        """Starts the container and attaches to its shell, without running any setup."""
+        # PID 1 only keeps the container alive, so the shell can be killed and
+        # respawned (see `reset`) without losing the container.
+        with metrics.timed("create", backend=self.METRICS_BACKEND):
             self.container = self.client.containers.run(
-                self.image,
-                command="/bin/bash",
+                image or self.image,
+                command=["sleep", "infinity"],
                 tty=True,
                 stdin_open=True,
-                detach=True
-            )
-            # Install tools using exec_run
-            print("Installing tools in sandbox...")
-            exit_code, (stdout, stderr) = self.container.exec_run(
-                f"/bin/bash -c '{self.setup_commands}'", demux=True
-            )
-            if exit_code != 0:
-                raise Exception(f"Sandbox setup failed: {stderr.decode() if stderr else 'Unknown error'}")
-            print("Sandbox ready.")
-            # Attach to the bash process
-            self.socket = self.container.attach_socket(
-                params={'stdin': 1, 'stdout': 1, 'stderr': 1, 'stream': 1}
+                detach=True,
+                nano_cpus=int(self.cpu_limit * 1e9) if self.cpu_limit else None,
+                mem_limit=self.memory_limit,
+                labels=teardown.container_labels(),
             )
+            teardown.track(self.container)
+        self.container_image = image or self.image
+        self._spawn_shell()
+
+    def _spawn_shell(self):
+        """Starts an interactive bash in the container and attaches to it."""
+        with metrics.timed("attach", backend=self.METRICS_BACKEND):
+            exec_id = self.client.api.exec_create(self.container.id, "/bin/bash", stdin=True, tty=True)['Id']
+            self.socket = self.client.api.exec_start(exec_id, socket=True, tty=True)
             self.socket._sock.settimeout(1)  # Set timeout for socket reads
-            self.socket._sock.send(b'stty -echo\n') # Don't echo input
-            time.sleep(0.1)
+            self._attach(self.socket._sock)
+            self._init_session()
+
+    def _session_open(self):
+        return self.container is not None and self.socket is not None
+
+    def _send(self, data):
+        self.socket._sock.sendall(data)
+
+    def _recv(self):
+        """Returns received bytes, b"" once the shell is gone, or None if nothing arrived."""
+        try:
+            return self.socket._sock.recv(65536)
+        except socket.timeout:
+            return None
+
+    def _adopt(self, other):
+        """Takes over the running container and shell session of another sandbox."""
+        self.container, self.container_image = other.container, other.container_image
+        self.socket, self.nonce, self.shell_pid = other.socket, other.nonce, other.shell_pid
+        self.channel = other.channel
+        if self.channel is None and self.socket is not None:
+            self._attach(self.socket._sock)
+
+    def start(self):
+        """Starts a new Docker container and sets up a persistent shell session."""
+        print("Starting secure sandbox...")
+        try:
+            cached_image = None
+            if self.setup_cache is not None and self.setup_command_list:
+                cached_image = self.setup_cache.lookup(self.image, self.setup_command_list)
+            if cached_image:
+                # The image already contains the post-setup state, so setup is skipped
+                self.launch(image=cached_image)
+            elif self.pool is not None:
+                # Take an already running, attached container instead of a cold start
+                self._adopt(self.pool.acquire())
+            else:
+                self.launch()
+            if self.setup_commands and not cached_image:
+                # Install tools using exec_run
+                print("Installing tools in sandbox...")
+                with metrics.timed("setup", backend=self.METRICS_BACKEND):
+                    exit_code, (stdout, stderr) = self.container.exec_run(
+                        f"/bin/bash -c '{self.setup_commands}'", demux=True
+                    )
+                    if exit_code != 0:
+                        raise Exception(f"Sandbox setup failed: {stderr.decode() if stderr else 'Unknown error'}")
+                if self.setup_cache is not None:
+                    self.setup_cache.store(self.container, self.image, self.setup_command_list)
+            print("Sandbox ready.")
 
         except Exception as e:
             print(f"Error starting sandbox: {e}")
             self.stop()
             raise
 
-    def execute_command(self, command: str):
-        """Executes a command in the persistent shell session."""
-        if not self.container or not self.socket:
-            raise Exception("Sandbox is not running or session is not started.")
-
-        self.command_id += 1
-        id = self.command_id
-        stdout_file = f"/tmp/stdout_{id}.txt"
-        stderr_file = f"/tmp/stderr_{id}.txt"
-        exitcode_file = f"/tmp/exitcode_{id}.txt"
-        marker = f"COMMAND_DONE_{id}"
-
-        # By wrapping the command in `{ ...; }`, we create a command group.
-        # This allows shell redirections inside the `command` (e.g., `> file.txt`)
-        # to function correctly, while we capture the output of the group itself.
-        # Unlike a subshell `(...)`, this executes in the current shell context,
-        # so commands like `cd` work as expected.
-        # The spaces and trailing semicolon are required syntax for the shell group.
-        grouped_command = f"{{ {command}; }}"
-
-        # Send command with output redirection and marker
-        cmd_to_send = (
-            f"{grouped_command} > {stdout_file} 2> {stderr_file}; "
-            f"echo $? > {exitcode_file}; echo '{marker}'\n"
-        )
-        self.socket._sock.send(cmd_to_send.encode('utf-8'))
-
-        # Wait for command completion
-        self.read_until_marker(marker)
-
-        # Read output files
-        stdout_exit, (stdout_data, stdout_errdata) = self.container.exec_run(f"cat {stdout_file}", demux=True)
-        stderr_exit, (stderr_data, stderr_errdata) = self.container.exec_run(f"cat {stderr_file}", demux=True)
-        exitcode_exit, (exitcode_data, exitcode_errdata) = self.container.exec_run(f"cat {exitcode_file}", demux=True)
-        
-        if stdout_exit != 0:
-            raise Exception(f"Command failed: {stdout_errdata.decode('utf-8')}")
-        if stderr_exit != 0:
-            raise Exception(f"Command failed: {stderr_errdata.decode('utf-8')}")
-        if exitcode_exit != 0:
-            raise Exception(f"Command failed: {exitcode_errdata.decode('utf-8')}")
-
-        # Decode outputs
-        stdout = stdout_data.decode('utf-8') if stdout_data else ""
-        stderr = stderr_data.decode('utf-8') if stderr_data else ""
-        exit_code_str = exitcode_data.decode('utf-8').strip() if exitcode_data else "0"
-
-        # Parse exit code
-        try:
-            exit_code = int(exit_code_str)
-        except ValueError:
-            exit_code = -1  # Indicate parsing error
+    def _kill_foreground_job(self):
+        """Sends SIGKILL to the process group in the foreground of the shell's terminal."""
+        pid = self.shell_pid
+        self.container.exec_run([
+            "/bin/sh", "-c",
+            f"pg=$(ps -o tpgid= -p {pid} | tr -d ' '); "
+            f"if [ -n \"$pg\" ] && [ \"$pg\" -gt 0 ] && [ \"$pg\" != {pid} ]; then kill -KILL -- -$pg; fi"
+        ])
+
+    def _respawn_shell(self):
+        """Replaces a dead or wedged shell with a new one, keeping the container filesystem."""
+        print("Respawning sandbox shell...")
+        self._detach()
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+        if self.shell_pid:
+            # The shell leads its own session, so this also takes its jobs with it
+            self.container.exec_run(["pkill", "-KILL", "-s", str(self.shell_pid)])
+        self._spawn_shell()
 
-        # Clean up temporary files
-        self.container.exec_run(f"rm {stdout_file} {stderr_file} {exitcode_file}")
+    def reset(self, template=None):
+        """Restores the container to its image state and respawns the shell, keeping the container.
 
-        return stdout, stderr, exit_code
+        `template` is a created (never started) container of the same image that
+        pristine files are copied from; a temporary one is made if not given.
+        """
+        if not self.container:
+            raise Exception("Sandbox is not running.")
+        with metrics.timed("reset", backend=self.METRICS_BACKEND):
+            self._reset(template)
 
-    def read_until_marker(self, marker, timeout=20):
-        """Reads from the socket until the specified marker is found."""
-        if self.socket is None:
-            raise Exception("Socket not initialized")
-        accumulated = ""
+    def _reset(self, template):
         start_time = time.time()
-        while time.time() - start_time < timeout:
-            try:
-                data = self.socket._sock.recv(1024).decode('utf-8')
-                accumulated += data
-                if marker in accumulated:
-                    return accumulated
-            except socket.timeout:
-                continue
-        raise TimeoutError(f"Timeout waiting for marker: {marker}")
+        self._detach()
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+        # kill -1 signals everything but PID 1 and the caller: the shell and any jobs it left
+        self.container.exec_run(["/bin/sh", "-c", "kill -KILL -1"])
+
+        own_template = template is None
+        if own_template:
+            template = self.client.containers.create(self.container_image, command="true", labels=teardown.container_labels())
+        try:
+            self._revert_filesystem(template)
+        finally:
+            if own_template:
+                template.remove(force=True)
+
+        self.command_id = 0
+        self._spawn_shell()
+        teardown.heartbeat(self.container)
+        print(f"Sandbox reset in {time.time() - start_time:.2f}s")
+
+    def _revert_filesystem(self, template):
+        """Undoes every change `docker diff` reports against the container's image."""
+        changes = self.container.diff() or []
+        added = [c['Path'] for c in changes if c['Kind'] == 1]
+        modified = [c['Path'] for c in changes if c['Kind'] == 0]
+        deleted = [c['Path'] for c in changes if c['Kind'] == 2]
+
+        # Removing a new directory removes everything added below it
+        added = _top_level_paths(added)
+        for i in range(0, len(added), 500):
+            self.container.exec_run(["rm", "-rf", "--", *added[i:i + 500]])
+
+        # Entries added to or removed from a modified directory are covered by the
+        # other lists; modified files need their content back, and modified
+        # directories their metadata, which a chmod, chown or touch may have changed.
+        modified_dirs = set()
+        if modified:
+            _, (stdout, _) = self.container.exec_run(["find", *modified, "-maxdepth", "0", "-type", "d"], demux=True)
+            modified_dirs = set((stdout or b"").decode('utf-8', errors='replace').splitlines())
+        to_restore = _top_level_paths(deleted) + [p for p in modified if p not in modified_dirs]
+        for path in to_restore:
+            data, _ = template.get_archive(path)
+            self.container.put_archive(os.path.dirname(path) or "/", b"".join(data))
+
+        # Last, as restoring their entries above touched their mtime again
+        commands = []
+        for path in sorted(modified_dirs):
+            mode, uid, gid, mtime = _directory_metadata(template, path)
+            quoted = shlex.quote(path)
+            commands.append(f"chown -h {uid}:{gid} {quoted}; chmod {mode:04o} {quoted}; touch -h -d @{mtime} {quoted}")
+        if commands:
+            exit_code, output = self.container.exec_run(["/bin/sh", "-c", "; ".join(commands)])
+            if exit_code != 0:
+                raise Exception(f"Could not restore directory metadata: {output.decode('utf-8', errors='replace')}")
+
+    def halt(self):
+        """Stops the shell session and the container but keeps the container, e.g. to inspect it later."""
+        # A kept container is never handed back to the pool
+        self.pool = None
+        self._detach()
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+        if self.container:
+            self.container.stop(timeout=1)
+            # Left for the orphan reaper once it outlives its TTL
+            teardown.untrack(self.container)
 
     def stop(self):
-        """Stops the shell session and removes the container."""
+        """Stops the shell session and removes the container, or hands it back to its pool."""
+        with metrics.timed("teardown", backend=self.METRICS_BACKEND):
+            self._stop()
+
+    def _stop(self):
+        if self.pool is not None and self.container is not None and self.container_image == self.pool.image:
+            # Containers of the pool's image are reset and reused instead of removed
+            self.pool.release(self)
+            self.container = None
+            self.socket = None
+            self.channel = None
+            return
+        self._detach()
         if self.socket:
-            try:
-                self.socket._sock.send(b"exit\n")
-                time.sleep(1)  # Allow bash to exit
-            except Exception as e:
-                print(f"Error sending exit command: {e}")
+            # Removing the container kills the shell, so there is no need to wait for it to exit
             self.socket.close()
             self.socket = None
         if self.container:
-            try:
-                self.container.remove(force=True)
-            except docker.errors.APIError as e: # type: ignore
-                print(f"Warning: Could not stop container properly: {e}")
+            if self.teardown_queue is not None:
+                self.teardown_queue.submit(self.container)
+            else:
+                teardown.remove_container(self.container)
             self.container = None
 
 
+class _ChunkReader:
+    """File-like view of a chunk generator, for tarfile's streaming mode."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _directory_metadata(template, path):
+    """Returns the (mode, uid, gid, mtime) a directory has in the template container.
+
+    Only the archive's first header is read; the template never changes, so the
+    result is kept for the next resets.
+    """
+    key = (template.id, path)
+    with _template_dirs_lock:
+        if key in _template_dirs:
+            return _template_dirs[key]
+    chunks, _ = template.get_archive(path, chunk_size=4096)
+    try:
+        with tarfile.open(fileobj=_ChunkReader(chunks), mode="r|") as tar:
+            info = tar.next()
+    finally:
+        chunks.close()
+    if info is None or not info.isdir():
+        raise Exception(f"{path} is not a directory in the image")
+    metadata = (info.mode & 0o7777, info.uid, info.gid, int(info.mtime))
+    with _template_dirs_lock:
+        _template_dirs[key] = metadata
+    return metadata
+
+
+def _top_level_paths(paths):
+    """Drops every path that has an ancestor in the list."""
+    kept = set()
+    for path in sorted(paths, key=len):
+        parent = os.path.dirname(path)
+        while parent not in kept and parent not in ("/", ""):
+            parent = os.path.dirname(parent)
+        if parent not in kept:
+            kept.add(path)
+    return sorted(kept)
+
+
 if __name__ == "__main__":
     # Example usage
     sandbox = Sandbox()
@@ -0,0 +1,192 @@
+import threading
+import time
+from collections import deque
+
+import docker
+
+import teardown
+from sandbox import Sandbox
+
+
+class SandboxPool:
+    """Keeps pre-started, attached sandbox containers ready to be handed out.
+
+    With `reuse` enabled, released sandboxes are reset in place and go back into
+    the pool instead of being removed and replaced by a fresh container.
+    """
+
+    def __init__(self, image="shellm-sandbox:latest", min_size=2, max_size=8, idle_timeout=300, refill_workers=2, reuse=True, reactor=None, cpu_limit=None, memory_limit=None, teardown_queue=None, client=None):
+        if min_size < 0 or max_size < min_size:
+            raise ValueError(f"Invalid pool size: min_size={min_size}, max_size={max_size}")
+        self.image = image
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.refill_workers = refill_workers
+        self.reuse = reuse
+        self.reactor = reactor
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.teardown_queue = teardown_queue
+        self.client = client if client is not None else docker.from_env()
+        self._idle = deque()  # (sandbox, idle_since), oldest first
+        self._dirty = deque()  # released sandboxes waiting for a reset
+        self._template = None
+        self._target = min_size
+        self._launching = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        """Starts the background workers that keep the pool filled."""
+        for i in range(self.refill_workers):
+            thread = threading.Thread(target=self._refill_loop, name=f"sandbox-pool-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def acquire(self):
+        """Hands out a warm sandbox, or cold-starts one if the pool is empty."""
+        sandbox = None
+        with self._cond:
+            if self._closed:
+                raise Exception("Sandbox pool is closed.")
+            if self._idle:
+                sandbox, _ = self._idle.popleft()
+            else:
+                # A miss means demand is above what we keep warm, so grow towards max_size
+                self._target = min(self._target + 1, self.max_size)
+            self._cond.notify_all()
+        if sandbox is None:
+            print("Sandbox pool empty, cold-starting a container...")
+            return self._launch()
+        # A container that keeps being reused is not an orphan, however old it is
+        teardown.heartbeat(sandbox.container)
+        return sandbox
+
+    def release(self, sandbox):
+        """Takes back a used sandbox's container to be reset and handed out again."""
+        holder = Sandbox(image=self.image, client=self.client, reactor=self.reactor, teardown_queue=self.teardown_queue)
+        holder._adopt(sandbox)
+        with self._cond:
+            if self.reuse and not self._closed:
+                self._dirty.append(holder)
+                self._cond.notify_all()
+                return
+        holder.stop()
+
+    def close(self):
+        """Stops the refill workers and removes every idle container."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        while self._idle:
+            sandbox, _ = self._idle.popleft()
+            sandbox.stop()
+        while self._dirty:
+            self._dirty.popleft().stop()
+        if self._template is not None:
+            teardown.remove_container(self._template)
+            self._template = None
+
+    def _launch(self):
+        sandbox = Sandbox(image=self.image, client=self.client, reactor=self.reactor, cpu_limit=self.cpu_limit, memory_limit=self.memory_limit, teardown_queue=self.teardown_queue)
+        try:
+            sandbox.launch()
+        except Exception:
+            sandbox.stop()
+            raise
+        return sandbox
+
+    def _evict_idle(self):
+        """Pops idle sandboxes past the idle timeout, never going below min_size."""
+        evicted = []
+        now = time.time()
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            sandbox, _ = self._idle.popleft()
+            evicted.append(sandbox)
+            self._target = max(self.min_size, self._target - 1)
+        return evicted
+
+    def _get_template(self):
+        """Returns a created, never started container of the image to copy pristine files from."""
+        with self._cond:
+            if self._template is None:
+                self._template = self.client.containers.create(self.image, command="true", labels=teardown.container_labels())
+                teardown.track(self._template)
+            template = self._template
+        teardown.heartbeat(template, min_interval=600)
+        return template
+
+    def _add_idle(self, sandbox, launched=False):
+        with self._cond:
+            if launched:
+                self._launching -= 1
+            if sandbox is not None and not self._closed and len(self._idle) < self.max_size:
+                self._idle.append((sandbox, time.time()))
+                self._cond.notify_all()
+                return
+        if sandbox is not None:
+            sandbox.stop()
+
+    def _refill_loop(self):
+        while True:
+            job, evicted = None, []
+            with self._cond:
+                while not self._closed:
+                    # Resetting a used container is cheaper than launching a new one
+                    if self._dirty:
+                        job = self._dirty.popleft()
+                        break
+                    evicted = self._evict_idle()
+                    if evicted:
+                        break
+                    if len(self._idle) + self._launching < self._target:
+                        job = "launch"
+                        self._launching += 1
+                        break
+                    self._cond.wait(timeout=1)
+                closed = self._closed
+            for sandbox in evicted:
+                sandbox.stop()
+            if closed:
+                return
+
+            if job == "launch":
+                sandbox = None
+                try:
+                    sandbox = self._launch()
+                except Exception as e:
+                    print(f"Error pre-starting sandbox: {e}")
+                    time.sleep(1)
+                self._add_idle(sandbox, launched=True)
+            elif job is not None:
+                try:
+                    job.reset(template=self._get_template())
+                except Exception as e:
+                    print(f"Error resetting sandbox, discarding it: {e}")
+                    job.stop()
+                    continue
+                self._add_idle(job)
+
+
+if __name__ == "__main__":
+    # Example usage
+    pool = SandboxPool(min_size=2, max_size=4)
+    pool.start()
+    try:
+        for i in range(3):
+            start_time = time.time()
+            sandbox = Sandbox(setup_commands=[f"mkdir -p /workspace/{i}"], pool=pool)
+            sandbox.start()
+            print(f"Sandbox {i} ready in {time.time() - start_time:.2f}s")
+            # Earlier tasks' directories are gone once their container was reset and reused
+            stdout, stderr, exit_code = sandbox.execute_command("ls /workspace")
+            print(f"ls: Exit code: {exit_code}, Stdout: {stdout}, Stderr: {stderr}")
+            sandbox.stop()
+            time.sleep(2)  # Give the pool time to reset the released container
+    finally:
+        pool.close()
@@ -0,0 +1,219 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+
+from sandbox import Sandbox
+
+DEFAULT_INDEX_FILE = os.path.expanduser("~/.cache/shellm/setup_cache.json")
+
+
+class SetupCache:
+    """Caches post-setup container state as images tagged by a hash of (image, setup_commands)."""
+
+    def __init__(self, client=None, repository="shellm-setup-cache", max_bytes=20 * 1024**3, index_file=DEFAULT_INDEX_FILE):
+        self.client = client if client is not None else docker.from_env()
+        self.repository = repository
+        self.max_bytes = max_bytes
+        self.index_file = index_file
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # tag -> lock held while that tag is being committed, so concurrent misses commit it once
+        self._committing = {}
+        # tag -> {"size": bytes of the committed layer, "last_used": unix time}
+        self._index = self._load_index()
+
+    def key(self, image, setup_commands):
+        """Returns the cache key for a base image and its list of setup commands."""
+        payload = json.dumps({"image": image, "setup_commands": list(setup_commands)})
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def tag(self, image, setup_commands):
+        return f"{self.repository}:{self.key(image, setup_commands)}"
+
+    def lookup(self, image, setup_commands):
+        """Returns the cached image tag for this setup, or None on a miss."""
+        tag = self.tag(image, setup_commands)
+        try:
+            self.client.images.get(tag)
+        except docker.errors.ImageNotFound: # type: ignore
+            with self._lock:
+                self.misses += 1
+                self._index.pop(tag, None)
+            return None
+        with self._lock:
+            self.hits += 1
+            entry = self._index.setdefault(tag, {"size": 0})
+            entry["last_used"] = time.time()
+            self._save_index()
+        return tag
+
+    def store(self, container, image, setup_commands):
+        """Commits a freshly set up container under the cache tag and enforces the budget."""
+        tag = self.tag(image, setup_commands)
+        repository, key = tag.split(":")
+        with self._lock:
+            commit_lock = self._committing.setdefault(tag, threading.Lock())
+        with commit_lock:
+            with self._lock:
+                stored = tag in self._index
+            if stored and self._exists(tag):
+                # Another worker missed on the same setup and committed it first; a second
+                # commit would move the tag and leave its image behind, outside the budget
+                with self._lock:
+                    self._index[tag]["last_used"] = time.time()
+                    self._committing.pop(tag, None)
+                    self._save_index()
+                return tag
+            committed = container.commit(repository=repository, tag=key)
+            size = self._layer_size(committed)
+            with self._lock:
+                self._index[tag] = {"size": size, "last_used": time.time()}
+                self._committing.pop(tag, None)
+                self._save_index()
+        self.evict()
+        return tag
+
+    def _exists(self, tag):
+        try:
+            self.client.images.get(tag)
+            return True
+        except docker.errors.ImageNotFound: # type: ignore
+            return False
+
+    def _layer_size(self, committed):
+        """Returns the bytes of the layer a commit added, once the daemon reports them."""
+        for _ in range(10):
+            # A fresh commit's attributes may not have its size filled in yet
+            committed.reload()
+            if committed.attrs.get("Size"):
+                break
+            time.sleep(0.2)
+        # The commit adds exactly one layer on top of the base image
+        return committed.history()[0].get("Size") or 0
+
+    def evict(self):
+        """Removes least recently used images until the cache fits in max_bytes."""
+        with self._lock:
+            entries = sorted(self._index.items(), key=lambda item: item[1].get("last_used", 0))
+            total = sum(entry.get("size", 0) for _, entry in entries)
+            for tag, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    self.client.images.remove(tag)
+                except docker.errors.ImageNotFound: # type: ignore
+                    pass
+                except docker.errors.APIError as e: # type: ignore
+                    # Most likely a container is still running from it; try again later
+                    print(f"Warning: Could not evict cached image {tag}: {e}")
+                    continue
+                total -= entry.get("size", 0)
+                del self._index[tag]
+            self._save_index()
+
+    def clear(self):
+        """Removes every cached image."""
+        for image in self.client.images.list(name=self.repository):
+            for tag in image.tags:
+                try:
+                    self.client.images.remove(tag)
+                except docker.errors.APIError as e: # type: ignore
+                    print(f"Warning: Could not remove cached image {tag}: {e}")
+        with self._lock:
+            self._index = {}
+            self._save_index()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "images": len(self._index),
+                "bytes": sum(entry.get("size", 0) for entry in self._index.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_file, self.index_file)
+
+
+def load_setup_commands(task_file=None, split=None):
+    """Returns the distinct setup command lists of a task JSONL file or a scenario split."""
+    if task_file:
+        with open(task_file, 'r') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        from datasets import load_dataset
+        # Same dataset rl/load_scenarios.py reads its train/test splits from
+        rows = load_dataset("deathbyknowledge/shell-tasks", split=split)
+    unique = {}
+    for row in rows:
+        setup_commands = list(row.get('setup_commands') or [])
+        if setup_commands:
+            unique[json.dumps(setup_commands)] = setup_commands
+    return list(unique.values())
+
+
+def prewarm(cache, all_setup_commands, image="shellm-sandbox:latest", max_workers=4):
+    """Builds a cached image for every setup that is not in the cache yet."""
+    def warm(setup_commands):
+        if cache.lookup(image, setup_commands):
+            return "cached"
+        sandbox = Sandbox(image=image, setup_commands=setup_commands, client=cache.client, setup_cache=cache)
+        try:
+            sandbox.start()
+        except Exception as e:
+            return f"failed: {e}"
+        sandbox.stop()
+        return "built"
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(warm, all_setup_commands))
+    for status in ("built", "cached"):
+        print(f"{status}: {results.count(status)}")
+    failed = [r for r in results if r.startswith("failed")]
+    print(f"failed: {len(failed)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the setup-command image cache")
+    parser.add_argument("action", choices=["prewarm", "stats", "clear"])
+    parser.add_argument("--task-file", type=str, help="Task JSONL file to prewarm from")
+    parser.add_argument("--split", type=str, choices=["train", "test"], help="Scenario split to prewarm from")
+    parser.add_argument("--image", type=str, default="shellm-sandbox:latest", help="Base sandbox image")
+    parser.add_argument("--max-gb", type=float, default=20, help="Disk budget for cached images in GB (default: 20)")
+    parser.add_argument("--max-workers", type=int, default=4, help="Concurrent setups while prewarming (default: 4)")
+    args = parser.parse_args()
+
+    cache = SetupCache(max_bytes=int(args.max_gb * 1024**3))
+    if args.action == "prewarm":
+        if not args.task_file and not args.split:
+            parser.error("prewarm needs --task-file or --split")
+        all_setup_commands = load_setup_commands(args.task_file, args.split)
+        print(f"Prewarming {len(all_setup_commands)} distinct setups...")
+        prewarm(cache, all_setup_commands, image=args.image, max_workers=args.max_workers)
+    elif args.action == "clear":
+        cache.clear()
+    print(cache.stats())
+
+
+if __name__ == "__main__":
+    main()
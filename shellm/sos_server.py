@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import json
+import uuid
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import docker
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+import metrics
+from reactor import Reactor
+from sandbox import Sandbox
+from sandbox_pool import SandboxPool
+from setup_cache import SetupCache
+from teardown import OrphanReaper, TeardownQueue
+
+
+class CreateRequest(BaseModel):
+    image: str = "shellm-sandbox:latest"
+    setup_commands: List[str] = []
+
+
+class ExecRequest(BaseModel):
+    command: str
+    standalone: bool = False
+
+
+class ExecStreamRequest(BaseModel):
+    command: str
+    timeout: Optional[float] = None
+
+
+class ExecAndStopRequest(ExecRequest):
+    remove: bool = True
+
+
+class ExecBatchRequest(BaseModel):
+    commands: List[str]
+    stop_on_error: bool = False
+
+
+class StopRequest(BaseModel):
+    remove: bool = True
+
+
+class SandboxEntry:
+    """A sandbox the server knows about, and the lock that serializes work on it."""
+
+    def __init__(self, sandbox_id, sandbox):
+        self.id = sandbox_id
+        self.sandbox = sandbox
+        self.status = "created"
+        self.lock = asyncio.Lock()
+
+    def info(self):
+        return {"id": self.id, "image": self.sandbox.image, "status": self.status}
+
+
+class SandboxServer:
+    """Local stand-in for the SoS sandbox server that rl/run_agent.py talks to through SoSClient.
+
+    Sandboxes of the pool's image start from warm containers; blocking Docker work
+    runs in threads, so sessions proceed concurrently.
+    """
+
+    def __init__(self, image="shellm-sandbox:latest", pool_size=4, max_pool_size=32, setup_cache_gb=0, command_timeout=20, orphan_ttl_hours=6):
+        self.image = image
+        self.command_timeout = command_timeout
+        self.client = docker.from_env()
+        self.reactor = Reactor()
+        self.teardown_queue = TeardownQueue()
+        # Also collects sandboxes stopped without remove (EPHEMERAL=0) once they outlive the TTL
+        self.reaper = OrphanReaper(client=self.client, ttl=orphan_ttl_hours * 3600) if orphan_ttl_hours > 0 else None
+        self.pool = SandboxPool(image=image, min_size=pool_size, max_size=max(pool_size, max_pool_size), reactor=self.reactor, teardown_queue=self.teardown_queue) if pool_size > 0 else None
+        self.setup_cache = SetupCache(client=self.client, max_bytes=int(setup_cache_gb * 1024**3)) if setup_cache_gb > 0 else None
+        self.sandboxes = {}
+
+    def start(self):
+        self.reactor.start()
+        self.teardown_queue.start()
+        if self.reaper is not None:
+            self.reaper.start()
+        if self.pool is not None:
+            self.pool.start()
+
+    def close(self):
+        for entry in list(self.sandboxes.values()):
+            if entry.status == "running":
+                entry.sandbox.stop()
+        self.sandboxes = {}
+        if self.pool is not None:
+            self.pool.close()
+        self.reactor.close()
+        if self.reaper is not None:
+            self.reaper.close()
+        self.teardown_queue.close()
+
+    def get(self, sandbox_id):
+        entry = self.sandboxes.get(sandbox_id)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"Sandbox {sandbox_id} not found")
+        return entry
+
+    def create(self, image, setup_commands):
+        sandbox = Sandbox(
+            image=image,
+            setup_commands=setup_commands,
+            pool=self.pool if self.pool is not None and image == self.pool.image else None,
+            client=self.client,
+            setup_cache=self.setup_cache,
+            command_timeout=self.command_timeout,
+            reactor=self.reactor,
+            teardown_queue=self.teardown_queue,
+        )
+        entry = SandboxEntry(uuid.uuid4().hex, sandbox)
+        self.sandboxes[entry.id] = entry
+        return entry
+
+    async def start_sandbox(self, entry):
+        async with entry.lock:
+            if entry.status != "created":
+                raise HTTPException(status_code=409, detail=f"Sandbox {entry.id} is {entry.status}")
+            try:
+                await asyncio.to_thread(entry.sandbox.start)
+            except Exception as e:
+                entry.status = "failed"
+                raise HTTPException(status_code=500, detail=f"Failed to start sandbox: {e}")
+            entry.status = "running"
+
+    async def exec_command(self, entry, command, standalone=False):
+        async with entry.lock:
+            if entry.status != "running":
+                raise HTTPException(status_code=409, detail=f"Sandbox {entry.id} is {entry.status}")
+            if standalone:
+                # A fresh bash outside the agent's session, so its cwd and variables don't matter
+                exit_code, output = await asyncio.to_thread(entry.sandbox.container.exec_run, ["/bin/bash", "-c", command])
+                return {"output": (output or b"").decode('utf-8', errors='replace'), "exit_code": exit_code}
+            stdout, stderr, exit_code = await asyncio.to_thread(entry.sandbox.execute_command, command)
+            return {"output": stdout + stderr, "exit_code": exit_code, **entry.sandbox.last_command}
+
+    async def exec_stream(self, entry, command, timeout=None):
+        """Returns the NDJSON events of a streamed command, holding the sandbox until they are consumed."""
+        await entry.lock.acquire()
+        if entry.status != "running":
+            entry.lock.release()
+            raise HTTPException(status_code=409, detail=f"Sandbox {entry.id} is {entry.status}")
+
+        async def events():
+            # A client that disconnects closes this generator, which interrupts the command;
+            # the sandbox is only handed to the next request once that interrupt is done
+            stream = entry.sandbox.astream_command(command, timeout)
+            try:
+                async for event in stream:
+                    yield json.dumps(event) + "\n"
+            finally:
+                closing = asyncio.ensure_future(stream.aclose())
+                try:
+                    await asyncio.shield(closing)
+                finally:
+                    if closing.done():
+                        entry.lock.release()
+                    else:
+                        # Cancelled while the interrupt still runs: hand the sandbox over when it ends
+                        closing.add_done_callback(lambda _: entry.lock.release())
+
+        return events()
+
+    async def exec_batch(self, entry, commands, stop_on_error=False):
+        async with entry.lock:
+            if entry.status != "running":
+                raise HTTPException(status_code=409, detail=f"Sandbox {entry.id} is {entry.status}")
+            results = await asyncio.to_thread(entry.sandbox.execute_batch, commands, stop_on_error)
+            return {"results": [
+                {"command": r["command"], "output": r["stdout"] + r["stderr"], "exit_code": r["exit_code"], "duration": r["duration"]}
+                for r in results
+            ]}
+
+    async def stop_sandbox(self, entry, remove=True):
+        async with entry.lock:
+            if entry.status == "running":
+                if remove:
+                    await asyncio.to_thread(entry.sandbox.stop)
+                else:
+                    await asyncio.to_thread(entry.sandbox.halt)
+            entry.status = "stopped"
+            if remove:
+                self.sandboxes.pop(entry.id, None)
+
+
+def create_app(server):
+    @asynccontextmanager
+    async def lifespan(app):
+        server.start()
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(server.close)
+
+    app = FastAPI(title="shellm sandbox server", lifespan=lifespan)
+
+    @app.post("/sandboxes")
+    async def create_sandbox(request: CreateRequest):
+        return {"id": server.create(request.image, request.setup_commands).id}
+
+    @app.post("/sandboxes/create_and_start")
+    async def create_and_start_sandbox(request: CreateRequest):
+        entry = server.create(request.image, request.setup_commands)
+        try:
+            await server.start_sandbox(entry)
+        except HTTPException:
+            server.sandboxes.pop(entry.id, None)
+            raise
+        return entry.info()
+
+    @app.get("/sandboxes")
+    async def list_sandboxes():
+        return [entry.info() for entry in server.sandboxes.values()]
+
+    @app.post("/sandboxes/{sandbox_id}/start")
+    async def start_sandbox(sandbox_id: str):
+        entry = server.get(sandbox_id)
+        await server.start_sandbox(entry)
+        return entry.info()
+
+    @app.post("/sandboxes/{sandbox_id}/exec")
+    async def exec_command(sandbox_id: str, request: ExecRequest):
+        return await server.exec_command(server.get(sandbox_id), request.command, request.standalone)
+
+    @app.post("/sandboxes/{sandbox_id}/exec_stream")
+    async def exec_stream(sandbox_id: str, request: ExecStreamRequest):
+        events = await server.exec_stream(server.get(sandbox_id), request.command, request.timeout)
+        return StreamingResponse(events, media_type="application/x-ndjson")
+
+    @app.post("/sandboxes/{sandbox_id}/exec_batch")
+    async def exec_batch(sandbox_id: str, request: ExecBatchRequest):
+        return await server.exec_batch(server.get(sandbox_id), request.commands, request.stop_on_error)
+
+    @app.post("/sandboxes/{sandbox_id}/exec_and_stop")
+    async def exec_and_stop(sandbox_id: str, request: ExecAndStopRequest):
+        entry = server.get(sandbox_id)
+        try:
+            return await server.exec_command(entry, request.command, request.standalone)
+        finally:
+            await server.stop_sandbox(entry, request.remove)
+
+    @app.post("/sandboxes/{sandbox_id}/stop")
+    async def stop_sandbox(sandbox_id: str, request: StopRequest = StopRequest()):
+        entry = server.get(sandbox_id)
+        await server.stop_sandbox(entry, request.remove)
+        return entry.info()
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        return metrics.REGISTRY.render_prometheus()
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local SoS-compatible sandbox server")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to listen on (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=3000, help="Port to listen on (default: 3000, what SoSClient expects)")
+    parser.add_argument("--image", type=str, default="shellm-sandbox:latest", help="Image of the warm container pool")
+    parser.add_argument("--pool-size", type=int, default=4, help="Warm containers to keep ready, 0 disables the pool (default: 4)")
+    parser.add_argument("--max-pool-size", type=int, default=32, help="Upper bound the pool may grow to under load (default: 32)")
+    parser.add_argument("--setup-cache-gb", type=float, default=0, help="Disk budget in GB for images cached after setup, 0 disables the cache (default: 0)")
+    parser.add_argument("--command-timeout", type=int, default=20, help="Seconds before a session command is interrupted (default: 20)")
+    parser.add_argument("--orphan-ttl-hours", type=float, default=6, help="Remove sandbox containers nobody uses once they are this old, 0 disables it (default: 6)")
+    args = parser.parse_args()
+
+    server = SandboxServer(
+        image=args.image,
+        pool_size=args.pool_size,
+        max_pool_size=args.max_pool_size,
+        setup_cache_gb=args.setup_cache_gb,
+        command_timeout=args.command_timeout,
+        orphan_ttl_hours=args.orphan_ttl_hours,
+    )
+    uvicorn.run(create_app(server), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
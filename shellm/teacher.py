@@ -1,8 +1,9 @@
 import os
-from openai import OpenAI
 from pydantic import BaseModel
-import instructor
 from dotenv import load_dotenv
+from clients import REGISTRY
+from completion_cache import complete, complete_structured
+from history import History
 load_dotenv()
 
 class ShellResponse(BaseModel):
@@ -12,9 +13,10 @@ class ShellResponse(BaseModel):
 class Teacher:
     """Handles interaction with the teacher language model."""
     
-    def __init__(self, base_url: str | None = "https://api.deepseek.com", api_key: str | None = os.environ.get("DEEPSEEK_API_KEY"), model: str | None = "deepseek-chat"):
-        oai = OpenAI(base_url=base_url, api_key=api_key)
-        self.client = instructor.from_openai(oai)
+    def __init__(self, base_url: str | None = "https://api.deepseek.com", api_key: str | None = os.environ.get("DEEPSEEK_API_KEY"), model: str | None = "deepseek-chat", clients=None):
+        clients = clients or REGISTRY
+        self.client = clients.instructor(base_url, api_key)
+        self.cache = clients.completion_cache
         self.model = model
 
     def get_next_step(self, task, trajectory):
@@ -31,16 +33,18 @@ class Teacher:
         Respond with a single JSON object containing 'thought' and 'action' keys.
         """
         
-        history = self._format_history(trajectory)
+        history = History.of(trajectory).judge_transcript() if trajectory else "No history yet. This is the first step."
         prompt_content = f"TASK: {task}\n\nHISTORY:\n{history}\n\nProvide the next step."
 
-        shell_response = self.client.chat.completions.create(
+        shell_response = complete_structured(
+            self.client,
+            ShellResponse,
             model=self.model,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt_content}
             ],
-            response_model=ShellResponse,
+            cache=self.cache,
             temperature=0.4
         )
         if not shell_response:
@@ -48,50 +52,64 @@ class Teacher:
         
         return shell_response.thought, shell_response.action
 
-    def _format_history(self, trajectory):
-        """Formats the trajectory into a string for the prompt."""
-        if not trajectory:
-            return "No history yet. This is the first step."
-        
-        formatted = []
-        for turn in trajectory:
-            formatted.append(f"Turn {turn['turn']}:")
-            formatted.append(f"Thought:\n{turn['thought']}")
-            formatted.append(f"Action: `{turn['action']}`")
-            formatted.append(f"Exit Code: {turn['exit_code']}")
-            formatted.append(f"Observation:\n---\n{turn['observation'].strip()}\n---")
-        
-        return "\n".join(formatted)
+
+# Appended to the system prompt in single-call mode, so the reasoning and the command come in one message
+SINGLE_CALL_HINT = (
+    "\n\nAnswer each step with your reasoning as one or more shell comment lines starting with '#', "
+    "followed on the next line by the single command to run."
+)
 
 
 class ShellTeacher:
-    """Handles interaction with the teacher language model."""
+    """Handles interaction with the teacher language model.
+
+    With `single_call`, the model is asked for the `#` reasoning and the command in
+    one message. A reply holding only the reasoning falls back to the original
+    second call for the action, so the fallback costs nothing extra; a reply
+    without any reasoning is taken as the command alone.
+    `last_single_call` tells which of the two produced the last step, for the
+    caller to record on the turn.
+    """
     
-    def __init__(self, base_url: str | None = "https://api.deepseek.com", api_key: str | None = os.environ.get("DEEPSEEK_API_KEY"), model: str | None = "deepseek-chat"):
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+    def __init__(self, base_url: str | None = "https://api.deepseek.com", api_key: str | None = os.environ.get("DEEPSEEK_API_KEY"), model: str | None = "deepseek-chat", single_call: bool = False, clients=None):
+        clients = clients or REGISTRY
+        self.client = clients.openai(base_url, api_key)
+        self.cache = clients.completion_cache
         self.model = model
+        self.single_call = single_call
+        # How many turns took one call and how many needed the second one
+        self.single_calls = 0
+        self.fallbacks = 0
+        self.last_single_call = False
 
     def get_next_step(self, task, trajectory):
         """Constructs a prompt and gets the next thought/action."""
         
-        system_prompt = task        
-        history = self._format_history(trajectory)
-        prompt_content = f"TASK: {task}\n\nHISTORY:\n{history}\n\nProvide the next step."
+        system_prompt = task + SINGLE_CALL_HINT if self.single_call else task
+        # Rendered once per turn and kept, pass the same History every turn
+        history = History.of(trajectory).chat_messages()
 
         messages = [
                 {"role": "system", "content": system_prompt},
                 *history
         ]
         print('CALLING CLIENT', messages)
-        res = self.client.chat.completions.create(
-            model=self.model, #type: ignore
-            messages=messages,
-            temperature=0.4
-        )
-        if not res:
+        thought = complete(self.client, self.model, messages, cache=self.cache, temperature=0.4)
+        if not thought:
             raise ValueError("Received an empty response from the language model.")
 
-        thought = res.choices[0].message.content
+        if self.single_call:
+            split = self._split_step(thought)
+            if split is None and not thought.lstrip().startswith('#'):
+                # No reasoning at all, e.g. a bare `ls -la`: the whole reply is the command
+                split = "", thought.strip()
+            if split is not None:
+                self.single_calls += 1
+                self.last_single_call = True
+                return split
+            self.fallbacks += 1
+        self.last_single_call = False
+
         if "exit 0" in thought: # type: ignore
           return "", thought
 
@@ -100,28 +118,22 @@ class ShellTeacher:
 
         messages.append({"role": "assistant", "content": thought})
         messages.append({"role": "user", "content": ""})
-        res = self.client.chat.completions.create(
-            model=self.model, # type: ignore
-            messages=messages,
-            temperature=0.4
-        )
-        action = res.choices[0].message.content
+        action = complete(self.client, self.model, messages, cache=self.cache, temperature=0.4)
         
         return thought, action
 
-    def _format_history(self, trajectory):
-        """Formats the trajectory into a string for the prompt."""
-        if not trajectory:
-            return []
-        
-        messages = []
-        for turn in trajectory:
-            messages.append({"role": "assistant", "content": turn['thought']})
-            messages.append({"role": "user", "content": ""})
-            messages.append({"role": "assistant", "content": turn["action"]})
-            messages.append({"role": "user", "content": turn["observation"]})
-        
-        return messages
+    @staticmethod
+    def _split_step(content):
+        """Splits a reply into its leading `#` reasoning and the command after it, or returns None if either is missing."""
+        lines = (content or "").strip().splitlines()
+        comments = 0
+        while comments < len(lines) and lines[comments].lstrip().startswith('#'):
+            comments += 1
+        thought = "\n".join(lines[:comments]).strip()
+        action = "\n".join(lines[comments:]).strip()
+        if not thought or not action:
+            return None
+        return thought, action
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+import docker
+
+import metrics
+
+# Every sandbox container carries these labels, so leftovers can be found and attributed
+RUN_LABEL = "shellm.run"
+OWNER_LABEL = "shellm.owner"
+CREATED_LABEL = "shellm.created"
+
+# One run can span several processes (e.g. training workers); they share SHELLM_RUN_ID if set
+RUN_ID = os.getenv("SHELLM_RUN_ID") or uuid.uuid4().hex[:12]
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Containers this process still uses, which the reaper must leave alone whatever their age
+_live = set()
+_live_lock = threading.Lock()
+# When each container was last given a heartbeat by this process
+_heartbeats = {}
+
+
+def container_labels():
+    """Returns the labels to create a sandbox container with."""
+    return {RUN_LABEL: RUN_ID, OWNER_LABEL: OWNER_ID, CREATED_LABEL: str(int(time.time()))}
+
+
+def track(container):
+    """Marks a container as in use by this process."""
+    with _live_lock:
+        _live.add(container.id)
+
+
+def untrack(container):
+    """Lets the reaper collect a container once it is older than its TTL."""
+    with _live_lock:
+        _live.discard(container.id)
+
+
+def heartbeat(container, min_interval=0):
+    """Marks a container as just used, which restarts its orphan TTL.
+
+    Labels can't change after a container is created, so the time goes into the
+    container's name, which can, and which the reaper gets with the container list.
+    """
+    now = int(time.time())
+    with _live_lock:
+        if now - _heartbeats.get(container.id, 0) < min_interval:
+            return
+        _heartbeats[container.id] = now
+    try:
+        container.rename(f"shellm-{container.id[:12]}-{now}")
+    except docker.errors.APIError as e: # type: ignore
+        print(f"Warning: Could not record sandbox heartbeat: {e}")
+
+
+def last_used(container):
+    """Returns when a container was last given a heartbeat, or created if it never was."""
+    name = container.name or ""
+    prefix = f"shellm-{container.id[:12]}-"
+    if name.startswith(prefix) and name[len(prefix):].isdigit():
+        return int(name[len(prefix):])
+    try:
+        return int((container.labels or {}).get(CREATED_LABEL, "0"))
+    except ValueError:
+        return 0
+
+
+def remove_container(container):
+    """Force-removes a container, which also kills everything running in it."""
+    untrack(container)
+    with _live_lock:
+        _heartbeats.pop(container.id, None)
+    try:
+        container.remove(force=True)
+    except docker.errors.NotFound: # type: ignore
+        pass
+    except docker.errors.APIError as e: # type: ignore
+        print(f"Warning: Could not stop container properly: {e}")
+
+
+class TeardownQueue:
+    """Removes containers from background threads, so stopping a sandbox returns immediately."""
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"sandbox-teardown-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, container):
+        """Queues a container for removal, or removes it right away if the queue isn't running."""
+        if not self._threads:
+            remove_container(container)
+            return
+        metrics.inc("sandbox_teardown_queued_total")
+        self._queue.put(container)
+
+    def close(self):
+        """Waits for every queued removal, then stops the workers."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _loop(self):
+        while True:
+            container = self._queue.get()
+            if container is None:
+                return
+            with metrics.timed("remove", backend="docker"):
+                remove_container(container)
+
+
+class OrphanReaper:
+    """Periodically removes labelled sandbox containers that nobody uses anymore.
+
+    A container is an orphan once it has gone `ttl` seconds without a heartbeat
+    (or since its creation), is not in use by this process and its owner is not
+    another live process, e.g. sandboxes kept with EPHEMERAL=0 or left behind by
+    a crashed run on this host. Owners on other hosts sharing the Docker daemon
+    can't be checked, so their containers are left to them.
+    """
+
+    def __init__(self, client=None, ttl=6 * 3600, interval=300):
+        self.client = client if client is not None else docker.from_env()
+        self.ttl = ttl
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name="sandbox-reaper", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reap(self):
+        """Removes the orphans there are now and returns how many."""
+        now = time.time()
+        containers = self.client.containers.list(all=True, filters={"label": OWNER_LABEL})
+        with _live_lock:
+            live = set(_live)
+        reaped = 0
+        for container in containers:
+            labels = container.labels or {}
+            if container.id in live or now - last_used(container) < self.ttl or _owner_alive(labels.get(OWNER_LABEL, "")):
+                continue
+            print(f"Reaping orphaned sandbox container {container.short_id} of run {labels.get(RUN_LABEL)}")
+            remove_container(container)
+            reaped += 1
+        if reaped:
+            metrics.inc("sandbox_orphans_reaped_total", reaped)
+        return reaped
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Error reaping orphaned sandboxes: {e}")
+            self._stop.wait(self.interval)
+
+
+def _owner_alive(owner):
+    """Whether the owner is another process that may still be running.
+
+    Only processes on this host can be checked; owners elsewhere count as alive.
+    """
+    host, _, pid = owner.rpartition(":")
+    if not host or not pid.isdigit():
+        return False
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
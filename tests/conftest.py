@@ -0,0 +1,9 @@
+import os
+import sys
+
+# shellm/ and rl/ are script directories whose modules import each other flat
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+for directory in ("shellm", "rl"):
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.append(path)
@@ -0,0 +1,39 @@
+import importlib
+import sys
+import types
+
+
+def require(name, **attrs):
+    """Imports a module, or installs a stand-in with `attrs` when it isn't installed.
+
+    Only the third-party clients (docker, httpx, fastapi...) the modules under test
+    import at load time are faked; the tests never reach into them.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(require(parent), child, module)
+        return module
+
+
+class _APIError(Exception):
+    pass
+
+
+class _NotFound(_APIError):
+    pass
+
+
+class _ImageNotFound(_NotFound):
+    pass
+
+
+def require_docker():
+    errors = types.SimpleNamespace(APIError=_APIError, NotFound=_NotFound, ImageNotFound=_ImageNotFound)
+    docker = require("docker", errors=errors)
+    return docker
@@ -0,0 +1,52 @@
+import asyncio
+
+from admission import AdaptiveLimiter
+
+
+def test_waiters_are_admitted_by_priority():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial=1)
+        await limiter.acquire()
+        order = []
+
+        async def waiter(priority):
+            await limiter.acquire(priority)
+            order.append(priority)
+            limiter.release()
+
+        tasks = [asyncio.create_task(waiter(p)) for p in (3, 1, 2)]
+        await asyncio.sleep(0)
+        assert limiter.stats()["waiting"] == 3
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order, limiter.in_flight
+
+    assert asyncio.run(run()) == ([1, 2, 3], 0)
+
+
+def test_errors_shrink_the_limit_once_per_cooldown():
+    limiter = AdaptiveLimiter("test", initial=10, decrease=0.5, cooldown=60)
+    limiter.record(ok=False)
+    limiter.record(ok=False)
+    assert limiter.limit == 5
+
+
+def test_successes_grow_the_limit_up_to_the_max():
+    limiter = AdaptiveLimiter("test", initial=2, max_limit=3)
+    for _ in range(20):
+        limiter.record(latency=0.1)
+    assert limiter.limit == 3
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial=1)
+        await limiter.acquire()
+        task = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        task.cancel()
+        limiter.release()
+        await asyncio.gather(task, return_exceptions=True)
+        return limiter.in_flight
+
+    assert asyncio.run(run()) == 0
@@ -0,0 +1,116 @@
+import asyncio
+import fcntl
+import os
+import signal
+import subprocess
+import termios
+
+import pytest
+
+from base_sandbox import BaseSandbox, TIMEOUT_EXIT_CODE
+from reactor import Reactor
+
+
+class PtySandbox(BaseSandbox):
+    """A plain host bash on a pty: the session protocol without containers or namespaces."""
+
+    def __init__(self, **kwargs):
+        super().__init__(resource_accounting=False, **kwargs)
+        self.process = None
+        self.master_fd = None
+
+    def start(self):
+        self.master_fd, slave_fd = os.openpty()
+        try:
+            self.process = subprocess.Popen(
+                ["/bin/bash", "--norc", "--noprofile", "-i"],
+                stdin=slave_fd, stdout=slave_fd, stderr=slave_fd,
+                start_new_session=True,
+                preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0),
+            )
+        finally:
+            os.close(slave_fd)
+        self._attach(self.master_fd)
+        self._init_session()
+        return self
+
+    def _session_open(self):
+        return self.process is not None
+
+    def _send(self, data):
+        os.write(self.master_fd, data)
+
+    def _kill_foreground_job(self):
+        foreground = os.tcgetpgrp(self.master_fd)
+        if foreground != self.process.pid:
+            os.killpg(foreground, signal.SIGKILL)
+
+    def _respawn_shell(self):
+        self.stop()
+        self.start()
+
+    def stop(self):
+        if self.process is not None:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+            self.process = None
+        self._detach()
+        os.close(self.master_fd)
+
+
+@pytest.fixture
+def reactor():
+    reactor = Reactor().start()
+    yield reactor
+    reactor.close()
+
+
+def test_commands_are_awaited_on_the_event_loop(reactor):
+    sandbox = PtySandbox(reactor=reactor).start()
+    try:
+        async def run():
+            # Both sessions wait at once without a worker thread each
+            other = PtySandbox(reactor=reactor).start()
+            try:
+                return await asyncio.gather(
+                    sandbox.aexecute_command("sleep 0.3; echo one"),
+                    other.aexecute_command("sleep 0.3; echo two >&2; (exit 3)"),
+                )
+            finally:
+                other.stop()
+
+        assert asyncio.run(run()) == [("one\n", "", 0), ("", "two\n", 3)]
+    finally:
+        sandbox.stop()
+
+
+def test_awaited_command_times_out_and_the_session_recovers(reactor):
+    sandbox = PtySandbox(reactor=reactor).start()
+    try:
+        async def run():
+            timed_out = await sandbox.aexecute_command("echo started; sleep 30", timeout=0.5)
+            return timed_out, sandbox.last_command["timed_out"], await sandbox.aexecute_command("echo next")
+
+        (stdout, stderr, exit_code), flagged, after = asyncio.run(run())
+        assert stdout == "started\n"
+        assert exit_code == TIMEOUT_EXIT_CODE and flagged
+        assert "timed out after 0.5s" in stderr
+        assert after == ("next\n", "", 0)
+    finally:
+        sandbox.stop()
+
+
+def test_abandoned_stream_is_logged_as_abandoned(reactor, capsys):
+    sandbox = PtySandbox(reactor=reactor).start()
+    try:
+        stream = sandbox.stream_command("echo started; sleep 30", timeout=60)
+        output = b""
+        while b"started" not in output:
+            output += next(stream)
+        stream.close()
+        log = capsys.readouterr().out
+        assert f"Command {sandbox.command_id} abandoned by its consumer, interrupting it..." in log
+        assert "timed out" not in log
+        assert sandbox.execute_command("echo next") == ("next\n", "", 0)
+    finally:
+        sandbox.stop()
@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+from completion_cache import CompletionCache, acomplete, complete
+
+
+class Client:
+    """Answers every request with the next reply and records the requests."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **request):
+        self.requests.append(request)
+        message = SimpleNamespace(content=self.replies.pop(0))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class AsyncClient(Client):
+    async def create(self, **request):
+        return super().create(**request)
+
+
+MESSAGES = [{"role": "user", "content": "ls"}]
+
+
+def test_identical_requests_hit_and_different_ones_miss(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+    client = Client("first", "hotter", "other model")
+    assert complete(client, "m", MESSAGES, cache=cache, temperature=0) == "first"
+    assert complete(client, "m", MESSAGES, cache=cache, temperature=0) == "first"
+    assert complete(client, "m", MESSAGES, cache=cache, temperature=1) == "hotter"
+    assert complete(client, "n", MESSAGES, cache=cache, temperature=0) == "other model"
+    assert len(client.requests) == 3
+    assert (cache.hits, cache.misses) == (1, 3)
+    cache.close()
+
+    # Kept on disk for the next run
+    reopened = CompletionCache(str(tmp_path / "cache.sqlite"))
+    assert complete(Client(), "m", MESSAGES, cache=reopened, temperature=0) == "first"
+
+
+def test_empty_replies_are_not_cached(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+    client = Client("", "late")
+    assert complete(client, "m", MESSAGES, cache=cache) == ""
+    assert complete(client, "m", MESSAGES, cache=cache) == "late"
+    assert cache.stats()["entries"] == 1
+
+
+def test_async_requests_share_the_cache(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"))
+    complete(Client("sync"), "m", MESSAGES, cache=cache)
+    client = AsyncClient("async")
+    assert asyncio.run(acomplete(client, "m", MESSAGES, cache=cache)) == "sync"
+    assert client.requests == []
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = CompletionCache(str(tmp_path / "cache.sqlite"), max_bytes=10)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    cache.get("a")
+    cache.put("c", "cccc")
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == ("aaaa", None, "cccc")
@@ -0,0 +1,74 @@
+from context_budget import MESSAGE_OVERHEAD, ContextBudget
+
+
+class WordTokenizer:
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text, add_special_tokens=False):
+        self.calls += 1
+        return text.split()
+
+
+def conversation(outputs):
+    messages = [{"role": "system", "content": "task"}]
+    for i, output in enumerate(outputs):
+        messages.append({"role": "assistant", "content": f"cmd {i}"})
+        messages.append({"role": "user", "content": output})
+    return messages
+
+
+def budget_of(messages, **kwargs):
+    budget = ContextBudget(WordTokenizer(), **kwargs)
+    for message in messages:
+        budget.add(message)
+    return budget
+
+
+def recount(budget, messages):
+    return sum(budget.count(m["content"]) for m in messages)
+
+
+def big_output(seed):
+    return "\n".join(f"{seed} line {i} " + "word " * 20 for i in range(200))
+
+
+def test_counts_are_exact_and_cached():
+    messages = conversation(["a b c", "d e"])
+    budget = budget_of(messages, max_tokens=1000)
+    # task, cmd 0, a b c, cmd 1, d e
+    assert budget.tokens == 1 + 2 + 3 + 2 + 2 + 5 * MESSAGE_OVERHEAD
+    calls = budget.tokenizer.calls
+    budget.count("a b c")
+    assert budget.tokenizer.calls == calls
+
+
+def test_compaction_keeps_running_total_exact():
+    messages = conversation([big_output(i) for i in range(6)])
+    budget = budget_of(messages, max_tokens=6000, keep_recent=2, head_chars=200, tail_chars=200)
+    assert budget.needs_compaction()
+    saved = budget.compact(messages)
+    assert saved > 0
+    assert budget.tokens == recount(budget, messages)
+    assert budget.counts == [budget.count(m["content"]) for m in messages]
+    assert budget.fits()
+    assert "lines omitted" in messages[2]["content"]
+    # The output the model is about to answer is never cut
+    assert messages[-1]["content"] == big_output(5)
+
+
+def test_repeated_outputs_are_elided():
+    repeated = big_output("same")
+    messages = conversation([repeated, "short", repeated, "x", "y"])
+    budget = budget_of(messages, max_tokens=10 ** 6, keep_recent=2)
+    budget.compact(messages)
+    assert messages[2]["content"] == "[output identical to turn 3's, omitted]"
+    assert messages[6]["content"] == repeated
+    assert budget.tokens == recount(budget, messages)
+
+
+def test_compaction_within_budget_changes_nothing():
+    messages = conversation(["ok"] * 3)
+    budget = budget_of(messages, max_tokens=10 ** 6)
+    assert not budget.needs_compaction()
+    assert budget.compact(messages) == 0
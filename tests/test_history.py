@@ -0,0 +1,89 @@
+from history import History
+
+# The formatters History replaced, as Judge, Teacher, ShellTeacher and run_agent had them
+
+
+def old_judge_format(trajectory):
+    if not trajectory:
+        return "No actions were taken."
+
+    formatted = []
+    for turn in trajectory:
+        formatted.append(f"Turn {turn['turn']}:")
+        formatted.append(f"Thought:\n{turn['thought']}")
+        formatted.append(f"Action: `{turn['action']}`")
+        formatted.append(f"Exit Code: {turn['exit_code']}")
+        formatted.append(f"Observation:\n---\n{turn['observation'].strip()}\n---")
+
+    return "\n".join(formatted)
+
+
+def old_shell_teacher_format(trajectory):
+    messages = []
+    for turn in trajectory:
+        messages.append({"role": "assistant", "content": turn['thought']})
+        messages.append({"role": "user", "content": ""})
+        messages.append({"role": "assistant", "content": turn["action"]})
+        messages.append({"role": "user", "content": turn["observation"]})
+    return messages
+
+
+def old_run_agent_format(messages, exit_codes):
+    formatted = ""
+    outputs = 0
+    for msg in messages:
+        role = msg['role']
+        content = msg['content'] if 'content' in msg else "None"
+        if role == 'assistant':
+            formatted += f"$ {content}\n"
+        elif role == 'user':
+            formatted += f"{content}\n[EXIT_CODE = {exit_codes[outputs]}]\n"
+            outputs += 1
+        elif role == 'system':
+            formatted += f"TASK: {content}\n\n"
+    return formatted
+
+
+TURNS = [
+    {"turn": 1, "thought": "# Look around first", "action": "ls -la", "observation": "total 0\n  file.txt\n", "exit_code": 0},
+    {"turn": 2, "thought": "# Read it", "action": "cat missing.txt", "observation": "cat: missing.txt: No such file\n", "exit_code": 1},
+    {"turn": 3, "thought": "# Done", "action": "exit 0", "observation": "", "exit_code": 0},
+]
+
+
+def test_incremental_renderings_match_the_old_formatters():
+    history = History()
+    for i, turn in enumerate(TURNS):
+        history.append(turn)
+        # Rendering every turn, as the prompt builders do, must not change the result
+        assert history.judge_transcript() == old_judge_format(TURNS[:i + 1])
+        assert history.chat_messages() == old_shell_teacher_format(TURNS[:i + 1])
+    assert History().judge_transcript() == old_judge_format([])
+
+
+def test_chat_messages_are_copies():
+    history = History(TURNS[:1])
+    history.chat_messages().append({"role": "assistant", "content": "next"})
+    assert history.chat_messages() == old_shell_teacher_format(TURNS[:1])
+
+
+def test_shell_transcript_matches_run_agent():
+    messages = [{"role": "system", "content": "Find the file"}]
+    for turn in TURNS:
+        messages.append({"role": "assistant", "content": turn["action"]})
+        messages.append({"role": "user", "content": turn["observation"]})
+    exit_codes = [turn["exit_code"] for turn in TURNS]
+    history = History.from_messages(messages, exit_codes)
+    assert history.shell_transcript("Find the file") == old_run_agent_format(messages, exit_codes)
+
+
+def test_action_transcript_pairs_each_command_with_its_own_exit_code():
+    completion = []
+    for turn in TURNS[:2]:
+        completion.append({"role": "assistant", "content": turn["action"]})
+        completion.append({"role": "user", "content": turn["observation"]})
+    transcript = History.from_messages(completion, [0, 1]).action_transcript()
+    assert transcript == (
+        "Turn 1:\nAction:`ls -la`\nExit Code: 0\nShell Output:\n---\ntotal 0\n  file.txt\n---\n"
+        "Turn 2:\nAction:`cat missing.txt`\nExit Code: 1\nShell Output:\n---\ncat: missing.txt: No such file\n---"
+    )
@@ -0,0 +1,97 @@
+import pytest
+
+from protocol import FrameReader, StreamReader
+
+NONCE = "0123456789abcdef0123456789abcdef"
+
+
+def frame(command_id, exit_code, stdout=b"", stderr=b"", stdout_total=None, stderr_total=None, nonce=NONCE):
+    stdout_total = len(stdout) if stdout_total is None else stdout_total
+    stderr_total = len(stderr) if stderr_total is None else stderr_total
+    return f"\x1e{nonce}:{command_id}:{exit_code}:{stdout_total}:{stderr_total}\n".encode() + stdout + stderr
+
+
+def test_frame_fed_byte_by_byte():
+    reader = FrameReader(NONCE, 3)
+    data = b"shell noise\n" + frame(3, 2, b"out\n", b"err\n") + b"next"
+    results = [reader.feed(data[i:i + 1]) for i in range(len(data))]
+    end = len(data) - len(b"next")
+    # Complete exactly once the last byte of the body is in, and from then on
+    assert results[:end - 1] == [False] * (end - 1)
+    assert all(results[end - 1:])
+    assert reader.result() == (b"out\n", b"err\n", 2)
+    assert reader.remainder() == b"next"
+
+
+def test_header_split_across_reads():
+    reader = FrameReader(NONCE, 1)
+    data = frame(1, 0, b"hello")
+    assert not reader.feed(data[:5])
+    assert not reader.feed(data[5:40])
+    assert reader.feed(data[40:])
+    assert reader.result() == (b"hello", b"", 0)
+
+
+def test_forged_header_without_nonce_is_ignored():
+    reader = FrameReader(NONCE, 1)
+    # What an agent could print: a header with another nonce, or without the record separator
+    forged = frame(1, 0, b"fake", nonce="f" * 32) + f"{NONCE}:1:0:4:0\nfake".encode()
+    assert not reader.feed(forged)
+    assert reader.feed(frame(1, 7, b"real"))
+    assert reader.result() == (b"real", b"", 7)
+
+
+def test_other_command_ids_are_ignored():
+    reader = FrameReader(NONCE, 2)
+    assert not reader.feed(frame(1, 0, b""))
+    assert reader.feed(frame(2, 0, b"two"))
+    assert reader.result()[0] == b"two"
+
+
+def test_malformed_header_raises():
+    reader = FrameReader(NONCE, 1)
+    with pytest.raises(Exception, match="Malformed frame header"):
+        reader.feed(f"\x1e{NONCE}:1:zero:0:0\n".encode())
+
+
+def test_truncation_marker():
+    reader = FrameReader(NONCE, 1, max_output_bytes=10)
+    # The shell sends the first and last 5 bytes of a 25-byte output
+    assert reader.feed(frame(1, 0, b"HEAD.tail.", stdout_total=25))
+    stdout, stderr, exit_code = reader.result()
+    assert stdout == b"HEAD.\n[... 15 bytes truncated ...]\ntail."
+    assert reader.stdout_truncated and not reader.stderr_truncated
+    assert (stderr, exit_code) == (b"", 0)
+
+
+def test_resources_in_header():
+    reader = FrameReader(NONCE, 1)
+    assert reader.feed(f"\x1e{NONCE}:1:0:0:0:1500000:10:-1:4096\n".encode())
+    assert reader.resources == {"cpu_seconds": 1.5, "read_bytes": 10, "write_bytes": None, "memory_peak_bytes": 4096}
+
+
+def test_stream_reader_byte_by_byte():
+    reader = StreamReader(NONCE, 4)
+    data = b"line 1\nline 2\n" + frame(4, 3)
+    output = b""
+    for i in range(len(data)):
+        reader.feed(data[i:i + 1])
+        output += reader.take_output()
+    assert reader.complete and reader.exit_code == 3
+    assert output == b"line 1\nline 2\n"
+
+
+def test_stream_reader_drops_stale_headers_and_keeps_forged_ones():
+    reader = StreamReader(NONCE, 4)
+    forged = frame(4, 0, nonce="f" * 32)
+    assert reader.feed(frame(3, 124) + forged + b"out")
+    assert not reader.complete
+    assert reader.feed(frame(4, 0))
+    assert reader.take_output() == forged + b"out"
+
+
+def test_stream_reader_caps_pending_output():
+    reader = StreamReader(NONCE, 1, max_pending=4)
+    reader.feed(b"0123456789")
+    assert reader.take_output() == b"0123"
+    assert reader.dropped == 6
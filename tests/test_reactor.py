@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+
+import pytest
+
+from reactor import Reactor
+
+
+class BrokenReader:
+    header = b"broken"
+
+    def feed(self, data):
+        raise ValueError("malformed header")
+
+
+class LineReader:
+    header = b"line"
+
+    def __init__(self):
+        self.data = b""
+
+    def feed(self, data):
+        self.data += data
+        return self.data.endswith(b"\n")
+
+
+def test_reader_error_reaches_its_waiter_only():
+    reactor = Reactor().start()
+    broken_r, broken_w = os.pipe()
+    ok_r, ok_w = os.pipe()
+    broken, ok = reactor.register(broken_r), reactor.register(ok_r)
+    try:
+        def write():
+            time.sleep(0.1)
+            os.write(broken_w, b"garbage")
+            time.sleep(0.1)
+            os.write(ok_w, b"fine\n")
+
+        threading.Thread(target=write).start()
+        with pytest.raises(ValueError, match="malformed header"):
+            reactor.wait_frame(broken, BrokenReader(), timeout=5)
+        reader = LineReader()
+        reactor.wait_frame(ok, reader, timeout=5)
+        assert reader.data == b"fine\n"
+    finally:
+        reactor.unregister(broken)
+        reactor.unregister(ok)
+        reactor.close()
+        for fd in (broken_r, broken_w, ok_r, ok_w):
+            os.close(fd)
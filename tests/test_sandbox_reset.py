@@ -0,0 +1,90 @@
+import io
+import tarfile
+
+from fakes import require_docker
+
+require_docker()
+
+from sandbox import Sandbox, _directory_metadata, _top_level_paths
+
+
+def _archive(path, kind=tarfile.DIRTYPE, mode=0o755, uid=0, gid=0, mtime=1000, data=b""):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo(path.rsplit("/", 1)[-1])
+        info.type, info.mode, info.uid, info.gid, info.mtime = kind, mode, uid, gid, mtime
+        info.size = len(data) if kind == tarfile.REGTYPE else 0
+        tar.addfile(info, io.BytesIO(data) if kind == tarfile.REGTYPE else None)
+    return buffer.getvalue()
+
+
+class Template:
+    """A created container of the image: what `get_archive` returns for each path."""
+
+    def __init__(self, archives):
+        self.id = f"template-{id(self)}"
+        self.archives = archives
+        self.requests = []
+
+    def get_archive(self, path, chunk_size=None):
+        self.requests.append(path)
+        data = self.archives[path]
+        size = chunk_size or len(data)
+        return (data[i:i + size] for i in range(0, len(data), size)), {}
+
+
+class Container:
+    def __init__(self, changes, directories):
+        self.changes = changes
+        self.directories = directories
+        self.commands = []
+        self.restored = []
+
+    def diff(self):
+        return self.changes
+
+    def exec_run(self, cmd, demux=False):
+        self.commands.append(cmd)
+        if cmd[0] == "find":
+            found = "".join(f"{p}\n" for p in cmd[1:-4] if p in self.directories).encode()
+            return 0, (found, None)
+        return 0, b""
+
+    def put_archive(self, path, data):
+        self.restored.append((path, tarfile.open(fileobj=io.BytesIO(data)).getnames()))
+
+
+def test_top_level_paths_drop_descendants():
+    assert _top_level_paths(["/a/b/c", "/a", "/ab", "/x/y", "/x/y/z"]) == ["/a", "/ab", "/x/y"]
+
+
+def test_directory_metadata_reads_the_first_header_once():
+    template = Template({"/etc": _archive("/etc", mode=0o40755, uid=1, gid=2, mtime=1234)})
+    assert _directory_metadata(template, "/etc") == (0o755, 1, 2, 1234)
+    assert _directory_metadata(template, "/etc") == (0o755, 1, 2, 1234)
+    assert template.requests == ["/etc"]
+
+
+def test_revert_filesystem_undoes_every_kind_of_change():
+    changes = [
+        {"Path": "/tmp/new", "Kind": 1},
+        {"Path": "/tmp/new/file", "Kind": 1},
+        {"Path": "/etc", "Kind": 0},
+        {"Path": "/etc/hosts", "Kind": 0},
+        {"Path": "/etc/passwd", "Kind": 2},
+    ]
+    template = Template({
+        "/etc": _archive("/etc", mode=0o755, mtime=99),
+        "/etc/hosts": _archive("/etc/hosts", tarfile.REGTYPE, data=b"127.0.0.1 localhost\n"),
+        "/etc/passwd": _archive("/etc/passwd", tarfile.REGTYPE, data=b"root:x:0:0::/root:/bin/sh\n"),
+    })
+    sandbox = Sandbox(client=object())
+    sandbox.container = Container(changes, directories={"/etc"})
+
+    sandbox._revert_filesystem(template)
+
+    commands = sandbox.container.commands
+    assert ["rm", "-rf", "--", "/tmp/new"] in commands
+    assert sorted(sandbox.container.restored) == [("/etc", ["hosts"]), ("/etc", ["passwd"])]
+    # The directory itself only gets its metadata back, after its entries were restored
+    assert commands[-1] == ["/bin/sh", "-c", "chown -h 0:0 /etc; chmod 0755 /etc; touch -h -d @99 /etc"]
@@ -0,0 +1,101 @@
+import threading
+
+from fakes import require_docker
+
+docker = require_docker()
+
+from setup_cache import SetupCache
+
+
+class Images:
+    def __init__(self, tags=(), in_use=()):
+        self.tags = set(tags)
+        self.in_use = set(in_use)
+        self.removed = []
+
+    def get(self, tag):
+        if tag not in self.tags:
+            raise docker.errors.ImageNotFound(tag)
+
+    def remove(self, tag):
+        if tag in self.in_use:
+            raise docker.errors.APIError(f"{tag} is in use")
+        self.tags.discard(tag)
+        self.removed.append(tag)
+
+
+class Client:
+    def __init__(self, images):
+        self.images = images
+
+
+class Committed:
+    attrs = {"Size": 1}
+
+    def reload(self):
+        pass
+
+    def history(self):
+        return [{"Size": 1234}, {"Size": 10**9}]
+
+
+class Container:
+    def __init__(self, images):
+        self.images = images
+        self.commits = 0
+
+    def commit(self, repository, tag):
+        self.commits += 1
+        self.images.tags.add(f"{repository}:{tag}")
+        return Committed()
+
+
+def _cache(tmp_path, images, **kwargs):
+    return SetupCache(client=Client(images), index_file=str(tmp_path / "index.json"), **kwargs)
+
+
+def test_key_depends_on_the_image_and_the_ordered_commands(tmp_path):
+    cache = _cache(tmp_path, Images())
+    key = cache.key("ubuntu", ["a", "b"])
+    assert key == cache.key("ubuntu", ("a", "b"))
+    assert len({key, cache.key("ubuntu", ["b", "a"]), cache.key("debian", ["a", "b"])}) == 3
+    assert cache.tag("ubuntu", ["a", "b"]) == f"shellm-setup-cache:{key}"
+
+
+def test_evict_removes_least_recently_used_until_it_fits(tmp_path):
+    images = Images(tags={"c:old", "c:busy", "c:mid", "c:new"}, in_use={"c:busy"})
+    cache = _cache(tmp_path, images, max_bytes=25)
+    cache._index = {
+        "c:new": {"size": 10, "last_used": 4},
+        "c:old": {"size": 10, "last_used": 1},
+        "c:busy": {"size": 10, "last_used": 2},
+        "c:mid": {"size": 10, "last_used": 3},
+    }
+    cache.evict()
+    # The image still in use is skipped and the next oldest goes instead
+    assert images.removed == ["c:old", "c:mid"]
+    assert cache.stats()["bytes"] == 20
+    assert _cache(tmp_path, images)._index.keys() == {"c:busy", "c:new"}
+
+
+def test_concurrent_misses_commit_once_with_the_layer_size(tmp_path):
+    images = Images()
+    cache = _cache(tmp_path, images)
+    containers = [Container(images) for _ in range(8)]
+    barrier = threading.Barrier(len(containers))
+
+    def store(container):
+        barrier.wait()
+        cache.store(container, "ubuntu", ["apt-get install -y jq"])
+
+    threads = [threading.Thread(target=store, args=(c,)) for c in containers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(c.commits for c in containers) == 1
+    assert cache.stats()["bytes"] == 1234
+    assert cache.lookup("ubuntu", ["apt-get install -y jq"]) == cache.tag("ubuntu", ["apt-get install -y jq"])
+    assert cache.lookup("ubuntu", ["something else"]) is None
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,99 @@
+import asyncio
+import importlib.util
+import os
+
+import pytest
+
+from fakes import require
+
+require("httpx", Limits=lambda **limits: limits, AsyncClient=None, TimeoutException=TimeoutError)
+
+# Loaded from its path: shellm/ also has a `sandbox` module, which wins on sys.path
+_spec = importlib.util.spec_from_file_location(
+    "rl_sandbox", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rl", "sandbox.py"))
+rl_sandbox = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(rl_sandbox)
+
+
+class Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+
+class Server:
+    """Answers SoSClient's requests, with or without the compound endpoints."""
+
+    def __init__(self, compound_status=None):
+        self.compound_status = compound_status
+        self.requests = []
+
+    async def request(self, stage, method, path, **kwargs):
+        self.requests.append((method, path))
+        if path.endswith("/create_and_start") or path.endswith("/exec_and_stop"):
+            if self.compound_status is not None:
+                return Response(self.compound_status, {"detail": "Not Found"})
+            if path.endswith("/create_and_start"):
+                return Response(200, {"id": "compound"})
+            return Response(200, {"output": "done\n", "exit_code": 0})
+        if path == "/sandboxes":
+            return Response(200, {"id": "plain"})
+        if path.endswith("/exec"):
+            return Response(200, {"output": "done\n", "exit_code": 0})
+        return Response(200, {})
+
+
+def _client(server):
+    client = rl_sandbox.SoSClient()
+    client._request = server.request
+    return client
+
+
+def test_compound_endpoints_take_one_request_each():
+    server = Server()
+    client = _client(server)
+
+    async def run():
+        sandbox_id = await client.create_and_start_sandbox("image", ["true"])
+        return sandbox_id, await client.exec_and_stop(sandbox_id, "ls")
+
+    assert asyncio.run(run()) == ("compound", ("done\n", 0))
+    assert server.requests == [("POST", "/sandboxes/create_and_start"), ("POST", "/sandboxes/compound/exec_and_stop")]
+
+
+def test_servers_without_compound_endpoints_fall_back_and_are_remembered():
+    for status in (404, 405):
+        server = Server(compound_status=status)
+        client = _client(server)
+
+        async def run():
+            first = await client.create_and_start_sandbox("image", ["true"])
+            second = await client.create_and_start_sandbox("image", ["true"])
+            return first, second, await client.exec_and_stop(second, "ls")
+
+        assert asyncio.run(run()) == ("plain", "plain", ("done\n", 0))
+        assert server.requests == [
+            ("POST", "/sandboxes/create_and_start"),
+            ("POST", "/sandboxes"),
+            ("POST", "/sandboxes/plain/start"),
+            # Known to be missing from here on
+            ("POST", "/sandboxes"),
+            ("POST", "/sandboxes/plain/start"),
+            ("POST", "/sandboxes/plain/exec"),
+            ("POST", "/sandboxes/plain/stop"),
+        ]
+
+
+def test_other_errors_of_the_compound_endpoint_are_raised():
+    server = Server(compound_status=500)
+    with pytest.raises(Exception, match="500"):
+        asyncio.run(_client(server).create_and_start_sandbox("image"))
+    assert server.requests == [("POST", "/sandboxes/create_and_start")]
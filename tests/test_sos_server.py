@@ -0,0 +1,78 @@
+import asyncio
+
+from fakes import require, require_docker
+
+
+class HTTPException(Exception):
+    def __init__(self, status_code, detail=None):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+require_docker()
+require("uvicorn")
+require("fastapi", FastAPI=object, HTTPException=HTTPException)
+require("fastapi.responses", PlainTextResponse=object, StreamingResponse=object)
+require("pydantic", BaseModel=object)
+
+from sos_server import SandboxEntry, SandboxServer
+
+
+class SlowInterruptSandbox:
+    """Streams one chunk, then blocks; closing the stream takes a while, like interrupting a command."""
+
+    image = "test"
+
+    def __init__(self):
+        self.log = []
+
+    async def astream_command(self, command, timeout=None):
+        self.log.append(f"start {command}")
+        try:
+            yield {"output": command}
+            await asyncio.sleep(10)
+            yield {"exit_code": 0}
+        finally:
+            await asyncio.sleep(0.1)
+            self.log.append(f"interrupted {command}")
+
+
+def _server_and_entry():
+    entry = SandboxEntry("sandbox", SlowInterruptSandbox())
+    entry.status = "running"
+    return object.__new__(SandboxServer), entry
+
+
+def test_abandoned_stream_holds_the_sandbox_until_interrupted():
+    async def run():
+        server, entry = _server_and_entry()
+        first = await server.exec_stream(entry, "first")
+        assert await first.__anext__() == '{"output": "first"}\n'
+        await first.aclose()
+
+        second = await server.exec_stream(entry, "second")
+        await second.__anext__()
+        await second.aclose()
+        return entry.sandbox.log, entry.lock.locked()
+
+    log, locked = asyncio.run(run())
+    assert log == ["start first", "interrupted first", "start second", "interrupted second"]
+    assert not locked
+
+
+def test_cancelled_close_still_waits_for_the_interrupt():
+    async def run():
+        server, entry = _server_and_entry()
+        first = await server.exec_stream(entry, "first")
+        await first.__anext__()
+        closing = asyncio.create_task(first.aclose())
+        await asyncio.sleep(0.01)
+        closing.cancel()
+        await asyncio.gather(closing, return_exceptions=True)
+
+        await entry.lock.acquire()
+        entry.sandbox.log.append("next")
+        entry.lock.release()
+        return entry.sandbox.log
+
+    assert asyncio.run(run()) == ["start first", "interrupted first", "next"]
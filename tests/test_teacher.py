@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fakes import require
+
+require("pydantic", BaseModel=object)
+require("dotenv", load_dotenv=lambda *args, **kwargs: None)
+
+from history import History
+from teacher import ShellTeacher
+
+
+class Client:
+    """Answers every request with the next reply and records the requests."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **request):
+        self.requests.append(request)
+        message = SimpleNamespace(content=self.replies.pop(0))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def _teacher(*replies, single_call=True):
+    client = Client(*replies)
+    clients = SimpleNamespace(openai=lambda base_url, api_key: client, completion_cache=None)
+    return ShellTeacher(single_call=single_call, clients=clients), client
+
+
+def test_single_call_reply_with_reasoning_and_command():
+    teacher, client = _teacher("# List the files\n# then read them\nls -la")
+    assert teacher.get_next_step("task", History()) == ("# List the files\n# then read them", "ls -la")
+    assert teacher.last_single_call and len(client.requests) == 1
+
+
+def test_single_call_reply_with_only_reasoning_falls_back_to_a_second_call():
+    teacher, client = _teacher("# List the files", "ls -la")
+    assert teacher.get_next_step("task", History()) == ("# List the files", "ls -la")
+    assert not teacher.last_single_call and teacher.fallbacks == 1
+    assert len(client.requests) == 2
+
+
+def test_single_call_reply_without_reasoning_is_the_command():
+    teacher, client = _teacher("ls -la\n")
+    assert teacher.get_next_step("task", History()) == ("", "ls -la")
+    assert teacher.last_single_call and len(client.requests) == 1
+
+    history = History([{"turn": 1, "thought": "", "action": "ls -la", "observation": "a.txt\n", "exit_code": 0, "single_call": True}])
+    assert history.chat_messages() == [
+        {"role": "assistant", "content": "ls -la"},
+        {"role": "user", "content": "a.txt\n"},
+    ]
+
+
+def test_two_call_mode_still_requires_reasoning():
+    teacher, _ = _teacher("ls -la", single_call=False)
+    with pytest.raises(Exception, match="Reasoning was not a comment"):
+        teacher.get_next_step("task", History())
@@ -0,0 +1,78 @@
+import os
+import socket
+import subprocess
+import time
+
+from fakes import require_docker
+
+require_docker()
+
+import teardown
+from teardown import CREATED_LABEL, OWNER_LABEL, OrphanReaper, _owner_alive
+
+
+class Container:
+    def __init__(self, container_id, owner, created, name=None):
+        self.id = container_id
+        self.short_id = container_id[:12]
+        self.name = name or f"container-{container_id}"
+        self.labels = {OWNER_LABEL: owner, CREATED_LABEL: str(int(created))}
+        self.removed = False
+
+    def rename(self, name):
+        self.name = name
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+class Containers:
+    def __init__(self, containers):
+        self.containers = containers
+
+    def list(self, all=False, filters=None):
+        return [c for c in self.containers if not c.removed]
+
+
+class Client:
+    def __init__(self, containers):
+        self.containers = Containers(containers)
+
+
+def _dead_pid():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def test_owner_alive():
+    host = socket.gethostname()
+    assert _owner_alive(f"{host}:{os.getppid()}")
+    assert not _owner_alive(f"{host}:{_dead_pid()}")
+    # This process's own containers are judged by their tracking, not by its liveness
+    assert not _owner_alive(f"{host}:{os.getpid()}")
+    # Another host sharing the daemon can't be checked, so its owner counts as alive
+    assert _owner_alive(f"not-{host}:1")
+    assert not _owner_alive("garbage")
+
+
+def test_reaper_counts_the_ttl_from_the_last_heartbeat():
+    host = socket.gethostname()
+    dead = f"{host}:{_dead_pid()}"
+    old = time.time() - 7200
+    orphan = Container("a" * 64, dead, old)
+    reused = Container("b" * 64, dead, old)
+    tracked = Container("c" * 64, dead, old)
+    foreign = Container("d" * 64, f"not-{host}:1", old)
+    young = Container("e" * 64, dead, time.time())
+    teardown.heartbeat(reused)
+    teardown.track(tracked)
+    try:
+        reaper = OrphanReaper(client=Client([orphan, reused, tracked, foreign, young]), ttl=3600)
+        assert reaper.reap() == 1
+    finally:
+        teardown.untrack(tracked)
+    assert orphan.removed
+    assert not any(c.removed for c in (reused, tracked, foreign, young))
+    assert teardown.last_used(reused) >= int(time.time()) - 1
+    assert teardown.last_used(orphan) == int(old)